@@ -35,6 +35,7 @@ valid_countries = [
     'GB', 'HR', 'LT', 'LV', 'KZ', 'NL',
     'RU', 'SE', 'US' ] # test test, fill up! :)
 valid_prefix_types = [ 'host', 'reservation', 'assignment' ]
+valid_allocation_strategies = [ 'first-fit', 'next-fit', 'sparse' ]
 valid_prefix_status = [ 'assigned', 'reserved', 'quarantine' ]
 valid_families = [ 'ipv4', 'ipv6', 'dual-stack' ]
 valid_bools = [ 'true', 'false' ]
@@ -586,16 +587,16 @@ def list_prefix(arg, opts, shell_opts):
                 sys.exit(1)
             columns.append(col)
 
-    offset = 0
+    after = None
     # small initial limit for "instant" result
     limit = 50
     prefix_str = ""
     while True:
         res = Prefix.smart_search(search_string, { 'parents_depth': -1,
-            'include_neighbors': True, 'offset': offset, 'max_result': limit },
+            'include_neighbors': True, 'after': after, 'max_result': limit },
             vrf_q)
 
-        if offset == 0: # first time in loop?
+        if after is None: # first time in loop?
             if shell_opts.show_interpretation:
                 print("Query interpretation:")
                 _parse_interp_prefix(res['interpretation'])
@@ -667,9 +668,9 @@ def list_prefix(arg, opts, shell_opts):
             except UnicodeEncodeError as e:
                 print("\nCrazy encoding for prefix %s\n" % p.prefix, file=sys.stderr)
 
-        if len(res['result']) < limit:
+        if res['next_cursor'] is None:
             break
-        offset += limit
+        after = res['next_cursor']
 
         # let consecutive limit be higher to tax the XML-RPC backend less
         limit = 200
@@ -992,6 +993,7 @@ def add_pool(arg, opts, shell_opts):
     p.default_type = opts.get('default-type')
     p.ipv4_default_prefix_length = opts.get('ipv4_default_prefix_length')
     p.ipv6_default_prefix_length = opts.get('ipv6_default_prefix_length')
+    p.allocation_strategy = opts.get('allocation-strategy')
 
     if 'tags' in opts:
         tags = list(csv.reader([opts.get('tags', '')], escapechar='\\'))[0]
@@ -1104,6 +1106,7 @@ def view_pool(arg, opts, shell_opts):
     print("  %-26s : %s" % ("Default type", p.default_type))
     print("  %-26s : %s / %s" % ("Implied VRF RT / name", vrf_rt, vrf_name))
     print("  %-26s : %s / %s" % ("Preflen (v4/v6)", str(p.ipv4_default_prefix_length), str(p.ipv6_default_prefix_length)))
+    print("  %-26s : %s" % ("Allocation strategy", p.allocation_strategy))
 
     print("-- Extra Attributes")
     if p.avps is not None:
@@ -1551,6 +1554,8 @@ def modify_pool(arg, opts, shell_opts):
         p.ipv4_default_prefix_length = opts['ipv4_default_prefix_length']
     if 'ipv6_default_prefix_length' in opts:
         p.ipv6_default_prefix_length = opts['ipv6_default_prefix_length']
+    if 'allocation-strategy' in opts:
+        p.allocation_strategy = opts['allocation-strategy']
     if 'tags' in opts:
         tags = list(csv.reader([opts.get('tags', '')], escapechar='\\'))[0]
         p.tags = {}
@@ -2023,6 +2028,13 @@ def complete_prefix_type(arg):
 
 
 
+def complete_allocation_strategy(arg):
+    """ Complete NIPAP pool allocation strategy
+    """
+    return _complete_string(arg, valid_allocation_strategies)
+
+
+
 def complete_prefix_status(arg):
     """ Complete NIPAP prefix status
     """
@@ -2799,6 +2811,15 @@ cmds = {
                                 'descripton': 'Default IPv6 prefix length'
                             }
                         },
+                        'allocation-strategy': {
+                            'type': 'option',
+                            'argument': {
+                                'type': 'value',
+                                'content_type': str,
+                                'descripton': 'Allocation strategy: first-fit | next-fit | sparse',
+                                'complete': complete_allocation_strategy,
+                            }
+                        },
                         'tags': {
                             'type': 'option',
                             'content_type': str,
@@ -2979,6 +3000,15 @@ cmds = {
                                         'descripton': 'Default IPv6 prefix length'
                                     }
                                 },
+                                'allocation-strategy': {
+                                    'type': 'option',
+                                    'argument': {
+                                        'type': 'value',
+                                        'content_type': str,
+                                        'descripton': 'Allocation strategy: first-fit | next-fit | sparse',
+                                        'complete': complete_allocation_strategy,
+                                    }
+                                },
                                 'tags': {
                                     'type': 'option',
                                     'content_type': str,
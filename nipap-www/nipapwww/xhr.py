@@ -939,6 +939,7 @@ class NipapJSONEncoder(json.JSONEncoder):
                 'default_type': obj.default_type,
                 'ipv4_default_prefix_length': obj.ipv4_default_prefix_length,
                 'ipv6_default_prefix_length': obj.ipv6_default_prefix_length,
+                'allocation_strategy': obj.allocation_strategy,
                 'tags': obj.tags,
                 'member_prefixes_v4': obj.member_prefixes_v4,
                 'member_prefixes_v6': obj.member_prefixes_v6,
@@ -1,5 +1,5 @@
 __version__		= "0.32.7"
-__db_version__	= 8
+__db_version__	= 9
 __author__		= "Kristian Larsson, Lukas Garberg"
 __author_email__ = "kll@tele2.net, lukas@spritelink.net"
 __copyright__	= "Copyright 2011-2014, Kristian Larsson, Lukas Garberg"
@@ -63,6 +63,8 @@
     Classes
     -------
 """
+from functools import wraps
+import getpass
 import json
 import logging
 from datetime import datetime, timedelta
@@ -76,6 +78,7 @@ import sqlite3
 import string
 import random
 import requests
+import threading
 
 from .tracing import create_span_authenticate
 
@@ -90,6 +93,21 @@ except ImportError:
     ldap = None
 
 
+def _synchronized(f):
+    """ Run method while holding the lock of the instance
+
+        Auth objects are cached and shared by the threads of nipapd, so
+        methods using state such as a database connection must not run
+        concurrently.
+    """
+    @wraps(f)
+    def decorated(self, *args, **kwargs):
+        with self._lock:
+            return f(self, *args, **kwargs)
+
+    return decorated
+
+
 class AuthFactory:
     """ An factory for authentication backends.
     """
@@ -97,6 +115,7 @@ class AuthFactory:
     _logger = None
     _config = None
     _auth_cache = {}
+    _auth_cache_lock = threading.Lock()
     _backends = {}
 
     def __init__(self):
@@ -187,12 +206,13 @@ class AuthFactory:
             raise AuthError("Missing authoritative_source.")
 
         # remove invalid cache entries
-        rem = list()
-        for key in self._auth_cache:
-            if self._auth_cache[key]['valid_until'] < datetime.utcnow():
-                rem.append(key)
-        for key in rem:
-            del self._auth_cache[key]
+        with self._auth_cache_lock:
+            rem = list()
+            for key in self._auth_cache:
+                if self._auth_cache[key]['valid_until'] < datetime.utcnow():
+                    rem.append(key)
+            for key in rem:
+                del self._auth_cache[key]
 
         user_authbackend = username.rsplit('@', 1)
 
@@ -208,9 +228,11 @@ class AuthFactory:
         # do we have a cached instance?
         auth_str = (str(username) + str(password) + str(authoritative_source)
                     + str(auth_options))
-        if auth_str in self._auth_cache:
+        with self._auth_cache_lock:
+            cached = self._auth_cache.get(auth_str)
+        if cached is not None:
             self._logger.debug('found cached auth object for user %s', username)
-            return self._auth_cache[auth_str]['auth_object']
+            return cached['auth_object']
 
         # Create auth object
         try:
@@ -219,10 +241,11 @@ class AuthFactory:
             raise AuthError("Invalid auth backend '{}' specified".format(backend))
 
         # save auth object to cache
-        self._auth_cache[auth_str] = {
-            'valid_until': datetime.utcnow() + timedelta(seconds=self._config.getint('auth', 'auth_cache_timeout')),
-            'auth_object': auth
-        }
+        with self._auth_cache_lock:
+            self._auth_cache[auth_str] = {
+                'valid_until': datetime.utcnow() + timedelta(seconds=self._config.getint('auth', 'auth_cache_timeout')),
+                'auth_object': auth
+            }
 
         return auth
 
@@ -297,6 +320,20 @@ class BaseAuth:
         return False
 
 
+def local_auth():
+    """ Return an auth object for the local user.
+
+        Used by command line tools which reach the database through the
+        configuration file rather than by authenticating.
+    """
+
+    auth = BaseAuth(getpass.getuser(), None, 'nipap', 'local')
+    auth.authenticated_as = auth.username
+    auth.full_name = auth.username
+    auth.readonly = False
+    return auth
+
+
 class JwtAuth(BaseAuth):
     """ An authentication and authorization class for JWT auth.
     """
@@ -624,11 +661,15 @@ class LdapAuth(BaseAuth):
 
 class SqliteAuth(BaseAuth):
     """ An authentication and authorization class for local auth.
+
+        The database connection of an instance is shared by the threads
+        using it, so its methods hold the lock of the instance.
     """
 
     _db_conn = None
     _db_curs = None
     _authenticated = None
+    _lock = None
 
     def __init__(self, name, username, password, authoritative_source, auth_options=None):
         """ Constructor.
@@ -660,6 +701,8 @@ class SqliteAuth(BaseAuth):
 
         self._logger.debug('Creating SqliteAuth instance')
 
+        self._lock = threading.RLock()
+
         # connect to database
         try:
             self._db_conn = sqlite3.connect(
@@ -673,6 +716,7 @@ class SqliteAuth(BaseAuth):
             self._logger.error('Could not open user database: %s', str(exc))
             raise AuthError(str(exc))
 
+    @_synchronized
     def _latest_db_version(self):
         """ Check if database is of the latest version
 
@@ -694,6 +738,7 @@ class SqliteAuth(BaseAuth):
 
         return True
 
+    @_synchronized
     def _create_database(self):
         """ Set up database
 
@@ -712,6 +757,7 @@ class SqliteAuth(BaseAuth):
         self._db_curs.execute(sql)
         self._db_conn.commit()
 
+    @_synchronized
     def _upgrade_database(self):
         """ Upgrade database to latest version
 
@@ -728,6 +774,7 @@ class SqliteAuth(BaseAuth):
         self._db_conn.commit()
 
     @create_span_authenticate
+    @_synchronized
     def authenticate(self):
         """ Verify authentication.
 
@@ -784,6 +831,7 @@ class SqliteAuth(BaseAuth):
                            self.authenticated_as, self.username, self.full_name, str(self.readonly))
         return self._authenticated
 
+    @_synchronized
     def get_user(self, username):
         """ Fetch the user from the database
 
@@ -795,6 +843,7 @@ class SqliteAuth(BaseAuth):
         user = self._db_curs.fetchone()
         return user
 
+    @_synchronized
     def add_user(self, username, password, full_name=None, trusted=False, readonly=False):
         """ Add user to SQLite database.
 
@@ -826,6 +875,7 @@ class SqliteAuth(BaseAuth):
         except (sqlite3.OperationalError, sqlite3.IntegrityError) as error:
             raise AuthError(error)
 
+    @_synchronized
     def remove_user(self, username):
         """ Remove user from the SQLite database.
 
@@ -841,6 +891,7 @@ class SqliteAuth(BaseAuth):
             raise AuthError(error)
         return self._db_curs.rowcount
 
+    @_synchronized
     def modify_user(self, username, data):
         """ Modify user in SQLite database.
 
@@ -869,6 +920,7 @@ class SqliteAuth(BaseAuth):
         except (sqlite3.OperationalError, sqlite3.IntegrityError) as error:
             raise AuthError(error)
 
+    @_synchronized
     def list_users(self):
         """ List all users.
         """
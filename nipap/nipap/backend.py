@@ -93,6 +93,9 @@
     * :func:`~Nipap.add_prefix` - Add a prefix, more or less automatically.
     * :func:`~Nipap.edit_prefix` - Edit a prefix.
     * :func:`~Nipap.remove_prefix` - Remove a prefix.
+    * :func:`~Nipap.bulk_load_prefixes` - Load prefixes in bulk from a CSV file.
+    * :func:`~Nipap.verify_stats` - Find prefix, VRF and pool statistics which are off.
+    * :func:`~Nipap.rebuild_stats` - Rebuild prefix, VRF and pool statistics which are off.
     * :func:`~Nipap.search_prefix` - Search prefixes based on a formatted dict.
     * :func:`~Nipap.smart_search_prefix` - Search prefixes based on a string.
 
@@ -113,6 +116,10 @@
     * :attr:`default_type` - Default prefix type (see prefix types above.
     * :attr:`ipv4_default_prefix_length` - Default prefix length of IPv4 prefixes.
     * :attr:`ipv6_default_prefix_length` - Default prefix length of IPv6 prefixes.
+    * :attr:`allocation_strategy` - How free prefixes are picked when
+        allocating from the pool, one of :data:`first-fit` (default),
+        :data:`next-fit` or :data:`sparse`. See
+        :func:`~Nipap.find_free_prefix`.
     * :attr:`tags` - Tag keywords for simple searching and filtering of pools.
     * :attr:`avps` - Attribute-Value Pairs. This field can be used to add
         various extra attributes that a user wishes to store together with a
@@ -185,14 +192,21 @@
     Classes
     -------
 """
+import base64
+import collections
+import csv
+from contextlib import contextmanager
 from functools import wraps
 import dateutil.parser
 import datetime
+import json
 import logging
+import os
 import psycopg2
 import psycopg2.extras
 from psycopg2.extensions import adapt
 import shlex
+import threading
 import time
 import re
 import IPy
@@ -219,6 +233,10 @@ except:
 # list of all attributes on a pool, including both writable and read-only
 # values
 _pool_spec = {
+        'allocation_strategy': {
+            'column': 'po.allocation_strategy',
+            'ro': False,
+        },
         'avps': {
             'column': 'po.avps',
             'ro': False,
@@ -316,6 +334,14 @@ _pool_spec = {
 # read-only from _pool_spec
 _pool_attrs = {k: v for k, v in _pool_spec.items() if not _pool_spec[k]['ro']}
 
+# ways of picking free prefixes when allocating, first one is the default
+_allocation_strategies = ['first-fit', 'next-fit', 'sparse']
+
+# first key of the advisory locks serializing allocations, the second key is
+# the ID of the pool or VRF allocated from
+_lock_allocate_pool = 1
+_lock_allocate_vrf = 2
+
 
 # list of all attributes on a prefix, including both writable and read-only
 # values
@@ -365,7 +391,7 @@ _prefix_spec = {
             'ro': True,
         },
         'free_addresses': {
-            'column': 'inp.free_addresses',
+            'column': '(SELECT free_addresses FROM ip_net_plan_stats WHERE prefix_id = inp.id)',
             'ro': True,
         },
         'id': {
@@ -377,7 +403,7 @@ _prefix_spec = {
             'ro': True,
         },
         'indent': {
-            'column': 'inp.indent',
+            'column': '(SELECT COUNT(1) FROM ip_net_plan_ancestor WHERE prefix_id = inp.id)',
             'ro': True,
         },
         'last_modified': {
@@ -417,7 +443,7 @@ _prefix_spec = {
             'ro': False,
         },
         'total_addresses': {
-            'column': 'inp.total_addresses',
+            'column': '(SELECT total_addresses FROM ip_net_plan_stats WHERE prefix_id = inp.id)',
             'ro': True,
         },
         'type': {
@@ -425,7 +451,7 @@ _prefix_spec = {
             'ro': False,
         },
         'used_addresses': {
-            'column': 'inp.used_addresses',
+            'column': '(SELECT used_addresses FROM ip_net_plan_stats WHERE prefix_id = inp.id)',
             'ro': True,
         },
         'vlan': {
@@ -459,7 +485,8 @@ prefix_search_options_spec = {
     'include_all_children': False,
     'include_neighbors': False,
     'max_result': 50,
-    'offset': 0
+    'offset': 0,
+    'after': None
 }
 
 
@@ -533,6 +560,7 @@ _operation_map = {
     'and': 'AND',
     'or': 'OR',
     'equals_any': '= ANY',
+    'in': 'IN',
     '=': '=',
     'equals': '=',
     '<': '<',
@@ -586,6 +614,47 @@ def requires_rw(f):
     return decorated
 
 
+def requires_db_connection(f):
+    """ Check out a database connection for the duration of the call
+
+        A connection is taken from the connection pool before calling the
+        function and returned afterwards. Nested calls, such as add_prefix()
+        calling list_prefix(), reuse the connection already checked out.
+    """
+
+    @wraps(f)
+    def decorated(self, *args, **kwargs):
+        with self._db_connection():
+            return f(self, *args, **kwargs)
+
+    return decorated
+
+
+def _encode_prefix_cursor(rt_order, prefix):
+    """ Encode the position of a prefix in a search result as a cursor
+
+        The cursor is an opaque string holding the sort key of the prefix,
+        that is the VRF RT order and the prefix itself.
+    """
+    return base64.urlsafe_b64encode(json.dumps([rt_order, prefix]).encode()).decode()
+
+
+def _decode_prefix_cursor(cursor):
+    """ Decode a cursor created by _encode_prefix_cursor
+
+        Returns a tuple of (rt_order, prefix).
+    """
+    try:
+        rt_order, prefix = json.loads(base64.urlsafe_b64decode(str(cursor).encode()))
+        if rt_order is not None and not isinstance(rt_order, int):
+            raise ValueError()
+        IPy.IP(prefix)
+    except (TypeError, ValueError):
+        raise NipapValueError("Invalid value for option 'after'. Must be a cursor returned by a previous search.")
+
+    return rt_order, prefix
+
+
 def _parse_expires(expires):
     """ Parse the 'expires' attribute, guessing what format it is in and
         returning a datetime
@@ -610,17 +679,646 @@ def _parse_expires(expires):
     raise NipapValueError("Invalid date specification for expires")
 
 
+def _nesting_levels(rows):
+    """ Split rows of prefixes to add into levels of non-nested prefixes
+
+        The triggers of ip_net_plan expect the parents of a new prefix to
+        already be in the table, which they are not when inserted by the
+        same statement. A level holds no two prefixes of the same VRF
+        where one covers the other and the levels are returned parents
+        first, so each level can be added with one statement. Prefixes
+        which are not valid are put on the first level, for the database
+        to reject.
+    """
+
+    levels = [[]]
+    keyed = []
+    for row in rows:
+        try:
+            net = IPy.IP(row[1]['prefix'])
+        except (ValueError, TypeError):
+            levels[0].append(row)
+            continue
+        keyed.append(((row[1]['vrf_id'], net.version()), net.int(), -net.prefixlen(), net.broadcast().int(), row))
+
+    # with the prefixes sorted on their first address, widest first, the
+    # prefixes covering a prefix are the ones on the stack
+    keyed.sort(key=lambda key: key[:3])
+    stack = []
+    for family, first, neg_len, last, row in keyed:
+        while stack and (stack[-1][0] != family or stack[-1][1] < first):
+            stack.pop()
+        if len(stack) == len(levels):
+            levels.append([])
+        levels[len(stack)].append(row)
+        stack.append((family, last))
+
+    return [level for level in levels if len(level) > 0]
+
+
+_placeholder_re = re.compile(r'%%|%s|%\(([^)]+)\)s')
+
+# statements prepared from queries, keyed on the query and which of its
+# parameters are NULL
+_prepared_statements = {}
+_prepared_statements_lock = threading.Lock()
+
+
+def _prepared_statement(sql, opt):
+    """ Return a statement to prepare for a query with psycopg2 placeholders
+
+        Returns a tuple of the name of the statement, the statement with the
+        placeholders replaced by numbered parameters and the keys of `opt`
+        to take the value of each parameter from. NULL-values are put in the
+        statement as is, as they can not be used as parameters with IS.
+    """
+
+    if isinstance(opt, dict):
+        nulls = tuple(sorted(key for key, value in opt.items() if value is None))
+    else:
+        nulls = tuple(i for i, value in enumerate(opt or []) if value is None)
+
+    with _prepared_statements_lock:
+        statement = _prepared_statements.get((sql, nulls))
+        if statement is not None:
+            return statement
+
+        keys = []
+        position = [0]
+
+        def replace(m):
+            if m.group(0) == '%%':
+                return '%'
+            if m.group(0) == '%s':
+                key = position[0]
+                position[0] += 1
+            else:
+                key = m.group(1)
+            if key in nulls:
+                return 'NULL'
+            if key not in keys:
+                keys.append(key)
+            return '$%d' % (keys.index(key) + 1)
+
+        statement = ('nipap_%d' % len(_prepared_statements),
+                     _placeholder_re.sub(replace, sql) if opt is not None else sql,
+                     keys)
+        _prepared_statements[(sql, nulls)] = statement
+        return statement
+
+
+class NipapConnection(psycopg2.extensions.connection):
+    """ A database connection which keeps track of its prepared statements
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # parameter types of the statements prepared, by name
+        self.prepared = {}
+
+
+class NipapConnectionPool:
+    """ A pool of database connections.
+
+        One pool is kept per process and shared by all Nipap instances within
+        it, which means that the XML-RPC and REST APIs use the same set of
+        connections. At most `max_size` connections are opened and a caller
+        wanting a connection when all are in use waits for up to `timeout`
+        seconds for one to be returned. Connections that have been idle for
+        longer than `check_interval` seconds are checked before being handed
+        out again and replaced if found broken.
+    """
+
+    def __init__(self, db_args, min_size=1, max_size=10, check_interval=30, timeout=30):
+        """ Constructor.
+
+            No connections are opened until needed, see fill().
+        """
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.db_args = db_args
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.check_interval = check_interval
+        self.timeout = timeout
+
+        # the pool belongs to the process that created it
+        self.pid = os.getpid()
+        # set once the database schema version has been verified
+        self.verified = False
+        # descriptions of the unique indexes, to explain duplicate key errors
+        self.index_descriptions = {}
+
+        self._cond = threading.Condition()
+        # idle connections as tuples of (connection, time of return)
+        self._idle = []
+        # number of connections checked out or being opened
+        self._used = 0
+
+        # executions of prepared statements and how many of them had to
+        # prepare the statement first, by statement
+        self._prepared_executions = collections.Counter()
+        self._prepared_misses = collections.Counter()
+
+    def _connect(self):
+        """ Open a new database connection
+        """
+
+        con = psycopg2.connect(**self.db_args, connection_factory=NipapConnection,
+                               cursor_factory=psycopg2.extras.DictCursor)
+        con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return con
+
+    def _is_healthy(self, con, idle_since):
+        """ Check if an idle connection is still usable
+        """
+
+        if con.closed:
+            return False
+
+        if time.time() - idle_since < self.check_interval:
+            return True
+
+        try:
+            curs = con.cursor()
+            curs.execute("SELECT 1")
+            curs.close()
+        except psycopg2.Error as exc:
+            self._logger.info("Discarding broken database connection: %s", exc)
+            return False
+
+        return True
+
+    def _release(self):
+        """ Give back a slot for a connection which was never returned
+        """
+
+        with self._cond:
+            self._used -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        """ Check out a connection from the pool
+
+            Reuses an idle connection if there is one, otherwise opens a new
+            connection unless the pool is exhausted, in which case we wait for
+            a connection to be returned.
+        """
+
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while True:
+                if len(self._idle) > 0:
+                    con, idle_since = self._idle.pop()
+                    break
+                if self._used < self.max_size:
+                    con = None
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise NipapError("Timed out waiting for a database connection")
+                self._cond.wait(remaining)
+
+            self._used += 1
+
+        try:
+            if con is not None and not self._is_healthy(con, idle_since):
+                self.close_connection(con)
+                con = None
+            if con is None:
+                con = self._connect()
+        except:
+            self._release()
+            raise
+
+        return con
+
+    def putconn(self, con, close=False):
+        """ Return a connection to the pool
+
+            Connections left in a transaction are rolled back. If `close` is
+            set, or the connection is broken, it is closed instead of being
+            kept.
+        """
+
+        if not close and not con.closed:
+            if con.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    con.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        with self._cond:
+            self._used -= 1
+            if not close and not con.closed:
+                self._idle.append((con, time.time()))
+            self._cond.notify()
+
+        if close:
+            self.close_connection(con)
+
+    def count_prepared(self, statement, prepared):
+        """ Count an execution of a prepared statement
+
+            `prepared` is set if the statement had to be prepared first.
+        """
+
+        with self._cond:
+            self._prepared_executions[statement] += 1
+            if prepared:
+                self._prepared_misses[statement] += 1
+
+    def prepared_statement_stats(self):
+        """ Return how well prepared statements are reused
+
+            Returns a dict keyed on statement, holding dicts with the number
+            of executions, the number of those which had to prepare the
+            statement first and the share of executions which did not.
+        """
+
+        with self._cond:
+            return {
+                statement: {
+                    'executions': executions,
+                    'prepared': self._prepared_misses[statement],
+                    'hit_rate': 1 - self._prepared_misses[statement] / executions
+                }
+                for statement, executions in self._prepared_executions.items()
+            }
+
+    def close_connection(self, con):
+        """ Close a connection, ignoring errors
+        """
+
+        try:
+            con.close()
+        except psycopg2.Error:
+            pass
+
+    def fill(self):
+        """ Open connections until the pool holds at least `min_size`
+        """
+
+        while True:
+            with self._cond:
+                if len(self._idle) + self._used >= min(self.min_size, self.max_size):
+                    return
+                self._used += 1
+
+            try:
+                con = self._connect()
+            except:
+                self._release()
+                raise
+            self.putconn(con)
+
+
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
+
+
+def _get_connection_pool(cfg):
+    """ Return the database connection pool of the current process
+
+        The pool is created on first use. nipapd instantiates Nipap before
+        forking, so a pool inherited from the parent process is never used;
+        each child creates its own.
+    """
+    global _connection_pool
+
+    with _connection_pool_lock:
+        if _connection_pool is not None and _connection_pool.pid == os.getpid():
+            return _connection_pool
+
+        # Get database configuration
+        db_args = {}
+        db_args['host'] = cfg.get('nipapd', 'db_host')
+        db_args['database'] = cfg.get('nipapd', 'db_name')
+        db_args['user'] = cfg.get('nipapd', 'db_user')
+        db_args['password'] = cfg.get('nipapd', 'db_pass')
+        db_args['sslmode'] = cfg.get('nipapd', 'db_sslmode')
+        db_args['port'] = cfg.get('nipapd', 'db_port')
+        # delete keys that are None, for example if we want to connect over a
+        # UNIX socket, the 'host' argument should not be passed into the DSN
+        if db_args['host'] is not None and db_args['host'] in ('', '""'):
+            db_args['host'] = None
+        for key in db_args.copy():
+            if db_args[key] is None:
+                del db_args[key]
+
+        _connection_pool = NipapConnectionPool(db_args,
+                                               min_size=cfg.getint('nipapd', 'db_pool_min_size'),
+                                               max_size=cfg.getint('nipapd', 'db_pool_max_size'),
+                                               check_interval=cfg.getint('nipapd', 'db_pool_check_interval'),
+                                               timeout=cfg.getint('nipapd', 'db_pool_timeout'))
+
+        return _connection_pool
+
+
+def _query_shape(query, normalize, values):
+    """ Return the shape of a query dict and append its values to `values`
+
+        The shape holds the operators and columns of the query but none of
+        the values they are compared to, so queries which only differ in
+        their values have the same shape. `normalize` is applied to each
+        leaf of the query, just as when it is compiled. None is returned for
+        queries which are not well-formed, these are left to the compile
+        functions to raise the appropriate error for.
+    """
+
+    if isinstance(query, dict) and 'operands' in query:
+        shapes = []
+        for operand in query['operands']:
+            shape = _query_shape(operand, normalize, values)
+            if shape is None:
+                return None
+            shapes.append(shape)
+        return query['operator'], tuple(shapes)
+
+    if not isinstance(query, dict) or 'val1' not in query or 'val2' not in query:
+        return None
+    if not isinstance(query.get('operator'), str):
+        return None
+
+    if isinstance(query['val1'], dict) and isinstance(query['val2'], dict):
+        shape1 = _query_shape(query['val1'], normalize, values)
+        shape2 = _query_shape(query['val2'], normalize, values)
+        if shape1 is None or shape2 is None:
+            return None
+        return query['operator'], shape1, shape2
+
+    if not isinstance(query['val1'], str):
+        return None
+
+    normalize(query)
+    values.append(query['val2'])
+    # NULL-values, lists and tuples are compiled differently from other values
+    if query['val2'] is None or isinstance(query['val2'], (list, tuple)):
+        kind = type(query['val2'])
+    else:
+        kind = None
+    return query['operator'], query['val1'], kind
+
+
+def _normalize_query(query):
+    """ Normalize a leaf of a query dict in place
+
+        Equal and not equal matches of NULL-values are turned into IS and IS
+        NOT matches. The list of an IN match is turned into a tuple, which
+        is passed as a list of values of the type of the column instead of
+        a text array. An empty list matches nothing.
+    """
+    if query['operator'] == 'equals' and query['val2'] is None:
+        query['operator'] = 'is'
+    elif query['operator'] == 'not_equals' and query['val2'] is None:
+        query['operator'] = 'is_not'
+    elif query['operator'] == 'in' and isinstance(query['val2'], list):
+        query['val2'] = tuple(query['val2']) or (None,)
+
+
+def _normalize_prefix_query(query):
+    """ Normalize a leaf of a prefix query dict in place
+
+        As :func:`_normalize_query`, but also turns a NULL VRF into the
+        default VRF.
+    """
+    if query['val1'] == 'vrf_id' and query['val2'] is None:
+        query['val2'] = 0
+    _normalize_query(query)
+
+
+def _optimize_query(query, normalize):
+    """ Return an optimized version of a query dict
+
+        The API only has binary AND and OR, so long chains of them come in
+        as deep trees. These chains are flattened into a single node with a
+        list of operands. Among the operands of a chain:
+
+        * equal matches on the same column ORed together are folded into a
+          single IN match
+        * prefix ranges made redundant by another range are removed, the
+          wider range of AND and the narrower range of OR
+
+        The query itself is not changed, apart from its leafs being
+        normalized in place by `normalize`. None is returned for queries
+        which are not well-formed, these are left to the compile functions
+        to raise the appropriate error for.
+    """
+
+    if not isinstance(query, dict) or 'val1' not in query or 'val2' not in query:
+        return None
+    if not isinstance(query.get('operator'), str):
+        return None
+
+    if not (isinstance(query['val1'], dict) and isinstance(query['val2'], dict)):
+        if not isinstance(query['val1'], str):
+            return None
+        normalize(query)
+        return query
+
+    operator = query['operator']
+    if operator not in ('and', 'or'):
+        return None
+
+    # collect the operands of the chain without recursing, as the chains can
+    # be thousands of levels deep
+    operands = []
+    stack = [query]
+    while stack:
+        node = stack.pop()
+        if (isinstance(node, dict) and node.get('operator') == operator
+                and isinstance(node.get('val1'), dict) and isinstance(node.get('val2'), dict)):
+            stack.append(node['val2'])
+            stack.append(node['val1'])
+            continue
+
+        operand = _optimize_query(node, normalize)
+        if operand is None:
+            return None
+        if 'operands' in operand and operand['operator'] == operator:
+            operands += operand['operands']
+        else:
+            operands.append(operand)
+
+    if operator == 'or':
+        operands = _fold_equals(operands)
+    operands = _merge_prefix_ranges(operator, operands)
+
+    if len(operands) == 1:
+        return operands[0]
+    return {'operator': operator, 'operands': operands}
+
+
+def _fold_equals(operands):
+    """ Fold equal matches on the same column into IN matches
+
+        The IN match takes a tuple of the values, which PostgreSQL turns
+        into an = ANY() of an array of the type of the column.
+    """
+
+    def is_equals(operand):
+        return (operand['operator'] == 'equals' and 'operands' not in operand
+                and isinstance(operand['val2'], (str, int, float)))
+
+    values = {}
+    for operand in operands:
+        if is_equals(operand):
+            values.setdefault(operand['val1'], []).append(operand['val2'])
+
+    folded = []
+    for operand in operands:
+        if not is_equals(operand):
+            folded.append(operand)
+            continue
+
+        column_values = values.pop(operand['val1'], None)
+        if column_values is None:
+            # folded into an earlier operand
+            continue
+        if len(column_values) == 1:
+            folded.append(operand)
+        else:
+            folded.append({'operator': 'in', 'val1': operand['val1'], 'val2': tuple(column_values)})
+
+    return folded
+
+
+def _merge_prefix_ranges(operator, operands):
+    """ Remove prefix ranges made redundant by another range of the chain
+
+        A range which is implied by another range is redundant when ANDed
+        and a range implying another range is redundant when ORed.
+    """
+
+    ranges = []
+    for i, operand in enumerate(operands):
+        if operand['operator'] not in ('contained_within', 'contained_within_equals'):
+            continue
+        if 'operands' in operand or operand['val1'] != 'prefix':
+            continue
+        try:
+            net = IPy.IP(operand['val2'])
+        except (ValueError, TypeError):
+            continue
+        ranges.append((i, (net.version(), net.int(), net.broadcast().int(),
+                           operand['operator'] == 'contained_within')))
+
+    def implies(a, b):
+        """ Does a prefix within range a imply it being within range b?
+        """
+        if a[0] != b[0] or a[1] < b[1] or a[2] > b[2]:
+            return False
+        # an equal prefix is within a but not strictly within b
+        return not (a[:3] == b[:3] and not a[3] and b[3])
+
+    redundant = set()
+    for i, range_i in ranges:
+        for j, range_j in ranges:
+            if i == j or j in redundant:
+                continue
+            if operator == 'and' and implies(range_j, range_i) or operator == 'or' and implies(range_i, range_j):
+                redundant.add(i)
+                break
+
+    return [operand for i, operand in enumerate(operands) if i not in redundant]
+
+
+class _QueryCache:
+    """ WHERE-clauses compiled from query dicts, least recently used first
+
+        The WHERE-clause compiled from a query only depends on the shape of
+        the query, see :func:`_query_shape`. Clients tend to repeat a handful
+        of shapes, so the clauses are kept and reused for other queries of
+        the same shape, taking the values from each query.
+    """
+
+    def __init__(self):
+        self._clauses = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def expand(self, kind, query, table_name, normalize, compile, size):
+        """ Expand query into a WHERE-clause and its values
+
+            The query is optimized, see :func:`_optimize_query`, before it
+            is compiled.
+            `compile` is called to compile the query when there is no clause
+            of its shape in the cache. At most `size` clauses are kept, 0
+            disables the cache.
+        """
+
+        optimized = _optimize_query(query, normalize)
+        if optimized is None:
+            return compile(query, table_name)
+        query = optimized
+
+        values = []
+        shape = _query_shape(query, normalize, values)
+        if shape is None or size <= 0:
+            return compile(query, table_name)
+
+        key = (kind, table_name, shape)
+        with self._lock:
+            where = self._clauses.get(key)
+            if where is not None:
+                self._clauses.move_to_end(key)
+                self.hits += 1
+                return where, values
+            self.misses += 1
+
+        where, opt = compile(query, table_name)
+
+        with self._lock:
+            self._clauses[key] = where
+            while len(self._clauses) > size:
+                self._clauses.popitem(last=False)
+
+        return where, opt
+
+    def clear(self):
+        """ Remove all clauses from the cache
+        """
+        with self._lock:
+            self._clauses.clear()
+
+
+# WHERE-clauses of the VRF, pool and prefix queries of the process
+_query_cache = _QueryCache()
+
+
+class _AllocationBatch:
+    """ Allocations from a pool waiting to be handled together
+
+        The thread creating the batch handles all requests added to it and
+        sets `done` when each request has either a result or an error.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.done = threading.Event()
+
+
+# batches of allocations being collected, keyed on what is allocated
+_allocation_batches = {}
+_allocation_batches_lock = threading.Lock()
+
+
 class Nipap:
     """ Main NIPAP class.
 
-        The main NIPAP class containing all API methods. When creating an
-        instance, a database connection object is created which is used during
-        the instance's lifetime.
+        The main NIPAP class containing all API methods. Database connections
+        are taken from a connection pool shared by all instances in the
+        process; a connection is checked out for the duration of each API
+        call, so creating an instance is cheap. The checked out connection is
+        kept per thread, which allows an instance to be shared by threads.
     """
 
     _logger = None
-    _con_pg = None
-    _curs_pg = None
+    _pool = None
+    _local = None
 
     def __init__(self, auto_install_db=False, auto_upgrade_db=False):
         """ Constructor.
@@ -638,8 +1336,30 @@ class Nipap:
         self._auto_install_db = auto_install_db
         self._auto_upgrade_db = auto_upgrade_db
 
+        self._local = threading.local()
+
         self._connect_db()
 
+    @property
+    def _con_pg(self):
+        """ Database connection checked out by the current thread
+        """
+        return getattr(self._local, 'con_pg', None)
+
+    @_con_pg.setter
+    def _con_pg(self, value):
+        self._local.con_pg = value
+
+    @property
+    def _curs_pg(self):
+        """ Cursor on the database connection of the current thread
+        """
+        return getattr(self._local, 'curs_pg', None)
+
+    @_curs_pg.setter
+    def _curs_pg(self, value):
+        self._local.curs_pg = value
+
     #
     # Miscellaneous help functions
     #
@@ -712,84 +1432,205 @@ class Nipap:
     #
 
     def _connect_db(self):
-        """ Open database connection
+        """ Set up database connection pool
+
+            The first instance in each process creates the connection pool,
+            registers the hstore type and verifies the database schema
+            version, installing or upgrading the schema if so configured.
+            Following instances just reuse the pool.
         """
 
-        # Get database configuration
-        db_args = {}
-        db_args['host'] = self._cfg.get('nipapd', 'db_host')
-        db_args['database'] = self._cfg.get('nipapd', 'db_name')
-        db_args['user'] = self._cfg.get('nipapd', 'db_user')
-        db_args['password'] = self._cfg.get('nipapd', 'db_pass')
-        db_args['sslmode'] = self._cfg.get('nipapd', 'db_sslmode')
-        db_args['port'] = self._cfg.get('nipapd', 'db_port')
-        # delete keys that are None, for example if we want to connect over a
-        # UNIX socket, the 'host' argument should not be passed into the DSN
-        if db_args['host'] is not None and db_args['host'] in ('', '""'):
-            db_args['host'] = None
-        for key in db_args.copy():
-            if db_args[key] is None:
-                del db_args[key]
+        self._pool = _get_connection_pool(self._cfg)
+        if self._pool.verified:
+            return
 
-        # Create database connection
-        while True:
-            try:
-                self._con_pg = psycopg2.connect(**db_args, cursor_factory=psycopg2.extras.DictCursor)
-                self._con_pg.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-                self._curs_pg = self._con_pg.cursor()
-                psycopg2.extras.register_hstore(self._con_pg, globally=True)
-            except psycopg2.Error as exc:
-                if re.search("database.*does not exist", str(exc)):
-                    raise NipapDatabaseNonExistentError("Database '%s' does not exist" % db_args['database'])
-                # no hstore extension, assume empty db (it wouldn't work
-                # otherwise) and do auto upgrade?
-                if re.search("hstore type not found in the database", str(exc)):
-                    # automatically install if auto-install is enabled
+        db_name = self._pool.db_args['database']
+        with self._db_connection():
+            while True:
+                try:
+                    psycopg2.extras.register_hstore(self._con_pg, globally=True)
+                except psycopg2.Error as exc:
+                    # no hstore extension, assume empty db (it wouldn't work
+                    # otherwise) and do auto upgrade?
+                    if re.search("hstore type not found in the database", str(exc)):
+                        # automatically install if auto-install is enabled
+                        if self._auto_install_db:
+                            self._db_install(db_name)
+                            continue
+                        raise NipapDatabaseMissingExtensionError("hstore extension not found in the database")
+
+                    self._logger.error("pgsql: %s", exc)
+                    raise NipapError("Backend unable to connect to database")
+
+                # check db version
+                try:
+                    current_db_version = self._get_db_version()
+                except NipapDatabaseNoVersionError as exc:
+                    # if there's no db schema version we assume the database is
+                    # empty...
                     if self._auto_install_db:
-                        self._db_install(db_args['database'])
+                        # automatically install schema?
+                        self._db_install(db_name)
+                        continue
+                    raise exc
+                except NipapError as exc:
+                    self._logger.error(str(exc))
+                    raise exc
+
+                if current_db_version != nipap.__db_version__:
+                    if self._auto_upgrade_db:
+                        self._db_upgrade(db_name)
                         continue
-                    raise NipapDatabaseMissingExtensionError("hstore extension not found in the database")
+                    raise NipapDatabaseWrongVersionError(
+                        "NIPAP PostgreSQL database is outdated. Schema version {} is required to run but you are using "
+                        "{}".format(nipap.__db_version__, current_db_version))
 
-                self._logger.error("pgsql: %s, using args: %s", exc, db_args)
-                raise NipapError("Backend unable to connect to database")
-            except psycopg2.Warning as warn:
-                self._logger.warning('pgsql: %s', warn)
+                # if we reach this we should be fine and done
+                break
 
-            # check db version
-            try:
-                current_db_version = self._get_db_version()
-            except NipapDatabaseNoVersionError as exc:
-                # if there's no db schema version we assume the database is
-                # empty...
-                if self._auto_install_db:
-                    # automatically install schema?
-                    self._db_install(db_args['database'])
-                    continue
-                raise exc
-            except NipapError as exc:
-                self._logger.error(str(exc))
-                raise exc
+            # a duplicate key error aborts the transaction it occurs in, so
+            # the descriptions of the indexes are read beforehand
+            self._execute("SELECT relname, obj_description(oid) AS description FROM pg_class "
+                          "WHERE relkind = 'i' AND obj_description(oid) IS NOT NULL")
+            self._pool.index_descriptions = {row['relname']: row['description'] for row in self._curs_pg}
 
-            if current_db_version != nipap.__db_version__:
-                if self._auto_upgrade_db:
-                    self._db_upgrade(db_args['database'])
-                    continue
-                raise NipapDatabaseWrongVersionError(
-                    "NIPAP PostgreSQL database is outdated. Schema version {} is required to run but you are using "
-                    "{}".format(nipap.__db_version__, current_db_version))
+        self._pool.verified = True
 
-            # if we reach this we should be fine and done
-            break
+        # open the configured minimum number of connections up front
+        try:
+            self._pool.fill()
+        except psycopg2.Error as exc:
+            self._logger.warning("Unable to fill database connection pool: %s", exc)
+
+    def _checkout_connection(self):
+        """ Get a connection from the pool and open a cursor on it
+        """
 
-    def _execute(self, sql, opt=None, callno=0):
+        try:
+            self._con_pg = self._pool.getconn()
+        except psycopg2.Error as exc:
+            if re.search("database.*does not exist", str(exc)):
+                raise NipapDatabaseNonExistentError("Database '%s' does not exist" % self._pool.db_args['database'])
+
+            self._logger.error("pgsql: %s, using args: %s", exc, self._pool.db_args)
+            raise NipapError("Backend unable to connect to database")
+
+        self._curs_pg = self._con_pg.cursor()
+
+    @contextmanager
+    def _db_connection(self):
+        """ Check out a database connection for the duration of a with-block
+
+            The connection and a cursor on it are available as self._con_pg
+            and self._curs_pg within the block. If a connection is already
+            checked out by this instance it is used as is.
+        """
+
+        if self._con_pg is not None:
+            yield
+            return
+
+        self._checkout_connection()
+        try:
+            yield
+        finally:
+            if self._con_pg is not None:
+                self._pool.putconn(self._con_pg)
+            self._con_pg = None
+            self._curs_pg = None
+
+    @contextmanager
+    def _without_db_connection(self):
+        """ Return the checked out connection to the pool for a with-block
+
+            Used while waiting, so that the connection can serve others in
+            the meantime. A connection is checked out again when the block
+            finishes. Must not be used within :func:`_transaction`.
+        """
+
+        self._pool.putconn(self._con_pg)
+        self._con_pg = None
+        self._curs_pg = None
+        try:
+            yield
+        finally:
+            self._checkout_connection()
+
+    @contextmanager
+    def _transaction(self):
+        """ Run the statements of a with-block in a single transaction
+
+            The transaction is committed when the block finishes and rolled
+            back if it raises an exception. If a transaction is already open
+            the block is run as part of it. Must be used within
+            :func:`_db_connection`.
+        """
+
+        if not self._con_pg.autocommit:
+            yield
+            return
+
+        self._con_pg.autocommit = False
+        try:
+            yield
+        except BaseException:
+            try:
+                self._con_pg.rollback()
+            except psycopg2.Error:
+                pass
+            raise
+        else:
+            self._con_pg.commit()
+        finally:
+            if not self._con_pg.closed:
+                self._con_pg.autocommit = True
+
+    @contextmanager
+    def _savepoint(self):
+        """ Run the statements of a with-block so they can fail on their own
+
+            A failing statement aborts the whole transaction it is run in.
+            Within the block it only undoes the block, after which the
+            transaction can carry on. Must be used within
+            :func:`_transaction`.
+        """
+
+        self._con_pg.cursor().execute("SAVEPOINT nipap_savepoint")
+        try:
+            yield
+        except BaseException:
+            if not self._con_pg.closed:
+                self._con_pg.cursor().execute("ROLLBACK TO SAVEPOINT nipap_savepoint")
+            raise
+        finally:
+            if not self._con_pg.closed:
+                self._con_pg.cursor().execute("RELEASE SAVEPOINT nipap_savepoint")
+
+    def _execute(self, sql, opt=None, callno=0, prepare=None):
         """ Execute query, catch and log errors.
+
+            Frequent queries of a fixed shape can be run as prepared
+            statements by naming them with `prepare`, see
+            :func:`_execute_prepared`.
         """
 
+        # outside of an API call, check out a connection for this statement
+        # only - its result can not be fetched afterwards
+        if self._con_pg is None:
+            with self._db_connection():
+                return self._execute(sql, opt, callno, prepare)
+
         self._logger.debug("SQL: %s params: %s", sql, str(opt))
+
+        in_transaction = not self._con_pg.autocommit
+
         try:
-            self._curs_pg.execute(sql, opt)
+            if prepare is None:
+                self._curs_pg.execute(sql, opt)
+            else:
+                self._execute_prepared(prepare, sql, opt)
         except psycopg2.InternalError as exc:
-            self._con_pg.rollback()
+            self._rollback_statement()
 
             # NOTE: psycopg2 is unable to differentiate between exceptions
             # thrown by stored procedures and certain other database internal
@@ -823,7 +1664,7 @@ class Nipap:
             raise NipapError(str(exc))
 
         except psycopg2.IntegrityError as exc:
-            self._con_pg.rollback()
+            self._rollback_statement()
 
             # this is a duplicate key error
             if exc.pgcode == "23505":
@@ -832,14 +1673,7 @@ class Nipap:
                 m = re.match(r'.*"([^"]+)"', exc.pgerror)
                 if m is None:
                     raise NipapDuplicateError("Objects primary keys already exist")
-                cursor = self._con_pg.cursor()
-                cursor.execute("""  SELECT obj_description(oid)
-                                    FROM pg_class
-                                    WHERE relname = %(relname)s""", {'relname': m.group(1)})
-
-                column_desc = '<unknown>'
-                for desc in cursor:
-                    column_desc = desc[0]
+                column_desc = self._pool.index_descriptions.get(m.group(1), '<unknown>')
 
                 # figure out the value for the duplicate value
                 column_value = None
@@ -860,7 +1694,7 @@ class Nipap:
             raise NipapError("Unhandled integrity error.")
 
         except psycopg2.DataError as exc:
-            self._con_pg.rollback()
+            self._rollback_statement()
 
             m = re.search('invalid cidr value: "([^"]+)"', exc.pgerror)
             if m is not None:
@@ -881,27 +1715,75 @@ class Nipap:
 
         except psycopg2.Error as exc:
             try:
-                self._con_pg.rollback()
+                self._rollback_statement()
             except psycopg2.Error:
                 pass
 
             estr = "Unable to execute query: %s"
             self._logger.error(estr, exc)
 
-            # abort if we've already tried to reconnect
-            if callno > 0:
-                self._logger.error(estr, exc)
+            # abort if we've already tried to reconnect or if we are in a
+            # transaction, which would be lost by reconnecting
+            if callno > 0 or in_transaction:
                 raise NipapError(estr % exc)
 
             # reconnect to database and retry query
             self._logger.info("Reconnecting to database...")
-            self._connect_db()
+            self._pool.putconn(self._con_pg, close=True)
+            self._con_pg = None
+            self._checkout_connection()
 
-            return self._execute(sql, opt, callno + 1)
+            return self._execute(sql, opt, callno + 1, prepare)
 
         except psycopg2.Warning as warn:
             self._logger.warning(warn)
 
+    def _execute_prepared(self, name, sql, opt):
+        """ Execute query as a prepared statement
+
+            The statement is prepared the first time it is executed on each
+            connection, which includes connections opened when reconnecting.
+            Its parameters are cast to the types PostgreSQL inferred for
+            them, as values such as lists are otherwise sent with types of
+            their own. `name` is what executions of the statement are
+            counted as, see :func:`NipapConnectionPool.prepared_statement_stats`.
+        """
+
+        prepared = getattr(self._con_pg, 'prepared', None)
+        if prepared is None:
+            # not a connection of our pool, just execute the query
+            self._curs_pg.execute(sql, opt)
+            return
+
+        statement, prepare_sql, keys = _prepared_statement(sql, opt)
+        types = prepared.get(statement)
+        missed = types is None
+        if missed:
+            self._curs_pg.execute("PREPARE " + statement + " AS " + prepare_sql)
+            self._curs_pg.execute("SELECT parameter_types::text[] AS types FROM pg_prepared_statements "
+                                  "WHERE name = %s", (statement,))
+            types = self._curs_pg.fetchone()['types']
+            prepared[statement] = types
+
+        if len(keys) == 0:
+            self._curs_pg.execute("EXECUTE " + statement)
+        else:
+            self._curs_pg.execute("EXECUTE " + statement + " (" +
+                                  ", ".join("%s::" + param_type for param_type in types) + ")",
+                                  [opt[key] for key in keys])
+
+        self._pool.count_prepared(name, missed)
+
+    def _rollback_statement(self):
+        """ Undo the effects of a failed statement
+
+            In a transaction the statement is left to be undone along with
+            the transaction, or the savepoint of :func:`_savepoint`.
+        """
+
+        if self._con_pg.autocommit:
+            self._con_pg.rollback()
+
     def _lastrowid(self):
         """ Get ID of last inserted column.
         """
@@ -926,6 +1808,38 @@ class Nipap:
 
         return sql, params
 
+    def _sql_expand_insert_many(self, specs, col_prefix=''):
+        """ Expand a list of dicts so they fit in a multi-row INSERT clause
+
+            Columns missing from some of the dicts are set to their default
+            value for those rows.
+        """
+        col = []
+        for spec in specs:
+            for key in spec:
+                if key not in col:
+                    col.append(key)
+
+        values = []
+        params = {}
+        for i, spec in enumerate(specs):
+            row = []
+            for key in col:
+                if key in spec:
+                    param = 'r{}_{}'.format(i, key)
+                    row.append('%(' + param + ')s')
+                    params[param] = spec[key]
+                else:
+                    row.append('DEFAULT')
+            values.append('(' + ', '.join(row) + ')')
+
+        sql = '('
+        sql += ', '.join(col_prefix + key for key in col)
+        sql += ') VALUES '
+        sql += ', '.join(values)
+
+        return sql, params
+
     def _sql_expand_update(self, spec, key_prefix='', col_prefix=''):
         """ Expand a dict so it fits in a INSERT clause
         """
@@ -978,25 +1892,16 @@ class Nipap:
             latest UPDATE ... RETURNING id query.
         """
 
-        # Get dicts for all rows which were edited by building a query for
-        # search_*. Each row returned from UPDATE ... RETURNING id gives us one
-        # query part (qp) which then are combined to one big query for the
-        # search_* API call.
-        qps = []
-        for row in self._curs_pg:
-            qps.append({'operator': 'equals', 'val1': 'id', 'val2': row['id']})
+        ids = [row['id'] for row in self._curs_pg]
 
         # if we didn't update anything return empty list
-        if len(qps) == 0:
+        if len(ids) == 0:
             return []
 
-        # fetch list of objects based on IDs
-        q = qps[0]
-
-        for qp in qps[1:]:
-            q = {'operator': 'or', 'val1': q, 'val2': qp}
-
-        updated = function(auth, q, {'max_result': 10000})['result']
+        # fetch list of objects based on IDs, there can be no more results
+        # than IDs so fetch them all
+        q = {'operator': 'in', 'val1': 'id', 'val2': ids}
+        updated = function(auth, q, {'max_result': len(ids)})['result']
 
         return updated
 
@@ -1061,7 +1966,11 @@ class Nipap:
         """ Upgrade nipap database schema
         """
         current_db_version = self._get_db_version()
+        # the functions are installed before the upgrade creates the tables
+        # some of them use, so their bodies can not be checked until then
+        self._execute("SET check_function_bodies = false")
         self._execute(db_schema.functions)
+        self._execute("RESET check_function_bodies")
         for i in range(current_db_version, nipap.__db_version__):
             self._logger.info("Upgrading DB schema: %s to %s", i, i + 1)
             upgrade_sql = db_schema.upgrade[i - 1]  # 0 count on array
@@ -1110,7 +2019,35 @@ class Nipap:
 
         return where, params
 
+    def _compile_operands(self, query, compile, table_name):
+        """ Compile a chain of AND or OR flattened by _optimize_query
+
+            Each operand is compiled with the `compile` function.
+        """
+
+        where = list()
+        opt = list()
+        for operand in query['operands']:
+            sub_where, sub_opt = compile(operand, table_name)
+            where.append(sub_where)
+            opt += sub_opt
+
+        return " ({}) ".format((" %s " % _operation_map[query['operator']]).join(where)), opt
+
     def _expand_vrf_query(self, query, table_name=None):
+        """ Expand vrf query dict into a WHERE-clause.
+
+            If you need to prefix each column reference with a table
+            name, that can be supplied via the table_name argument.
+
+            The WHERE-clause is cached for other queries of the same shape.
+        """
+
+        return _query_cache.expand('vrf', query, table_name, _normalize_query,
+                                   self._compile_vrf_query,
+                                   self._cfg.getint('nipapd', 'query_cache_size'))
+
+    def _compile_vrf_query(self, query, table_name=None):
         """ Expand VRF query dict into a WHERE-clause.
 
             If you need to prefix each column reference with a table
@@ -1126,12 +2063,16 @@ class Nipap:
         else:
             col_prefix = table_name + "."
 
-        if isinstance(query['val1'], dict) and isinstance(query['val2'], dict):
+        if 'operands' in query:
+            # chain of AND or OR flattened by _optimize_query
+            where, opt = self._compile_operands(query, self._compile_vrf_query, table_name)
+
+        elif isinstance(query['val1'], dict) and isinstance(query['val2'], dict):
             # Sub expression, recurse! This is used for boolean operators: AND OR
             # add parantheses
 
-            sub_where1, opt1 = self._expand_vrf_query(query['val1'], table_name)
-            sub_where2, opt2 = self._expand_vrf_query(query['val2'], table_name)
+            sub_where1, opt1 = self._compile_vrf_query(query['val1'], table_name)
+            sub_where2, opt2 = self._compile_vrf_query(query['val2'], table_name)
             try:
                 where += " ({} {} {}) ".format(sub_where1, _operation_map[query['operator']], sub_where2)
             except KeyError:
@@ -1154,14 +2095,17 @@ class Nipap:
                 raise NipapNoSuchOperatorError("No such operator {}".format(query['operator']))
 
             # workaround for handling equal matches of NULL-values
-            if query['operator'] == 'equals' and query['val2'] is None:
-                query['operator'] = 'is'
-            elif query['operator'] == 'not_equals' and query['val2'] is None:
-                query['operator'] = 'is_not'
+            _normalize_query(query)
 
             if query['operator'] in ('equals_any',):
                 where = " %%s = ANY (%s%s::citext[]) " % (col_prefix, _vrf_spec[query['val1']]['column'])
 
+            elif query['operator'] in ('in',):
+                # lists are turned into tuples by _normalize_query
+                if not isinstance(query['val2'], tuple):
+                    raise NipapValueError("Operator 'in' requires a list")
+                where = " %s%s IN %%s " % (col_prefix, _vrf_spec[query['val1']]['column'])
+
             else:
                 where = " %s%s %s %%s " % (col_prefix, _vrf_spec[query['val1']]['column'],
                                            _operation_map[query['operator']])
@@ -1172,6 +2116,7 @@ class Nipap:
 
     @create_span
     @requires_rw
+    @requires_db_connection
     def add_vrf(self, auth, attr):
         """ Add a new VRF.
 
@@ -1215,12 +2160,13 @@ class Nipap:
         }
 
         sql, params = self._sql_expand_insert(audit_params)
-        self._execute('INSERT INTO ip_net_log ' + sql, params)
+        self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
         return vrf
 
     @create_span
     @requires_rw
+    @requires_db_connection
     def remove_vrf(self, auth, spec):
         """ Remove a VRF.
 
@@ -1231,6 +2177,11 @@ class Nipap:
 
             Remove VRF matching the `spec` argument.
 
+            All prefixes in the VRF are removed along with it. This bypasses
+            the per-prefix maintenance of the prefix tree and only resets the
+            statistics of the pools that had members in the VRF. A single
+            entry summarizing the removal is written to the audit log.
+
             This is the documentation of the internal backend function. It's
             exposed over XML-RPC, please also see the XML-RPC documentation for
             :py:func:`nipap.xmlrpc.NipapXMLRPC.remove_vrf` for full
@@ -1239,36 +2190,39 @@ class Nipap:
 
         self._logger.debug("remove_vrf called; spec: %s", spec)
 
-        # get list of VRFs to remove before removing them
-        vrfs = self.list_vrf(auth, spec)
-
-        # remove prefixes in VRFs
-        for vrf in vrfs:
-            v4spec = {'prefix': '0.0.0.0/0', 'vrf_id': vrf['id']}
-            v6spec = {'prefix': '::/0', 'vrf_id': vrf['id']}
-            self.remove_prefix(auth, spec=v4spec, recursive=True)
-            self.remove_prefix(auth, spec=v6spec, recursive=True)
+        with self._transaction():
+            # get list of VRFs to remove before removing them
+            vrfs = self.list_vrf(auth, spec)
 
-        where, params = self._expand_vrf_spec(spec)
-        sql = "DELETE FROM ip_net_vrf WHERE " + where
-        self._execute(sql, params)
+            # remove prefixes in VRFs
+            num_removed = {}
+            for vrf in vrfs:
+                num_removed[vrf['id']] = self._db_remove_vrf_prefixes(vrf['id'])
 
-        # write to audit table
-        for v in vrfs:
-            audit_params = {
-                'vrf_id': v['id'],
-                'vrf_rt': v['rt'],
-                'vrf_name': v['name'],
-                'username': auth.username,
-                'authenticated_as': auth.authenticated_as,
-                'full_name': auth.full_name,
-                'authoritative_source': auth.authoritative_source,
-                'description': 'Removed vrf %s' % v['rt']
-            }
-            sql, params = self._sql_expand_insert(audit_params)
-            self._execute('INSERT INTO ip_net_log ' + sql, params)
+            where, params = self._expand_vrf_spec(spec)
+            sql = "DELETE FROM ip_net_vrf WHERE " + where
+            self._execute(sql, params)
+
+            # write to audit table, one entry per VRF summarizing the prefixes
+            # removed along with it
+            audit_rows = []
+            for v in vrfs:
+                audit_rows.append({
+                    'vrf_id': v['id'],
+                    'vrf_rt': v['rt'],
+                    'vrf_name': v['name'],
+                    'username': auth.username,
+                    'authenticated_as': auth.authenticated_as,
+                    'full_name': auth.full_name,
+                    'authoritative_source': auth.authoritative_source,
+                    'description': 'Removed vrf %s with %d prefixes' % (v['rt'], num_removed[v['id']])
+                })
+            for start in range(0, len(audit_rows), 1000):
+                sql, params = self._sql_expand_insert_many(audit_rows[start:start + 1000])
+                self._execute('INSERT INTO ip_net_log ' + sql, params)
 
     @create_span
+    @requires_db_connection
     def list_vrf(self, auth, spec=None):
         """ Return a list of VRFs matching `spec`.
 
@@ -1299,17 +2253,21 @@ class Nipap:
         if len(params) > 0:
             sql += " WHERE " + where
 
-        sql += " ORDER BY vrf_rt_order(rt) NULLS FIRST"
+        sql += " ORDER BY rt_order NULLS FIRST"
 
-        self._execute(sql, params)
+        self._execute(sql, params, prepare='list_vrf')
 
         res = list()
         for row in self._curs_pg:
-            res.append(dict(row))
+            row = dict(row)
+            # the RT order is only there to sort on
+            del row['rt_order']
+            res.append(row)
 
         return res
 
     @create_span
+    @requires_db_connection
     def _get_vrf(self, auth, spec, prefix='vrf_'):
         """ Get a VRF based on prefix spec
 
@@ -1343,6 +2301,7 @@ class Nipap:
 
     @create_span
     @requires_rw
+    @requires_db_connection
     def edit_vrf(self, auth, spec, attr):
         """ Update VRFs matching `spec` with attributes `attr`.
 
@@ -1394,11 +2353,12 @@ class Nipap:
                 'description': 'Edited VRF %s attr: %s' % (v['rt'], attr)
             }
             sql, params = self._sql_expand_insert(audit_params)
-            self._execute('INSERT INTO ip_net_log ' + sql, params)
+            self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
         return updated_vrfs
 
     @create_span
+    @requires_db_connection
     def search_vrf(self, auth, query, search_options=None):
         """ Search VRF list for VRFs matching `query`.
 
@@ -1518,17 +2478,21 @@ class Nipap:
             where, opt = self._expand_vrf_query(query)
             sql += " WHERE " + where
 
-        sql += " ORDER BY vrf_rt_order(rt) NULLS FIRST LIMIT %s OFFSET %s" % (
+        sql += " ORDER BY rt_order NULLS FIRST LIMIT %s OFFSET %s" % (
             search_options['max_result'], search_options['offset'],)
         self._execute(sql, opt)
 
         result = list()
         for row in self._curs_pg:
-            result.append(dict(row))
+            row = dict(row)
+            # the RT order is only there to sort on
+            del row['rt_order']
+            result.append(row)
 
         return {'search_options': search_options, 'result': result}
 
     @create_span
+    @requires_db_connection
     def smart_search_vrf(self, auth, query_str, search_options=None, extra_query=None):
         """ Perform a smart search on VRF list.
 
@@ -1642,6 +2606,19 @@ class Nipap:
 
             If you need to prefix each column reference with a table
             name, that can be supplied via the table_name argument.
+
+            The WHERE-clause is cached for other queries of the same shape.
+        """
+
+        return _query_cache.expand('pool', query, table_name, _normalize_query,
+                                   self._compile_pool_query,
+                                   self._cfg.getint('nipapd', 'query_cache_size'))
+
+    def _compile_pool_query(self, query, table_name=None):
+        """ Compile pool query dict into a WHERE-clause.
+
+            If you need to prefix each column reference with a table
+            name, that can be supplied via the table_name argument.
         """
 
         where = ""
@@ -1653,12 +2630,16 @@ class Nipap:
         else:
             col_prefix = table_name + "."
 
-        if isinstance(query['val1'], dict) and isinstance(query['val2'], dict):
+        if 'operands' in query:
+            # chain of AND or OR flattened by _optimize_query
+            where, opt = self._compile_operands(query, self._compile_pool_query, table_name)
+
+        elif isinstance(query['val1'], dict) and isinstance(query['val2'], dict):
             # Sub expression, recurse! This is used for boolean operators: AND OR
             # add parantheses
 
-            sub_where1, opt1 = self._expand_pool_query(query['val1'], table_name)
-            sub_where2, opt2 = self._expand_pool_query(query['val2'], table_name)
+            sub_where1, opt1 = self._compile_pool_query(query['val1'], table_name)
+            sub_where2, opt2 = self._compile_pool_query(query['val2'], table_name)
             try:
                 where += " ({} {} {}) ".format(sub_where1, _operation_map[query['operator']], sub_where2)
             except KeyError:
@@ -1681,14 +2662,17 @@ class Nipap:
                 raise NipapNoSuchOperatorError("No such operator {}".format(query['operator']))
 
             # workaround for handling equal matches of NULL-values
-            if query['operator'] == 'equals' and query['val2'] is None:
-                query['operator'] = 'is'
-            elif query['operator'] == 'not_equals' and query['val2'] is None:
-                query['operator'] = 'is_not'
+            _normalize_query(query)
 
             if query['operator'] in ('equals_any',):
                 where = " %%s = ANY (%s%s::citext[]) " % (col_prefix, _pool_spec[query['val1']]['column'])
 
+            elif query['operator'] in ('in',):
+                # lists are turned into tuples by _normalize_query
+                if not isinstance(query['val2'], tuple):
+                    raise NipapValueError("Operator 'in' requires a list")
+                where = " %s%s IN %%s " % (col_prefix, _pool_spec[query['val1']]['column'])
+
             else:
                 where = " %s%s %s %%s " % (col_prefix, _pool_spec[query['val1']]['column'],
                                            _operation_map[query['operator']])
@@ -1699,6 +2683,7 @@ class Nipap:
 
     @create_span
     @requires_rw
+    @requires_db_connection
     def add_pool(self, auth, attr):
         """ Create a pool according to `attr`.
 
@@ -1739,12 +2724,13 @@ class Nipap:
             'description': 'Added pool ' + pool['name'] + ' with attr: ' + str(attr),
         }
         sql, params = self._sql_expand_insert(audit_params)
-        self._execute('INSERT INTO ip_net_log ' + sql, params)
+        self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
         return pool
 
     @create_span
     @requires_rw
+    @requires_db_connection
     def remove_pool(self, auth, spec):
         """ Remove a pool.
 
@@ -1781,9 +2767,10 @@ class Nipap:
             audit_params['description'] = 'Removed pool ' + p['name']
 
             sql, params = self._sql_expand_insert(audit_params)
-            self._execute('INSERT INTO ip_net_log ' + sql, params)
+            self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
     @create_span
+    @requires_db_connection
     def list_pool(self, auth, spec=None):
         """Return a list of pools.
 
@@ -1826,6 +2813,7 @@ class Nipap:
                         po.used_addresses_v6,
                         po.free_addresses_v4,
                         po.free_addresses_v6,
+                        po.allocation_strategy,
                         po.tags,
                         po.avps,
                         vrf.id AS vrf_id,
@@ -1844,7 +2832,7 @@ class Nipap:
 
         sql += " ORDER BY name"
 
-        self._execute(sql, params)
+        self._execute(sql, params, prepare='list_pool')
 
         res = list()
         for row in self._curs_pg:
@@ -1886,6 +2874,11 @@ class Nipap:
             except ValueError:
                 raise NipapValueError('Default IPv6 prefix length must be an integer between 1 and 128.')
 
+        # validate allocation strategy
+        if 'allocation_strategy' in attr:
+            if attr['allocation_strategy'] not in _allocation_strategies:
+                raise NipapValueError('Allocation strategy must be one of: ' + ', '.join(_allocation_strategies))
+
     def _get_pool(self, auth, spec):
         """ Get a pool.
 
@@ -1904,6 +2897,7 @@ class Nipap:
 
     @create_span
     @requires_rw
+    @requires_db_connection
     def edit_pool(self, auth, spec, attr):
         """ Update pool given by `spec` with attributes `attr`.
 
@@ -1954,11 +2948,12 @@ class Nipap:
             audit_params['description'] = 'Edited pool ' + p['name'] + ' attr: ' + str(attr)
 
             sql, params = self._sql_expand_insert(audit_params)
-            self._execute('INSERT INTO ip_net_log ' + sql, params)
+            self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
         return updated_pools
 
     @create_span
+    @requires_db_connection
     def search_pool(self, auth, query, search_options=None):
         """ Search pool list for pools matching `query`.
 
@@ -2091,6 +3086,7 @@ class Nipap:
                         po.used_addresses_v6,
                         po.free_addresses_v4,
                         po.free_addresses_v6,
+                        po.allocation_strategy,
                         po.tags,
                         po.avps,
                         vrf.id AS vrf_id,
@@ -2112,6 +3108,7 @@ class Nipap:
         return {'search_options': search_options, 'result': result}
 
     @create_span
+    @requires_db_connection
     def smart_search_pool(self, auth, query_str, search_options=None, extra_query=None):
         """ Perform a smart search on pool list.
 
@@ -2260,6 +3257,19 @@ class Nipap:
 
             If you need to prefix each column reference with a table
             name, that can be supplied via the table_name argument.
+
+            The WHERE-clause is cached for other queries of the same shape.
+        """
+
+        return _query_cache.expand('prefix', query, table_name, _normalize_prefix_query,
+                                   self._compile_prefix_query,
+                                   self._cfg.getint('nipapd', 'query_cache_size'))
+
+    def _compile_prefix_query(self, query, table_name=None):
+        """ Compile prefix query dict into a WHERE-clause.
+
+            If you need to prefix each column reference with a table
+            name, that can be supplied via the table_name argument.
         """
 
         where = ""
@@ -2271,6 +3281,10 @@ class Nipap:
         else:
             col_prefix = table_name + "."
 
+        if 'operands' in query:
+            # chain of AND or OR flattened by _optimize_query
+            return self._compile_operands(query, self._compile_prefix_query, table_name)
+
         if 'val1' not in query:
             raise NipapMissingInputError("'val1' must be specified")
         if 'val2' not in query:
@@ -2280,8 +3294,8 @@ class Nipap:
             # Sub expression, recurse! This is used for boolean operators: AND OR
             # add parenthesis
 
-            sub_where1, opt1 = self._expand_prefix_query(query['val1'], table_name)
-            sub_where2, opt2 = self._expand_prefix_query(query['val2'], table_name)
+            sub_where1, opt1 = self._compile_prefix_query(query['val1'], table_name)
+            sub_where2, opt2 = self._compile_prefix_query(query['val2'], table_name)
             try:
                 where += " ({} {} {}) ".format(sub_where1, _operation_map[query['operator']], sub_where2)
             except KeyError:
@@ -2303,14 +3317,9 @@ class Nipap:
             if query['operator'] not in _operation_map:
                 raise NipapNoSuchOperatorError("No such operator {}".format(query['operator']))
 
-            if query['val1'] == 'vrf_id' and query['val2'] is None:
-                query['val2'] = 0
-
-            # workaround for handling equal matches of NULL-values
-            if query['operator'] == 'equals' and query['val2'] is None:
-                query['operator'] = 'is'
-            elif query['operator'] == 'not_equals' and query['val2'] is None:
-                query['operator'] = 'is_not'
+            # default VRF and workaround for handling equal matches of
+            # NULL-values
+            _normalize_prefix_query(query)
 
             if query['operator'] in (
                     'contains',
@@ -2323,6 +3332,12 @@ class Nipap:
             elif query['operator'] in ('equals_any',):
                 where = " %s = ANY (" + col_prefix + _prefix_spec[query['val1']]['column'] + "::citext[]) "
 
+            elif query['operator'] in ('in',):
+                # lists are turned into tuples by _normalize_query
+                if not isinstance(query['val2'], tuple):
+                    raise NipapValueError("Operator 'in' requires a list")
+                where = ' ' + col_prefix + _prefix_spec[query['val1']]['column'] + " IN %s "
+
             elif query['operator'] in ('like', 'regex_match', 'regex_not_match'):
                 # we COALESCE column with '' to allow for example a regexp search on '.*' to match columns
                 # which are NULL in the database
@@ -2339,6 +3354,7 @@ class Nipap:
 
     @create_span
     @requires_rw
+    @requires_db_connection
     def add_prefix(self, auth, attr, args=None):
         """ Add a prefix and return its ID.
 
@@ -2373,6 +3389,15 @@ class Nipap:
                 documentation for the :func:`find_free_prefix` for a description of how
                 the `args` argument is to be formatted.
 
+            When allocating from a pool or a prefix, many prefixes can be
+            added at once by setting the key :attr:`count` in `args` to the
+            number of prefixes wanted, at most 1000. All prefixes get the
+            attributes in `attr`, which can be overridden per prefix by
+            setting :attr:`overrides` in `args` to a list with a dict of
+            attributes for each prefix. The prefixes are added in a single
+            transaction; if not all of them can be added, none are. A list
+            of dicts describing the added prefixes is returned.
+
             This is the documentation of the internal backend function. It's
             exposed over XML-RPC, please also see the XML-RPC documentation for
             :py:func:`nipap.xmlrpc.NipapXMLRPC.add_prefix` for full
@@ -2384,9 +3409,176 @@ class Nipap:
 
         self._logger.debug("add_prefix called; attr: %s; args: %s", attr, args)
 
-        # args defined?
-        if args is None:
-            args = {}
+        # allocation of many prefixes at once
+        if 'count' in args or 'overrides' in args:
+            return self._add_prefix_many(auth, attr, args)
+
+        # concurrent allocations from the same pool can be handled together
+        if 'from-pool' in args and self._con_pg.autocommit:
+            window = self._cfg.getint('nipapd', 'allocation_batch_window')
+            if window > 0:
+                return self._add_prefix_batched(auth, attr, args, window / 1000.0)
+
+        # finding a free prefix and inserting it has to be atomic, or
+        # concurrent allocations would end up with the same prefix
+        if 'from-pool' in args or 'from-prefix' in args:
+            with self._transaction():
+                return self._add_prefix(auth, attr, args)
+
+        return self._add_prefix(auth, attr, args)
+
+    def _lock_allocation(self, pool, vrf):
+        """ Wait for other allocations from a pool or VRF to finish
+
+            Allocations from the same pool, or VRF for allocations from a
+            prefix, are serialized by an advisory lock held until the
+            transaction finishes so that they don't find the same free prefix.
+        """
+
+        if pool is not None:
+            params = {'class': _lock_allocate_pool, 'id': pool['id']}
+        else:
+            params = {'class': _lock_allocate_vrf, 'id': vrf['id']}
+        self._execute("SELECT pg_advisory_xact_lock(%(class)s, %(id)s)", params)
+
+    def _add_prefix_many(self, auth, attr, args):
+        """ Add many prefixes from a pool or prefix, see :func:`add_prefix`.
+        """
+
+        if not isinstance(attr, dict):
+            raise NipapInputError("'attr' must be a dict")
+
+        overrides = args.get('overrides')
+        if overrides is not None:
+            if not isinstance(overrides, list) or not all(isinstance(o, dict) for o in overrides):
+                raise NipapInputError("'overrides' must be a list of dicts")
+            for override in overrides:
+                for key in ('vrf_id', 'vrf_rt', 'vrf_name', 'prefix'):
+                    if key in override:
+                        raise NipapExtraneousInputError("'{}' can not be overridden".format(key))
+
+        try:
+            count = int(args.get('count', len(overrides or [])))
+        except (TypeError, ValueError):
+            raise NipapValueError("count must be an integer")
+        if not 1 <= count <= 1000:
+            raise NipapValueError("count must be between 1 and 1000")
+        if overrides is not None and len(overrides) != count:
+            raise NipapValueError("count and the number of overrides differ")
+
+        if 'prefix' in attr or ('from-pool' in args) == ('from-prefix' in args):
+            raise NipapExtraneousInputError("'count' requires 'from-pool' or 'from-prefix'")
+
+        item_args = {k: v for k, v in args.items() if k not in ('count', 'overrides')}
+
+        with self._transaction():
+            if 'from-pool' in args:
+                pool = self._get_pool(auth, args['from-pool'])
+                vrf = {'id': pool['vrf_id']}
+            else:
+                pool = None
+                vrf = self._get_vrf(auth, attr)
+
+            self._lock_allocation(pool, vrf)
+            free = self.find_free_prefix(auth, vrf, dict(item_args, count=count))
+            if len(free) < count:
+                raise NipapNonExistentError("only {} of {} wanted free prefixes found".format(len(free), count))
+
+            prefixes = []
+            for index, free_prefix in enumerate(free):
+                item_attr = dict(attr)
+                if overrides is not None:
+                    item_attr.update(overrides[index])
+                prefixes.append(self._add_prefix(auth, item_attr, dict(item_args), free_prefix))
+
+        return prefixes
+
+    def _add_prefix_batched(self, auth, attr, args, window):
+        """ Add a prefix from a pool together with concurrent allocations
+
+            The first allocation for a pool, family and prefix length waits
+            `window` seconds for others to join it and then finds free
+            prefixes for all of them at once, see :func:`_add_prefix_batch`.
+        """
+
+        pool = self._get_pool(auth, args['from-pool'])
+        key = (pool['id'], str(args.get('family')), str(args.get('prefix_length')),
+               args.get('allocation_strategy'))
+        request = {'auth': auth, 'attr': attr, 'args': args}
+
+        with _allocation_batches_lock:
+            batch = _allocation_batches.get(key)
+            first = batch is None
+            if first:
+                batch = _allocation_batches[key] = _AllocationBatch()
+            batch.requests.append(request)
+
+        if first:
+            try:
+                # no connection is needed until the batch is complete
+                with self._without_db_connection():
+                    time.sleep(window)
+                    with _allocation_batches_lock:
+                        del _allocation_batches[key]
+
+                self._add_prefix_batch(pool, batch.requests)
+            except Exception as exc:
+                for req in batch.requests:
+                    if 'result' not in req and 'error' not in req:
+                        req['error'] = exc
+            finally:
+                batch.done.set()
+        else:
+            with self._without_db_connection():
+                batch.done.wait()
+
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def _add_prefix_batch(self, pool, requests):
+        """ Add prefixes for a batch of allocations from a pool
+
+            Free prefixes for all requests are found with one call to
+            :func:`find_free_prefix` and added in a single transaction. Each
+            request gets either a `result` or an `error`.
+        """
+
+        # find_free_prefix returns at most 1000 prefixes
+        for start in range(0, len(requests), 1000):
+            chunk = requests[start:start + 1000]
+            args = dict(chunk[0]['args'])
+            args['count'] = len(chunk)
+
+            try:
+                with self._transaction():
+                    self._lock_allocation(pool, None)
+                    free = self.find_free_prefix(chunk[0]['auth'], {'id': pool['vrf_id']}, args)
+
+                    for index, req in enumerate(chunk):
+                        if index >= len(free):
+                            req['error'] = NipapNonExistentError("no free prefix found")
+                            continue
+
+                        # a failing prefix must not affect the rest of the batch
+                        try:
+                            with self._savepoint():
+                                req['result'] = self._add_prefix(req['auth'], req['attr'], req['args'], free[index])
+                        except NipapError as exc:
+                            req['error'] = exc
+            except Exception as exc:
+                # the transaction was rolled back, so nothing in it was added
+                for req in chunk:
+                    req.pop('result', None)
+                    req['error'] = exc
+
+    def _add_prefix(self, auth, attr, args, free_prefix=None):
+        """ Add a prefix, see :func:`add_prefix`.
+
+            Allocations from a pool or prefix must be run in a transaction.
+            `free_prefix` is a prefix already found to be free by the caller
+            to use for an allocation, instead of looking for one.
+        """
 
         # attr must be a dict!
         if not isinstance(attr, dict):
@@ -2484,8 +3676,13 @@ class Nipap:
             # VRF fiddling
             ffp_vrf = self._get_vrf(auth, attr)
 
-            # get a new prefix
-            res = self.find_free_prefix(auth, ffp_vrf, args)
+            if free_prefix is not None:
+                res = [free_prefix]
+            else:
+                self._lock_allocation(from_pool if 'from-pool' in args else None, ffp_vrf)
+
+                # get a new prefix
+                res = self.find_free_prefix(auth, ffp_vrf, args)
             if res != []:
                 attr['prefix'] = res[0]
             else:
@@ -2508,6 +3705,14 @@ class Nipap:
         prefix_id = self._lastrowid()
         prefix = self.list_prefix(auth, {'id': prefix_id})[0]
 
+        # next-fit allocation from the pool continues after this prefix
+        if 'from-pool' in args and args.get('allocation_strategy', from_pool['allocation_strategy']) == 'next-fit':
+            if prefix['family'] == 4:
+                sql = "UPDATE ip_net_pool SET allocation_cursor_v4 = %(prefix)s WHERE id = %(pool_id)s"
+            else:
+                sql = "UPDATE ip_net_pool SET allocation_cursor_v6 = %(prefix)s WHERE id = %(pool_id)s"
+            self._execute(sql, {'prefix': prefix['prefix'], 'pool_id': from_pool['id']})
+
         # write to audit table
         audit_params = {
             'vrf_id': prefix['vrf_id'],
@@ -2522,7 +3727,7 @@ class Nipap:
             'description': 'Added prefix ' + prefix['prefix'] + ' with attr: ' + str(attr),
         }
         sql, params = self._sql_expand_insert(audit_params)
-        self._execute('INSERT INTO ip_net_log ' + sql, params)
+        self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
         if pool['id'] is not None:
             audit_params['pool_id'] = pool['id']
@@ -2531,12 +3736,478 @@ class Nipap:
                 'prefix'] + ' in VRF ' + str(prefix['vrf_rt'])
 
             sql, params = self._sql_expand_insert(audit_params)
-            self._execute('INSERT INTO ip_net_log ' + sql, params)
+            self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
         return prefix
 
     @create_span
     @requires_rw
+    @requires_db_connection
+    def add_prefixes(self, auth, attrs, options=None):
+        """ Add many prefixes in one transaction.
+
+            * `auth` [BaseAuth]
+                AAA options.
+            * `attrs` [list of prefix_attr]
+                Attributes of the prefixes to add, one dict per prefix.
+            * `options` [add_prefixes_options]
+                Options for the operation, see below.
+
+            Returns a dict with the keys `result`, a list of dicts describing
+            the prefixes which were added, and `errors`, a list of dicts with
+            the keys `index`, `error_code` and `message` describing the
+            prefixes which could not be added. `index` is the position of
+            the prefix in `attrs`.
+
+            All prefixes are validated before anything is written to the
+            database and are then added using as few queries as possible.
+            Only manually specified prefixes can be added, to allocate
+            prefixes from a pool or a prefix use :func:`add_prefix`.
+
+            The following options are available:
+
+            * :attr:`atomic` - If set to true, no prefixes are added if any of
+              them fails and the error is raised. Defaults to false, in which
+              case the remaining prefixes are added and the failures are
+              listed in `errors`.
+
+            This is the documentation of the internal backend function. It's
+            exposed over XML-RPC, please also see the XML-RPC documentation for
+            :py:func:`nipap.xmlrpc.NipapXMLRPC.add_prefixes` for full
+            understanding.
+        """
+
+        if options is None:
+            options = {}
+
+        self._logger.debug("add_prefixes called; %d prefixes; options: %s", len(attrs or []), options)
+
+        if not isinstance(attrs, list):
+            raise NipapInputError("'attrs' must be a list")
+
+        if not isinstance(options, dict):
+            raise NipapInputError("'options' must be a dict")
+
+        for key in options:
+            if key not in ('atomic',):
+                raise NipapInputError("Invalid option '{}'".format(key))
+
+        atomic = options.get('atomic', False)
+        if atomic not in (True, False):
+            raise NipapValueError("Invalid value for option 'atomic'. Only true and false is allowed.")
+
+        # validate all prefixes up front, caching VRF and pool lookups as
+        # many prefixes are likely to share them
+        rows = []
+        errors = []
+        vrfs = {}
+        pools = {}
+        for index, attr in enumerate(attrs):
+            try:
+                rows.append((index,) + self._prepare_prefix_attr(auth, attr, vrfs, pools))
+            except NipapError as exc:
+                if atomic:
+                    raise exc.__class__("Prefix {}: {}".format(index, exc))
+                errors.append({'index': index, 'error_code': exc.error_code, 'message': str(exc)})
+
+        added = []
+        with self._transaction():
+            # insert parents before their children and in chunks to keep
+            # the size of the queries reasonable
+            for level in _nesting_levels(rows):
+                for start in range(0, len(level), 1000):
+                    chunk = level[start:start + 1000]
+                    if atomic:
+                        ids = self._db_insert_prefixes([row[1] for row in chunk])
+                    else:
+                        try:
+                            with self._savepoint():
+                                ids = self._db_insert_prefixes([row[1] for row in chunk])
+                        except NipapError:
+                            ids = None
+
+                    if ids is None:
+                        # find the failing prefixes by adding them one by one
+                        ids = []
+                        for index, attr, pool in chunk:
+                            try:
+                                with self._savepoint():
+                                    ids += self._db_insert_prefixes([attr])
+                            except NipapError as exc:
+                                ids.append(None)
+                                errors.append({'index': index, 'error_code': exc.error_code, 'message': str(exc)})
+
+                    for row, prefix_id in zip(chunk, ids):
+                        if prefix_id is not None:
+                            added.append((row, prefix_id))
+            added.sort(key=lambda added_row: added_row[0][0])
+
+            prefixes = {}
+            if len(added) > 0:
+                for prefix in self._db_list_prefix('inp.id = ANY(%(ids)s)',
+                                                   {'ids': [prefix_id for row, prefix_id in added]}):
+                    prefixes[prefix['id']] = prefix
+
+            # write to audit table
+            audit_rows = []
+            for (index, attr, pool), prefix_id in added:
+                prefix = prefixes[prefix_id]
+                audit_params = {
+                    'vrf_id': prefix['vrf_id'],
+                    'vrf_rt': prefix['vrf_rt'],
+                    'vrf_name': prefix['vrf_name'],
+                    'prefix_id': prefix['id'],
+                    'prefix_prefix': prefix['prefix'],
+                    'username': auth.username,
+                    'authenticated_as': auth.authenticated_as,
+                    'full_name': auth.full_name,
+                    'authoritative_source': auth.authoritative_source,
+                    'description': 'Added prefix ' + prefix['prefix'] + ' with attr: ' + str(attr),
+                }
+                audit_rows.append(audit_params)
+
+                if pool['id'] is not None:
+                    audit_params = audit_params.copy()
+                    audit_params['pool_id'] = pool['id']
+                    audit_params['pool_name'] = pool['name']
+                    audit_params['description'] = 'Pool ' + pool['name'] + ' expanded with prefix ' + prefix[
+                        'prefix'] + ' in VRF ' + str(prefix['vrf_rt'])
+                    audit_rows.append(audit_params)
+
+            for start in range(0, len(audit_rows), 1000):
+                sql, params = self._sql_expand_insert_many(audit_rows[start:start + 1000])
+                self._execute('INSERT INTO ip_net_log ' + sql, params)
+
+        errors.sort(key=lambda error: error['index'])
+
+        return {
+            'result': [prefixes[prefix_id] for row, prefix_id in added],
+            'errors': errors
+        }
+
+    def _prepare_prefix_attr(self, auth, attr, vrfs, pools):
+        """ Validate and complete attributes of a manually specified prefix
+
+            Returns a tuple with the attributes to insert and the pool the
+            prefix is to be part of. `vrfs` and `pools` are dicts used to
+            cache VRF and pool lookups between calls.
+        """
+
+        if not isinstance(attr, dict):
+            raise NipapInputError("invalid input type, must be dict")
+        attr = attr.copy()
+
+        if 'prefix' not in attr:
+            raise NipapMissingInputError("missing attribute prefix")
+
+        # handle pool attributes - find correct one and remove bad pool keys
+        pool = {'id': None, 'name': None}
+        for key in ('id', 'name'):
+            if 'pool_' + key not in attr:
+                continue
+
+            value = attr['pool_' + key]
+            if value is not None:
+                cache_key = (key, repr(value))
+                if cache_key not in pools:
+                    pools[cache_key] = self._get_pool(auth, {key: value})
+                pool = pools[cache_key]
+
+            attr.pop('pool_name', None)
+            attr['pool_id'] = pool['id']
+            break
+
+        attr['authoritative_source'] = auth.authoritative_source
+
+        # handle VRF - find the correct one and remove bad VRF keys
+        cache_key = ('id', repr(0))
+        for key in ('id', 'rt', 'name'):
+            if 'vrf_' + key in attr:
+                cache_key = (key, repr(attr['vrf_' + key]))
+                break
+        if cache_key not in vrfs:
+            vrfs[cache_key] = self._get_vrf(auth, attr)
+        attr.pop('vrf_rt', None)
+        attr.pop('vrf_name', None)
+        attr['vrf_id'] = vrfs[cache_key]['id']
+
+        # do we have all attributes?
+        self._check_attr(attr, ['prefix', 'authoritative_source'], _prefix_attrs)
+        if ('description' not in attr) and ('node' not in attr):
+            raise NipapMissingInputError('Either description or node must be specified.')
+
+        if 'expires' in attr:
+            attr['expires'] = _parse_expires(attr['expires'])
+
+        return attr, pool
+
+    def _db_insert_prefixes(self, attrs):
+        """ Insert prefixes and return their IDs, in the same order
+        """
+
+        insert, params = self._sql_expand_insert_many(attrs)
+        self._execute("INSERT INTO ip_net_plan " + insert + " RETURNING id", params)
+
+        return [row['id'] for row in self._curs_pg]
+
+    @create_span
+    @requires_rw
+    @requires_db_connection
+    def bulk_load_prefixes(self, auth, csv_file):
+        """ Load prefixes in bulk from a CSV file.
+
+            * `auth` [BaseAuth]
+                AAA options.
+            * `csv_file` [file]
+                Open text file with the prefixes to load.
+
+            Returns the number of prefixes loaded.
+
+            Meant for importing large address plans. Rather than adding the
+            prefixes one by one, with the triggers maintaining the prefix tree
+            and statistics for each of them, the triggers are disabled and the
+            prefixes are copied into the database at once. The prefix tree and
+            statistics of the affected VRFs and pools are then rebuilt in a
+            few statements by the database function rebuild_prefix_stats,
+            which also performs the sanity checks of the triggers. Nothing is
+            loaded if any of the prefixes fails. Other changes to prefixes
+            have to wait for the load to finish.
+
+            The first line of the file names the prefix attribute held by each
+            column. `prefix`, `type` and one of `description` and `node` are
+            required. The VRF is given by one of the columns `vrf_id`,
+            `vrf_rt` and `vrf_name`, where an empty value is the default VRF,
+            and the pool by `pool_id` or `pool_name`. Values are given as
+            PostgreSQL expects them, so tags are written as '{tag1,tag2}' and
+            AVPs as 'key1=>value1,key2=>value2'. Empty values are set to the
+            default value of the attribute.
+        """
+
+        self._logger.debug("bulk_load_prefixes called")
+
+        header = next(csv.reader([csv_file.readline()]), [])
+        columns = [column.strip() for column in header]
+
+        vrf_keys = [key for key in ('vrf_id', 'vrf_rt', 'vrf_name') if key in columns]
+        pool_keys = [key for key in ('pool_id', 'pool_name') if key in columns]
+        for column in columns:
+            if column not in _prefix_attrs and column not in ('vrf_rt', 'vrf_name', 'pool_name') \
+                    or column == 'authoritative_source':
+                raise NipapExtraneousInputError("extraneous attribute {}".format(column))
+            if columns.count(column) > 1:
+                raise NipapInputError("attribute {} given more than once".format(column))
+        for key in ('prefix', 'type'):
+            if key not in columns:
+                raise NipapMissingInputError("missing attribute {}".format(key))
+        if 'description' not in columns and 'node' not in columns:
+            raise NipapMissingInputError('Either description or node must be specified.')
+        if len(vrf_keys) > 1 or len(pool_keys) > 1:
+            raise NipapInputError("only one of {} may be given".format(', '.join(vrf_keys if len(vrf_keys) > 1 else pool_keys)))
+
+        # the VRF and pool are looked up by the given column
+        vrf_match = {
+            'vrf_id': 'vrf.id = COALESCE(s.vrf_id::integer, 0)',
+            'vrf_rt': 'vrf.rt IS NOT DISTINCT FROM s.vrf_rt',
+            'vrf_name': 'CASE WHEN s.vrf_name IS NULL THEN vrf.id = 0 ELSE vrf.name = s.vrf_name END',
+        }
+        pool_match = {
+            'pool_id': 'pool.id = s.pool_id::integer',
+            'pool_name': 'pool.name = s.pool_name',
+        }
+
+        with self._transaction():
+            # the values are copied as text into a temporary table and cast
+            # to the type of the columns of ip_net_plan when inserted
+            self._execute("CREATE TEMPORARY TABLE bulk_load_prefix (" +
+                          ", ".join(column + " text" for column in columns) +
+                          ") ON COMMIT DROP")
+            try:
+                self._curs_pg.copy_expert("COPY bulk_load_prefix (" + ", ".join(columns) +
+                                          ") FROM STDIN WITH (FORMAT csv)", csv_file)
+            except psycopg2.DataError as exc:
+                raise NipapInputError("Invalid CSV file: {}".format(str(exc).splitlines()[0]))
+
+            # all VRFs and pools must exist, where an empty VRF is the
+            # default VRF and an empty pool is no pool
+            if len(vrf_keys) > 0:
+                self._execute("SELECT s.{0} AS value FROM bulk_load_prefix AS s "
+                              "LEFT JOIN ip_net_vrf AS vrf ON ({1}) "
+                              "WHERE vrf.id IS NULL LIMIT 1".format(vrf_keys[0], vrf_match[vrf_keys[0]]))
+                for row in self._curs_pg:
+                    raise NipapNonExistentError("No VRF with {} '{}' found.".format(vrf_keys[0], row['value']))
+            if len(pool_keys) > 0:
+                self._execute("SELECT s.{0} AS value FROM bulk_load_prefix AS s "
+                              "LEFT JOIN ip_net_pool AS pool ON ({1}) "
+                              "WHERE s.{0} IS NOT NULL AND pool.id IS NULL LIMIT 1".format(pool_keys[0], pool_match[pool_keys[0]]))
+                for row in self._curs_pg:
+                    raise NipapNonExistentError("No pool with {} '{}' found.".format(pool_keys[0], row['value']))
+
+            self._execute("""SELECT attname, format_type(atttypid, atttypmod) AS type,
+                                pg_get_expr(adbin, adrelid) AS default_value
+                            FROM pg_attribute
+                                LEFT JOIN pg_attrdef ON (adrelid = attrelid AND adnum = attnum)
+                            WHERE attrelid = 'ip_net_plan'::regclass
+                                AND attnum > 0
+                                AND NOT attisdropped""")
+            types = {}
+            for row in self._curs_pg:
+                types[row['attname']] = (row['type'], row['default_value'])
+
+            insert = ['vrf_id', 'authoritative_source']
+            select = ['vrf.id', '%(authoritative_source)s']
+            if len(pool_keys) > 0:
+                insert.append('pool_id')
+                select.append('pool.id')
+            for column in columns:
+                if column in ('vrf_id', 'vrf_rt', 'vrf_name', 'pool_id', 'pool_name'):
+                    continue
+                col_type, default = types[column]
+                value = 's.{}::{}'.format(column, col_type)
+                if column == 'country':
+                    value = 'upper({})'.format(value)
+                if default is not None:
+                    value = 'COALESCE({}, {})'.format(value, default)
+                insert.append(column)
+                select.append(value)
+
+            sql = ("WITH loaded AS (INSERT INTO ip_net_plan (" + ", ".join(insert) + ") SELECT " + ", ".join(select) +
+                   " FROM bulk_load_prefix AS s JOIN ip_net_vrf AS vrf ON (" +
+                   (vrf_match[vrf_keys[0]] if len(vrf_keys) > 0 else "vrf.id = 0") + ")")
+            if len(pool_keys) > 0:
+                sql += " LEFT JOIN ip_net_pool AS pool ON (" + pool_match[pool_keys[0]] + ")"
+            sql += " RETURNING vrf_id) SELECT vrf_id, COUNT(1) AS prefixes FROM loaded GROUP BY vrf_id"
+
+            self._execute("SELECT disable_prefix_triggers() AS triggers")
+            triggers = self._curs_pg.fetchone()['triggers']
+
+            self._execute(sql, {'authoritative_source': auth.authoritative_source})
+            loaded = {}
+            for row in self._curs_pg:
+                loaded[row['vrf_id']] = row['prefixes']
+
+            # the planner needs to know about the new prefixes to rebuild
+            # them efficiently
+            self._execute("ANALYZE ip_net_plan")
+
+            for vrf_id in sorted(loaded):
+                self._execute("SELECT rebuild_prefix_stats(%(vrf_id)s)", {'vrf_id': vrf_id})
+
+            self._execute("SELECT enable_prefix_triggers(%(triggers)s)", {'triggers': triggers})
+
+            # write to audit table, one entry per VRF
+            for vrf_id in sorted(loaded):
+                vrf = self._get_vrf(auth, {'vrf_id': vrf_id})
+                audit_params = {
+                    'vrf_id': vrf['id'],
+                    'vrf_rt': vrf['rt'],
+                    'vrf_name': vrf['name'],
+                    'username': auth.username,
+                    'authenticated_as': auth.authenticated_as,
+                    'full_name': auth.full_name,
+                    'authoritative_source': auth.authoritative_source,
+                    'description': 'Bulk loaded {} prefixes in VRF {}'.format(loaded[vrf_id], vrf['rt']),
+                }
+                sql, params = self._sql_expand_insert(audit_params)
+                self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
+
+        return sum(loaded.values())
+
+    def _db_verify_stats(self, vrf_id):
+        """ Do the underlying database query to verify the statistics of a VRF
+        """
+
+        self._execute("SELECT * FROM verify_prefix_stats(%(vrf_id)s) ORDER BY table_name, id, attribute",
+                      {'vrf_id': vrf_id})
+
+        return [dict(row) for row in self._curs_pg]
+
+    @create_span
+    @requires_db_connection
+    def verify_stats(self, auth, spec=None):
+        """ Find values maintained by the triggers which are off.
+
+            * `auth` [BaseAuth]
+                AAA options.
+            * `spec` [vrf_spec]
+                Specifies the VRFs to verify, all VRFs if omitted.
+
+            Returns a list of dicts, one for each value which is off, with
+            the keys `vrf_id`, `vrf_rt`, `table_name`, `id`, `attribute`,
+            `stored` and `expected`, where `stored` and `expected` are the
+            value found in the database and the value it should have, as text.
+
+            The prefix tree, the prefix statistics and the free ranges are
+            calculated from the prefixes alone, while the VRF and pool
+            statistics are calculated from the stored prefix statistics. Only
+            the database is read, so several VRFs can be verified in parallel.
+        """
+
+        self._logger.debug("verify_stats called; spec: %s", spec)
+
+        res = []
+        for v in self.list_vrf(auth, spec):
+            for row in self._db_verify_stats(v['id']):
+                row['vrf_id'] = v['id']
+                row['vrf_rt'] = v['rt']
+                res.append(row)
+
+        return res
+
+    @create_span
+    @requires_rw
+    @requires_db_connection
+    def rebuild_stats(self, auth, spec=None):
+        """ Rebuild values maintained by the triggers which are off.
+
+            * `auth` [BaseAuth]
+                AAA options.
+            * `spec` [vrf_spec]
+                Specifies the VRFs to rebuild, all VRFs if omitted.
+
+            Returns the values which were off, as returned by
+            :func:`verify_stats`.
+
+            Each VRF with values which are off is rebuilt in a transaction of
+            its own by the database function rebuild_prefix_stats, which only
+            locks the rows of the VRF and its pools. Several VRFs can thereby
+            be rebuilt in parallel and changes to prefixes in other VRFs don't
+            have to wait for the rebuild to finish.
+        """
+
+        self._logger.debug("rebuild_stats called; spec: %s", spec)
+
+        res = []
+        for v in self.list_vrf(auth, spec):
+            with self._transaction():
+                drift = self._db_verify_stats(v['id'])
+                if len(drift) == 0:
+                    continue
+
+                self._execute("SELECT rebuild_prefix_stats(%(vrf_id)s)", {'vrf_id': v['id']})
+
+                audit_params = {
+                    'vrf_id': v['id'],
+                    'vrf_rt': v['rt'],
+                    'vrf_name': v['name'],
+                    'username': auth.username,
+                    'authenticated_as': auth.authenticated_as,
+                    'full_name': auth.full_name,
+                    'authoritative_source': auth.authoritative_source,
+                    'description': 'Rebuilt statistics of VRF {}, {} values were off'.format(v['rt'], len(drift)),
+                }
+                sql, params = self._sql_expand_insert(audit_params)
+                self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
+
+            for row in drift:
+                row['vrf_id'] = v['id']
+                row['vrf_rt'] = v['rt']
+                res.append(row)
+
+        return res
+
+    @create_span
+    @requires_rw
+    @requires_db_connection
     def edit_prefix(self, auth, spec, attr):
         """ Update prefix matching `spec` with attributes `attr`.
 
@@ -2624,7 +4295,7 @@ class Nipap:
             audit_params['prefix_prefix'] = p['prefix']
             audit_params['description'] = 'Edited prefix ' + p['prefix'] + ' attr: ' + str(attr)
             sql, params = self._sql_expand_insert(audit_params)
-            self._execute('INSERT INTO ip_net_log ' + sql, params)
+            self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
             # Only add to log if something was changed
             if p['pool_id'] != pool['id']:
@@ -2649,7 +4320,7 @@ class Nipap:
                     audit_params2['description'] = 'Expanded pool ' + pool['name'] + ' with prefix ' + p['prefix']
 
                     sql, params = self._sql_expand_insert(audit_params2)
-                    self._execute('INSERT INTO ip_net_log ' + sql, params)
+                    self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
                 # if prefix had pool set previously, prefix was removed from that pool
                 if p['pool_id'] is not None:
@@ -2661,11 +4332,12 @@ class Nipap:
                     audit_params2['description'] = 'Removed prefix ' + p['prefix'] + ' from pool ' + pool2['name']
 
                     sql, params = self._sql_expand_insert(audit_params2)
-                    self._execute('INSERT INTO ip_net_log ' + sql, params)
+                    self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
         return updated_prefixes
 
     @create_span
+    @requires_db_connection
     def find_free_prefix(self, auth, vrf, args):
         """ Finds free prefixes in the sources given in `args`.
 
@@ -2715,6 +4387,24 @@ class Nipap:
             how many prefixes that should be returned. If omitted, the default
             value is 1000.
 
+            The key :attr:`allocation_strategy` decides which of the free
+            prefixes are returned:
+
+            * :data:`first-fit` - The first free prefixes of the searched
+              prefixes.
+            * :data:`next-fit` - The first free prefixes after the prefix
+              last allocated from the pool, wrapping around to the start when
+              the end is reached. Sequential allocations thereby don't
+              rescan the used part of the pool.
+            * :data:`sparse` - Prefixes at the start of the largest free
+              blocks, spreading allocations out and leaving room for each of
+              them to grow.
+
+            It defaults to the allocation strategy of the pool when
+            allocating from a pool and to :data:`first-fit` otherwise. As
+            only pools keep track of the last allocated prefix, :data:`next-fit`
+            works like :data:`first-fit` when allocating from a prefix.
+
             The internal backend function :func:`find_free_prefix` is used
             internally by the :func:`add_prefix` function to find available
             prefixes from the given sources. It's also exposed over XML-RPC,
@@ -2736,6 +4426,10 @@ class Nipap:
         else:
             args['count'] = 1
 
+        if 'allocation_strategy' in args:
+            if args['allocation_strategy'] not in _allocation_strategies:
+                raise NipapValueError('Allocation strategy must be one of: ' + ', '.join(_allocation_strategies))
+
         if 'from-pool' in args:
             if 'from-prefix' in args:
                 raise NipapInputError("specify 'from-pool' OR 'from-prefix'")
@@ -2759,6 +4453,8 @@ class Nipap:
         # determine prefixes
         prefixes = []
         wpl = 0
+        strategy = args.get('allocation_strategy')
+        cursor = None
         if 'from-pool' in args:
             # extract prefixes from
             pool_result = self.list_pool(auth, args['from-pool'])
@@ -2776,6 +4472,13 @@ class Nipap:
                 else:
                     wpl = pool_result[0]['ipv6_default_prefix_length']
 
+            if strategy is None:
+                strategy = pool_result[0]['allocation_strategy']
+            if strategy == 'next-fit':
+                self._execute("SELECT allocation_cursor_v4, allocation_cursor_v6 FROM ip_net_pool WHERE id = %(id)s",
+                              {'id': pool_result[0]['id']})
+                cursor = self._curs_pg.fetchone()['allocation_cursor_v%d' % int(args['family'])]
+
         afi = None
         if 'from-prefix' in args:
             for prefix in args['from-prefix']:
@@ -2800,29 +4503,22 @@ class Nipap:
             if wpl < 0 or wpl > 128:
                 raise NipapValueError("the specified wanted prefix length argument must be between 0 and 128 for ipv6")
 
-        # build SQL
-        params = {}
-        # TODO: this makes me want to piss my pants
-        #       we should really write a patch to psycopg2 or something to
-        #       properly adapt a python list of texts with values looking
-        #       like prefixes to a postgresql array of inets
-        # UPDATE: This could actually be supported now, only I'm not comfortable messing with this
-        sql_prefix = ' UNION '.join('SELECT %(prefix' + str(prefixes.index(p)) + ')s AS prefix' for p in prefixes)
-        for p in prefixes:
-            params['prefix%s' % prefixes.index(p)] = p
-
-        damp = 'SELECT array_agg((prefix::text)::inet) FROM (' + sql_prefix + ') AS a'
-
-        sql = "SELECT * FROM find_free_prefix(%(vrf_id)s, (" + damp + "), %(prefix_length)s, %(max_result)s) AS prefix"
+        # build SQL, the prefixes are passed as an array of inets which keeps
+        # the statement the same whatever the number of prefixes
+        sql = ("SELECT * FROM find_free_prefix(%(vrf_id)s, %(prefixes)s::inet[], %(prefix_length)s, " +
+               "%(max_result)s, %(allocation_strategy)s, %(allocation_cursor)s) AS prefix")
 
         v = self._get_vrf(auth, vrf or {}, '')
 
+        params = {}
         params['vrf_id'] = v['id']
         params['prefixes'] = prefixes
         params['prefix_length'] = wpl
         params['max_result'] = args['count']
+        params['allocation_strategy'] = strategy or _allocation_strategies[0]
+        params['allocation_cursor'] = cursor
 
-        self._execute(sql, params)
+        self._execute(sql, params, prepare='find_free_prefix')
 
         res = list()
         for row in self._curs_pg:
@@ -2831,6 +4527,7 @@ class Nipap:
         return res
 
     @create_span
+    @requires_db_connection
     def list_prefix(self, auth, spec=None):
         """ List prefixes matching the `spec`.
 
@@ -2858,6 +4555,15 @@ class Nipap:
         else:
             raise NipapError("invalid prefix specification")
 
+        return self._db_list_prefix(where, params)
+
+    def _db_list_prefix(self, where, params):
+        """ Do the underlying database query to list prefixes
+
+            `where` is an SQL condition on the prefix table, aliased inp,
+            using `params`.
+        """
+
         if where != '':
             where = ' WHERE ' + where
 
@@ -2877,7 +4583,7 @@ class Nipap:
             pool.id AS pool_id,
             pool.name AS pool_name,
             inp.type,
-            inp.indent,
+            (SELECT COUNT(1) FROM ip_net_plan_ancestor WHERE prefix_id = inp.id) AS indent,
             inp.country,
             inp.order_id,
             inp.customer_id,
@@ -2888,18 +4594,19 @@ class Nipap:
             inp.vlan,
             inp.added,
             inp.last_modified,
-            inp.total_addresses,
-            inp.used_addresses,
-            inp.free_addresses,
+            stats.total_addresses,
+            stats.used_addresses,
+            stats.free_addresses,
             inp.status,
             inp.avps,
             inp.expires
             FROM ip_net_plan inp
             JOIN ip_net_vrf vrf ON (inp.vrf_id = vrf.id)
+            LEFT JOIN ip_net_plan_stats stats ON (stats.prefix_id = inp.id)
             LEFT JOIN ip_net_pool pool ON (inp.pool_id = pool.id) """ + where + """
-            ORDER BY vrf.rt NULLS FIRST, prefix"""
+            ORDER BY vrf.rt_order NULLS FIRST, prefix"""
 
-        self._execute(sql, params)
+        self._execute(sql, params, prepare='list_prefix')
 
         res = list()
         for row in self._curs_pg:
@@ -2924,8 +4631,30 @@ class Nipap:
         sql = "DELETE FROM ip_net_plan AS p WHERE " + where
         self._execute(sql, params)
 
+    def _db_remove_prefix_subtree(self, vrf_id, prefix):
+        """ Remove a prefix and all prefixes it covers in a VRF
+
+            The prefix tree is only fixed up at the parent of the subtree
+            instead of for every prefix removed, see the database function
+            remove_prefix_subtree. Returns the number of prefixes removed.
+        """
+        self._execute("SELECT remove_prefix_subtree(%(vrf_id)s, %(prefix)s) AS num_removed",
+                      {'vrf_id': vrf_id or 0, 'prefix': prefix})
+        return self._curs_pg.fetchone()['num_removed']
+
+    def _db_remove_vrf_prefixes(self, vrf_id):
+        """ Remove all prefixes in a VRF which is about to be removed
+
+            See the database function remove_vrf_prefixes. Returns the number
+            of prefixes removed.
+        """
+        self._execute("SELECT remove_vrf_prefixes(%(vrf_id)s) AS num_removed",
+                      {'vrf_id': vrf_id})
+        return self._curs_pg.fetchone()['num_removed']
+
     @create_span
     @requires_rw
+    @requires_db_connection
     def remove_prefix(self, auth, spec, recursive=False):
         """ Remove prefix matching `spec`.
 
@@ -2936,6 +4665,11 @@ class Nipap:
             * `recursive` [bool]
                 When set to True, also remove child prefixes.
 
+            When `recursive` is set and the prefix is specified by ID only, or
+            by prefix and VRF only, the prefix and all prefixes it covers are
+            removed with a single statement, which keeps removing large
+            subtrees fast.
+
             This is the documentation of the internal backend function. It's
             exposed over XML-RPC, please also see the XML-RPC documentation for
             :py:func:`nipap.xmlrpc.NipapXMLRPC.remove_prefix` for full
@@ -2956,55 +4690,64 @@ class Nipap:
         else:
             raise NipapMissingInputError('missing prefix or id of prefix')
 
-        prefixes = self.list_prefix(auth, spec)
-
-        if recursive:
-            # Hosts needs to be removed first
-            previous_type = spec.get('type')
-            spec['type'] = 'host'
-            self._db_remove_prefix(spec, recursive)
-            if previous_type:
-                spec['type'] = previous_type
+        with self._transaction():
+            prefixes = self.list_prefix(auth, spec)
+
+            if recursive and set(spec) == {'prefix', 'vrf_id'}:
+                # the whole subtree goes, so there is nothing left below the
+                # prefix to maintain the prefix tree for. As with the slow
+                # path, everything within the prefix is removed even if the
+                # prefix itself does not exist
+                self._db_remove_prefix_subtree(spec['vrf_id'], spec['prefix'])
+            elif recursive:
+                # Hosts needs to be removed first
+                previous_type = spec.get('type')
+                spec['type'] = 'host'
+                self._db_remove_prefix(spec, recursive)
+                if previous_type:
+                    spec['type'] = previous_type
+                else:
+                    del spec['type']
+                self._db_remove_prefix(spec, recursive)
             else:
-                del spec['type']
-            self._db_remove_prefix(spec, recursive)
-        else:
-            self._db_remove_prefix(spec)
-
-        # write to audit table
-        audit_params = {
-            'username': auth.username,
-            'authenticated_as': auth.authenticated_as,
-            'full_name': auth.full_name,
-            'authoritative_source': auth.authoritative_source
-        }
-        for p in prefixes:
-            audit_params['prefix_id'] = p['id']
-            audit_params['prefix_prefix'] = p['prefix']
-            audit_params['description'] = 'Removed prefix ' + p['prefix']
-            audit_params['vrf_id'] = p['vrf_id']
-            audit_params['vrf_rt'] = p['vrf_rt']
-            audit_params['vrf_name'] = p['vrf_name']
-            sql, params = self._sql_expand_insert(audit_params)
-            self._execute('INSERT INTO ip_net_log ' + sql, params)
+                self._db_remove_prefix(spec)
 
-            if p['pool_id'] is not None:
-                pool = self._get_pool(auth, {'id': p['pool_id']})
-                audit_params2 = {
-                    'pool_id': pool['id'],
-                    'pool_name': pool['name'],
+            # write to audit table
+            audit_rows = []
+            for p in prefixes:
+                audit_params = {
                     'prefix_id': p['id'],
                     'prefix_prefix': p['prefix'],
-                    'description': 'Prefix ' + p['prefix'] + ' removed from pool ' + pool['name'],
+                    'description': 'Removed prefix ' + p['prefix'],
+                    'vrf_id': p['vrf_id'],
+                    'vrf_rt': p['vrf_rt'],
+                    'vrf_name': p['vrf_name'],
                     'username': auth.username,
                     'authenticated_as': auth.authenticated_as,
                     'full_name': auth.full_name,
                     'authoritative_source': auth.authoritative_source
                 }
-                sql, params = self._sql_expand_insert(audit_params2)
+                audit_rows.append(audit_params)
+
+                if p['pool_id'] is not None:
+                    audit_rows.append({
+                        'pool_id': p['pool_id'],
+                        'pool_name': p['pool_name'],
+                        'prefix_id': p['id'],
+                        'prefix_prefix': p['prefix'],
+                        'description': 'Prefix ' + p['prefix'] + ' removed from pool ' + p['pool_name'],
+                        'username': auth.username,
+                        'authenticated_as': auth.authenticated_as,
+                        'full_name': auth.full_name,
+                        'authoritative_source': auth.authoritative_source
+                    })
+
+            for start in range(0, len(audit_rows), 1000):
+                sql, params = self._sql_expand_insert_many(audit_rows[start:start + 1000])
                 self._execute('INSERT INTO ip_net_log ' + sql, params)
 
     @create_span
+    @requires_db_connection
     def search_prefix(self, auth, query, search_options=None):
         """ Search prefix list for prefixes matching `query`.
 
@@ -3032,6 +4775,7 @@ class Nipap:
             * :data:`and` - Logical AND
             * :data:`or` - Logical OR
             * :data:`equals_any` - Equality of any element in array
+            * :data:`in` - Equality to any element in list
             * :data:`equals` - Equality; =
             * :data:`not_equals` - Inequality; !=
             * :data:`less` - Less than; <
@@ -3127,6 +4871,7 @@ class Nipap:
                 * :attr:`include_neighbors` - Include neighbors.
                 * :attr:`max_result` - The maximum number of prefixes to return (default :data:`50`).
                 * :attr:`offset` - Offset the result list this many prefixes (default :data:`0`).
+                * :attr:`after` - Only return prefixes sorting after the position given by this cursor.
 
             The options above gives the possibility to specify how many levels
             of parent and child prefixes to return in addition to the prefixes
@@ -3143,6 +4888,18 @@ class Nipap:
             useful for example when displaying prefixes in a tree without the
             need to implement client side IP address logic.
 
+            To page through a large result, pass the :attr:`next_cursor`
+            returned with the result as the :attr:`after` option in the
+            following search. Unlike :attr:`offset`, which requires the
+            database to produce and skip all preceding rows, the cursor lets it
+            seek directly to the start of the next page. :attr:`next_cursor` is
+            :data:`None` when there are no more prefixes to fetch. Each page
+            includes the parents of its matches as given by
+            :attr:`parents_depth` and :attr:`include_all_parents`, also the
+            ones sorting before the cursor, so a parent can be returned on
+            more than one page. They are not counted towards
+            :attr:`max_result`.
+
             This is the documentation of the internal backend function. It's
             exposed over XML-RPC, please also see the XML-RPC documentation for
             :py:func:`nipap.xmlrpc.NipapXMLRPC.search_prefix` for full
@@ -3234,177 +4991,231 @@ class Nipap:
             except IndexError:
                 raise NipapNonExistentError("Parent prefix {} can not be found".format(search_options['parent_prefix']))
 
+        # after
+        if 'after' not in search_options or search_options['after'] in (None, ''):
+            search_options['after'] = None
+        else:
+            after_rt_order, after_prefix = _decode_prefix_cursor(search_options['after'])
+
         self._logger.debug('search_prefix search_options: %s', search_options)
 
         # translate search options to SQL
 
+        # The search is done in stages. The matching prefixes are found first,
+        # ordered and limited on their own. The prefixes related to them, ie
+        # their parents, children and neighbors, are then looked up from the
+        # matches through ip_net_plan_ancestor and the parent of each prefix,
+        # every stage using an index of its own. The depth of a parent or
+        # child relative to a match m is the difference in their number of
+        # ancestors. A prefix related to several matches is returned once. Only
+        # the page to return is joined with the pool and statistics.
+        related = ["SELECT m.id, true FROM match AS m"]
+        parents = None
         if search_options['include_all_parents'] or search_options['parents_depth'] == -1:
-            where_parents = ''
-        elif search_options['parents_depth'] >= 0:
-            where_parents = 'AND p1.indent BETWEEN p2.indent - %d AND p1.indent' % search_options['parents_depth']
-        else:
+            parents = ("SELECT anc.ancestor_id, false FROM {match} AS m "
+                       "JOIN ip_net_plan_ancestor AS anc ON (anc.prefix_id = m.id)")
+        elif search_options['parents_depth'] > 0:
+            parents = ("SELECT anc.ancestor_id, false FROM {match} AS m "
+                       "JOIN ip_net_plan_ancestor AS anc ON (anc.prefix_id = m.id) "
+                       "WHERE (SELECT COUNT(1) FROM ip_net_plan_ancestor WHERE prefix_id = anc.ancestor_id) >= m.indent - %d"
+                       % search_options['parents_depth'])
+        elif search_options['parents_depth'] < 0:
             raise NipapValueError("Invalid value for option 'parents_depth'. Only integer values > -1 allowed.")
+        if parents is not None:
+            related.append(parents.format(match='match'))
 
         if search_options['include_all_children'] or search_options['children_depth'] == -1:
-            where_children = ''
-        elif search_options['children_depth'] >= 0:
-            where_children = 'AND p1.indent BETWEEN p2.indent AND p2.indent + %d' % search_options['children_depth']
-        else:
+            related.append("SELECT anc.prefix_id, false FROM match AS m "
+                           "JOIN ip_net_plan_ancestor AS anc ON (anc.ancestor_id = m.id)")
+        elif search_options['children_depth'] > 0:
+            related.append("SELECT anc.prefix_id, false FROM match AS m "
+                           "JOIN ip_net_plan_ancestor AS anc ON (anc.ancestor_id = m.id) "
+                           "WHERE (SELECT COUNT(1) FROM ip_net_plan_ancestor WHERE prefix_id = anc.prefix_id) <= m.indent + %d"
+                           % search_options['children_depth'])
+        elif search_options['children_depth'] < 0:
             raise NipapValueError("Invalid value for option 'children_depth'. Only integer values > -1 allowed.")
 
         if search_options['include_neighbors']:
-            include_neighbors = 'true'
-        else:
-            include_neighbors = 'false'
+            related.append("SELECT nb.id, false FROM match AS m "
+                           "JOIN ip_net_plan AS nb ON (nb.parent_id = m.parent_id "
+                           "AND iprange(nb.prefix) << iprange(m.display_prefix::cidr))")
 
+        # With a parent prefix, the parent prefix and its direct children are
+        # returned whether they are related to a match or not.
         if search_options['parent_prefix']:
-            vrf_id = 0
-            if parent_prefix['vrf_id']:
-                vrf_id = parent_prefix['vrf_id']
-            where_parent_prefix = " WHERE (p1.vrf_id = %s AND iprange(p1.prefix) <<= iprange('%s') AND " \
-                                  "p1.indent <= %s) " % (vrf_id, parent_prefix['prefix'], parent_prefix['indent'] + 1)
-            left_join = 'LEFT OUTER'
+            from_result = "ip_net_plan AS p1 LEFT JOIN result ON (result.id = p1.id)"
+            where_parent_prefix = " WHERE (p1.id = %d OR p1.parent_id = %d) " % (parent_prefix['id'], parent_prefix['id'])
         else:
+            from_result = "result JOIN ip_net_plan AS p1 ON (p1.id = result.id)"
             where_parent_prefix = ''
-            left_join = ''
+
+        where, opt = self._expand_prefix_query(query)
+
+        # Seek past the cursor given by 'after'. Prefixes are ordered on
+        # (VRF RT order, prefix), where the default VRF has no RT and thus
+        # sorts first. Apart from the matches sorting after the cursor, we
+        # also need the ones containing the cursor position as their children
+        # and neighbors can sort after it. Those are few and fetched
+        # separately so they don't count towards the LIMIT. The parents of
+        # the matches on the page can sort before the cursor, those are
+        # added to the page without counting towards the LIMIT either.
+        where_after_match = ''
+        match_containing = ''
+        where_after = ''
+        page_parents = ''
+        opt_after_match = []
+        opt_after = []
+        opt_page_parents = []
+        if search_options['after'] is not None:
+            if after_rt_order is None:
+                seek = "(vrf.rt_order IS NOT NULL OR {prefix} > %s::cidr)"
+                seek_opt = [after_prefix]
+            else:
+                seek = "((vrf.rt_order, {prefix}) > (%s, %s::cidr))"
+                seek_opt = [after_rt_order, after_prefix]
+
+            where_after_match = " AND " + seek.format(prefix='inp.prefix')
+            opt_after_match = list(seek_opt)
+
+            if search_options['include_neighbors']:
+                containing_col = 'inp.display_prefix::cidr'
+            else:
+                containing_col = 'inp.prefix'
+            match_containing = """
+            UNION
+            SELECT inp.id, inp.prefix, inp.parent_id, inp.display_prefix
+            FROM ip_net_plan AS inp
+                JOIN ip_net_vrf AS vrf ON (inp.vrf_id = vrf.id)
+                LEFT JOIN ip_net_pool AS pool ON (inp.pool_id = pool.id)
+            WHERE (""" + where + """) AND vrf.rt_order IS NOT DISTINCT FROM %s
+                AND iprange(""" + containing_col + """) >>= iprange(%s::cidr)"""
+            opt_after_match += opt + [after_rt_order, after_prefix]
+
+            where_after = seek.format(prefix='p1.prefix')
+            if where_parent_prefix == '':
+                where_after = " WHERE " + where_after
+            else:
+                where_after = " AND " + where_after
+            opt_after = seek_opt
+
+            if parents is not None:
+                page_parents = """
+    ), page_match AS (
+        SELECT page.id, (SELECT COUNT(1) FROM ip_net_plan_ancestor WHERE prefix_id = page.id) AS indent
+        FROM page
+        WHERE page.match
+    ), page_parent (id, match) AS (
+        """ + parents.format(match='page_match') + """
+    ), page_parent_before AS (
+        SELECT p1.id, vrf.rt_order, p1.prefix, result.display, result.match, false AS in_page
+        FROM """ + from_result + """
+            JOIN ip_net_vrf AS vrf ON (p1.vrf_id = vrf.id)
+        """ + (where_parent_prefix + " AND " if where_parent_prefix else " WHERE ") + """
+            p1.id IN (SELECT id FROM page_parent) AND NOT """ + seek.format(prefix='p1.prefix')
+                opt_page_parents = seek_opt
 
         if search_options['max_result'] is None:
-            limit_string = ""
+            limit_match = ""
+            limit_result = ""
         else:
-            limit_string = "LIMIT %d" % (search_options['max_result'] + search_options['offset'])
+            limit_match = "LIMIT %d" % (search_options['max_result'] + search_options['offset'])
+            limit_result = "LIMIT %d" % search_options['max_result']
 
-        display = '(p1.prefix << p2.display_prefix OR p2.prefix <<= p1.prefix %s) OR (p2.prefix >>= ' \
-                  'p1.prefix %s)' % (where_parents, where_children)
-
-        where, opt = self._expand_prefix_query(query)
         sql = """
-    SELECT
-        id,
-        vrf_id,
-        vrf_rt,
-        vrf_name,
-        family,
-        display,
-        match,
-        prefix,
-        prefix_length,
-        display_prefix::text AS display_prefix,
-        description,
-        comment,
-        inherited_tags,
-        tags,
-        node,
-        pool_id,
-        pool_name,
-        type,
-        status,
-        indent,
-        country,
-        order_id,
-        customer_id,
-        external_key,
-        authoritative_source,
-        alarm_priority,
-        monitor,
-        vlan,
-        added,
-        last_modified,
-        children,
-        total_addresses,
-        used_addresses,
-        free_addresses,
-        avps,
-        expires
-    FROM (
-        SELECT DISTINCT ON(vrf_rt_order(vrf.rt), p1.prefix) p1.id,
-            p1.prefix,
-            p1.display_prefix,
-            p1.description,
-            p1.comment,
-            COALESCE(p1.inherited_tags, '{}') AS inherited_tags,
-            COALESCE(p1.tags, '{}') AS tags,
-            p1.node,
-            pool.id AS pool_id,
-            pool.name AS pool_name,
-            p1.type,
-            p1.indent,
-            p1.country,
-            p1.order_id,
-            p1.customer_id,
-            p1.external_key,
-            p1.authoritative_source,
-            p1.alarm_priority,
-            p1.monitor,
-            p1.vlan,
-            p1.added,
-            p1.last_modified,
-            p1.children,
-            p1.total_addresses,
-            p1.used_addresses,
-            p1.free_addresses,
-            p1.status,
-            p1.avps,
-            p1.expires,
-            vrf.id AS vrf_id,
-            vrf.rt AS vrf_rt,
-            vrf.name AS vrf_name,
-            masklen(p1.prefix) AS prefix_length,
-            family(p1.prefix) AS family,
-            (""" + display + """) AS display,
-            CASE WHEN p1.prefix = p2.prefix THEN true ELSE false END AS match
-            FROM ip_net_plan AS p1
-            -- possible set LEFT OUTER JOIN, if we are doing a parent_prefix operation
-            """ + left_join + """ JOIN ip_net_plan AS p2 ON
-            (
-                (
-                    (p1.vrf_id = p2.vrf_id)
-                    AND
-                    (
-                        -- Join in the parents (p1) of matching prefixes (p2)
-                        (iprange(p1.prefix) >>= iprange(p2.prefix) """ + where_parents + """)
-                        OR
-                        -- Join in the children (p1) of matching prefixes (p2)
-                        (iprange(p1.prefix) << iprange(p2.prefix) """ + where_children + """)
-                        OR
-                        -- Join in all neighbors (p1) of matching prefixes (p2)
-                        (true = """ + include_neighbors + """ AND iprange(p1.prefix) << iprange(p2.display_prefix::cidr) AND p1.indent = p2.indent)
-                    )
-                )
-                -- set match conditions for p2
-                AND p2.id IN (
-                    SELECT inp.id FROM ip_net_plan AS inp JOIN ip_net_vrf AS vrf ON inp.vrf_id = vrf.id LEFT JOIN ip_net_pool AS pool ON inp.pool_id = pool.id
-                        WHERE """ + where + """
-                    ORDER BY vrf_rt_order(vrf.rt) NULLS FIRST, prefix
-                    """ + limit_string + """
-                )
-            )
+    WITH match AS (
+        SELECT m.*, (SELECT COUNT(1) FROM ip_net_plan_ancestor WHERE prefix_id = m.id) AS indent
+        FROM (
+            (SELECT inp.id, inp.prefix, inp.parent_id, inp.display_prefix
+            FROM ip_net_plan AS inp
+                JOIN ip_net_vrf AS vrf ON (inp.vrf_id = vrf.id)
+                LEFT JOIN ip_net_pool AS pool ON (inp.pool_id = pool.id)
+            WHERE (""" + where + ")" + where_after_match + """
+            ORDER BY vrf.rt_order NULLS FIRST, inp.prefix
+            """ + limit_match + ")" + match_containing + """
+        ) AS m
+    ), related (id, match) AS (
+        """ + "\n        UNION ALL\n        ".join(related) + """
+    ), result AS (
+        SELECT id, true AS display, bool_or(match) AS match
+        FROM related
+        GROUP BY id
+    ), page AS (
+        SELECT p1.id, vrf.rt_order, p1.prefix, result.display, result.match, true AS in_page
+        FROM """ + from_result + """
             JOIN ip_net_vrf AS vrf ON (p1.vrf_id = vrf.id)
-            LEFT JOIN ip_net_pool AS pool ON (p1.pool_id = pool.id)
-            -- possible set where conditions, if we are doing a parent_prefix operation
-            """ + where_parent_prefix + """
-            ORDER BY vrf_rt_order(vrf.rt) NULLS FIRST, p1.prefix, CASE WHEN p1.prefix = p2.prefix THEN 0 ELSE 1 END 
-            OFFSET """ + str(search_options['offset']) + ") AS a ORDER BY vrf_rt_order(vrf_rt) NULLS FIRST, prefix"
-
-        self._execute(sql, opt)
+        """ + where_parent_prefix + where_after + """
+        ORDER BY vrf.rt_order NULLS FIRST, p1.prefix
+        OFFSET """ + str(search_options['offset']) + """
+        """ + limit_result + page_parents + """
+    )
+    SELECT
+        p1.id,
+        vrf.id AS vrf_id,
+        vrf.rt AS vrf_rt,
+        vrf.name AS vrf_name,
+        vrf.rt_order AS vrf_rt_order,
+        page.in_page,
+        family(p1.prefix) AS family,
+        page.display,
+        COALESCE(page.match, false) AS match,
+        p1.prefix,
+        masklen(p1.prefix) AS prefix_length,
+        p1.display_prefix::text AS display_prefix,
+        p1.description,
+        p1.comment,
+        COALESCE(p1.inherited_tags, '{}') AS inherited_tags,
+        COALESCE(p1.tags, '{}') AS tags,
+        p1.node,
+        pool.id AS pool_id,
+        pool.name AS pool_name,
+        p1.type,
+        p1.status,
+        (SELECT COUNT(1) FROM ip_net_plan_ancestor WHERE prefix_id = p1.id) AS indent,
+        p1.country,
+        p1.order_id,
+        p1.customer_id,
+        p1.external_key,
+        p1.authoritative_source,
+        p1.alarm_priority,
+        p1.monitor,
+        p1.vlan,
+        p1.added,
+        p1.last_modified,
+        stats.children,
+        stats.total_addresses,
+        stats.used_addresses,
+        stats.free_addresses,
+        p1.avps,
+        p1.expires
+    FROM """ + ("(SELECT * FROM page UNION ALL SELECT * FROM page_parent_before) AS page"
+                if page_parents else "page") + """
+        JOIN ip_net_plan AS p1 ON (p1.id = page.id)
+        JOIN ip_net_vrf AS vrf ON (p1.vrf_id = vrf.id)
+        LEFT JOIN ip_net_pool AS pool ON (p1.pool_id = pool.id)
+        LEFT JOIN ip_net_plan_stats AS stats ON (stats.prefix_id = p1.id)
+    ORDER BY page.rt_order NULLS FIRST, page.prefix"""
+
+        self._execute(sql, opt + opt_after_match + opt_after + opt_page_parents)
 
         result = list()
+        rt_order = None
+        in_page = 0
         for row in self._curs_pg:
-            result.append(dict(row))
-            # This is a SQL LIMIT clause implemented in Python. It is performed
-            # here to avoid a silly planner missestimate in PostgreSQL. For too
-            # low values of LIMIT, the planner will prefer plans with very low
-            # startup costs which will in turn lead to the slow plan. We avoid
-            # the low value (or any value really) of LIMIT by performing the
-            # LIMIT in Python. There is still a LIMIT on the inner query which
-            # together with the OFFSET, which is still performed in PostgreSQL,
-            # yields a rather small result set and thus high speed.
-            if search_options['max_result'] not in (False, None):
-                if len(result) >= int(search_options['max_result']):
-                    break
+            row = dict(row)
+            rt_order = row.pop('vrf_rt_order')
+            if row.pop('in_page'):
+                in_page += 1
+            result.append(row)
 
-        return {'search_options': search_options, 'result': result}
+        # there may be more rows if the page is full, continue after the last
+        next_cursor = None
+        if search_options['max_result'] and in_page == search_options['max_result']:
+            next_cursor = _encode_prefix_cursor(rt_order, result[-1]['prefix'])
+
+        return {'search_options': search_options, 'result': result, 'next_cursor': next_cursor}
 
     @create_span
+    @requires_db_connection
     def smart_search_prefix(self, auth, query_str, search_options=None, extra_query=None):
         """ Perform a smart search on prefix list.
 
@@ -3418,10 +5229,11 @@ class Nipap:
                 Extra search terms, will be AND:ed together with what is
                 extracted from the query string.
 
-            Return a dict with three elements:
+            Return a dict with four elements:
                 * :attr:`interpretation` - How the query string was interpreted.
                 * :attr:`search_options` - Various search_options.
                 * :attr:`result` - The search result.
+                * :attr:`next_cursor` - Cursor for fetching the next page.
 
                 The :attr:`interpretation` is given as a list of dicts, each
                 explaining how a part of the search key was interpreted (ie. what
@@ -3458,6 +5270,7 @@ class Nipap:
                 'interpretation': query,
                 'search_options': search_options,
                 'result': [],
+                'next_cursor': None,
                 'error': True,
                 'error_message': 'query interpretation failed'
             }
@@ -3579,6 +5392,7 @@ class Nipap:
         return where, params
 
     @create_span
+    @requires_db_connection
     def list_asn(self, auth, asn=None):
         """ List AS numbers matching `spec`.
 
@@ -3620,6 +5434,7 @@ class Nipap:
 
     @create_span
     @requires_rw
+    @requires_db_connection
     def add_asn(self, auth, attr):
         """ Add AS number to NIPAP.
 
@@ -3659,12 +5474,13 @@ class Nipap:
         }
 
         sql, params = self._sql_expand_insert(audit_params)
-        self._execute('INSERT INTO ip_net_log ' + sql, params)
+        self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
         return asn
 
     @create_span
     @requires_rw
+    @requires_db_connection
     def edit_asn(self, auth, asn, attr):
         """ Edit AS number
 
@@ -3713,12 +5529,13 @@ class Nipap:
             }
 
             sql, params = self._sql_expand_insert(audit_params)
-            self._execute('INSERT INTO ip_net_log ' + sql, params)
+            self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
         return updated_asns
 
     @create_span
     @requires_rw
+    @requires_db_connection
     def remove_asn(self, auth, asn):
         """ Remove an AS number.
 
@@ -3755,9 +5572,10 @@ class Nipap:
                 'description': 'Removed ASN %s' % a['asn']
             }
             sql, params = self._sql_expand_insert(audit_params)
-            self._execute('INSERT INTO ip_net_log ' + sql, params)
+            self._execute('INSERT INTO ip_net_log ' + sql, params, prepare='audit')
 
     @create_span
+    @requires_db_connection
     def search_asn(self, auth, query, search_options=None):
         """ Search ASNs for entries matching 'query'
 
@@ -3856,6 +5674,7 @@ class Nipap:
         return {'search_options': search_options, 'result': result}
 
     @create_span
+    @requires_db_connection
     def smart_search_asn(self, auth, query_str, search_options=None, extra_query=None):
         """ Perform a smart search operation among AS numbers
 
@@ -4048,6 +5867,7 @@ class Nipap:
         return where, opt
 
     @create_span
+    @requires_db_connection
     def search_tag(self, auth, query, search_options=None):
         """ Search Tags for entries matching 'query'
 
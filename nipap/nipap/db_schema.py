@@ -8,33 +8,6 @@ functions = """
 -- SQL functions for NIPAP
 --
 
---
--- calc_indent is an internal function that calculates the correct indentation
--- for a prefix. It is called from a trigger function on the ip_net_plan table.
---
-CREATE OR REPLACE FUNCTION calc_indent(arg_vrf integer, arg_prefix inet, delta integer) RETURNS bool AS $_$
-DECLARE
-	r record;
-	current_indent integer;
-BEGIN
-	current_indent := (
-		SELECT COUNT(*)
-		FROM
-			(SELECT DISTINCT inp.prefix
-			FROM ip_net_plan inp
-			WHERE vrf_id = arg_vrf
-				AND iprange(prefix) >> iprange(arg_prefix::cidr)
-			) AS a
-		);
-
-	UPDATE ip_net_plan SET indent = current_indent WHERE vrf_id = arg_vrf AND prefix = arg_prefix;
-	UPDATE ip_net_plan SET indent = indent + delta WHERE vrf_id = arg_vrf AND iprange(prefix) << iprange(arg_prefix::cidr);
-
-	RETURN true;
-END;
-$_$ LANGUAGE plpgsql;
-
-
 --
 -- Remove duplicate elements from an array
 --
@@ -50,44 +23,50 @@ $_$ LANGUAGE SQL;
 
 
 --
--- calc_tags is an internal function that calculates the inherited_tags
--- from parent prefixes to its children. It is called from a trigger function
--- on the ip_net_plan table.
+-- calc_tags is an internal function that calculates the inherited_tags of all
+-- prefixes covered by a prefix, whether or not the prefix itself exists. It
+-- is called from a trigger function on the ip_net_plan table.
+--
+-- The inherited tags of a prefix are the tags of all of its ancestors, so the
+-- whole subtree is updated at once from ip_net_plan_ancestor instead of one
+-- level at a time through the triggers, and only the prefixes whose inherited
+-- tags actually change are written. The update sets nipap.calc_tags, which
+-- skips the triggers maintaining tags and statistics as inherited tags play no
+-- part in the statistics. The sanity checks of the update are still made.
 --
 CREATE OR REPLACE FUNCTION calc_tags(arg_vrf integer, arg_prefix inet) RETURNS bool AS $_$
 DECLARE
-	i_indent integer;
-	new_inherited_tags text[];
+	calc_tags text;
 BEGIN
-	-- TODO: why don't we take the prefix as argument? That way we could save
-	--		 in these selects fetching data from the table that we already have.
-	i_indent := (
-		SELECT indent+1
-		FROM ip_net_plan
-		WHERE vrf_id = arg_vrf
-			AND prefix = arg_prefix
-		);
-	-- set default if we don't have a parent prefix
-	IF i_indent IS NULL THEN
-		i_indent := 0;
-	END IF;
+	calc_tags := current_setting('nipap.calc_tags', true);
+	PERFORM set_config('nipap.calc_tags', 'on', true);
 
-	new_inherited_tags := (
-		SELECT array_undup(array_cat(inherited_tags, tags))
+	WITH subtree AS (
+		SELECT id, COALESCE(inherited_tags, '{}') AS inherited_tags
 		FROM ip_net_plan
 		WHERE vrf_id = arg_vrf
-			AND prefix = arg_prefix
-		);
-	-- set default if we don't have a parent prefix
-	IF new_inherited_tags IS NULL THEN
-		new_inherited_tags := '{}';
-	END IF;
-
-	-- TODO: we don't need to update if our old tags are the same as our new
-	-- TODO: we could add WHERE inherited_tags != new_inherited_tags which
-	--		 could potentially speed up this update considerably, especially
-	--		 with a GiN index on that column
-	UPDATE ip_net_plan SET inherited_tags = new_inherited_tags WHERE vrf_id = arg_vrf AND iprange(prefix) << iprange(arg_prefix::cidr) AND indent = i_indent;
+			AND iprange(prefix) << iprange(arg_prefix::cidr)
+	), new_tags AS (
+		SELECT subtree.id,
+			-- tags of the top level prefix first, each tag only once
+			COALESCE((SELECT array_agg(tag ORDER BY masklen, pos)
+				FROM (SELECT DISTINCT ON (tag) tag, masklen(anc.prefix) AS masklen, pos
+					FROM ip_net_plan_ancestor AS a
+						JOIN ip_net_plan AS anc ON (anc.id = a.ancestor_id)
+						CROSS JOIN unnest(anc.tags) WITH ORDINALITY AS t (tag, pos)
+					WHERE a.prefix_id = subtree.id
+					ORDER BY tag, masklen(anc.prefix), pos) AS anc_tag), '{}') AS inherited_tags
+		FROM subtree
+	)
+	UPDATE ip_net_plan AS inp
+	SET inherited_tags = new_tags.inherited_tags
+	FROM subtree
+		JOIN new_tags ON (new_tags.id = subtree.id)
+	WHERE inp.id = subtree.id
+		AND NOT (subtree.inherited_tags @> new_tags.inherited_tags
+			AND subtree.inherited_tags <@ new_tags.inherited_tags);
+
+	PERFORM set_config('nipap.calc_tags', COALESCE(calc_tags, 'off'), true);
 
 	RETURN true;
 END;
@@ -140,7 +119,7 @@ BEGIN
 	last_used := host(network(arg_prefix.prefix));
 
 	-- loop over direct childrens of arg_prefix
-	FOR current_prefix IN (SELECT * FROM ip_net_plan WHERE prefix <<= arg_prefix.prefix AND vrf_id = arg_prefix.vrf_id AND indent = arg_prefix.indent + 1 ORDER BY prefix ASC) LOOP
+	FOR current_prefix IN (SELECT * FROM ip_net_plan WHERE parent_id = arg_prefix.id ORDER BY prefix ASC) LOOP
 		-- if network address of current prefix is higher than the last used
 		-- address (typically the broadcast address of the previous network) it
 		-- means that this and the previous network are not adjacent, ie we
@@ -174,6 +153,87 @@ $_$ LANGUAGE plpgsql;
 
 
 
+--
+-- calc_free_ranges is an internal function that updates the free ranges of a
+-- prefix, as stored in ip_net_free_range, for the part of the prefix that is
+-- covered by arg_range. The range is widened to include the stored free
+-- ranges it overlaps or is adjacent to, which are then replaced by the free
+-- ranges between the direct children of the prefix. Ranges are thereby split
+-- when a child prefix is added and merged when one is removed. It is called
+-- from a trigger function on the ip_net_plan table.
+--
+CREATE OR REPLACE FUNCTION calc_free_ranges(arg_prefix_id integer, arg_range iprange) RETURNS bool AS $_$
+DECLARE
+	parent ip_net_plan;
+	r record;
+	max_prefix_len integer;
+	span_start ipaddress;
+	span_end ipaddress;
+	free_start ipaddress;
+BEGIN
+	SELECT * INTO parent FROM ip_net_plan WHERE id = arg_prefix_id;
+	-- the prefix might have been removed by the same statement
+	IF parent.id IS NULL THEN
+		RETURN false;
+	END IF;
+
+	IF family(parent.prefix) = 4 THEN
+		max_prefix_len := 32;
+	ELSE
+		max_prefix_len := 128;
+	END IF;
+
+	-- hosts can't hold any other prefixes
+	IF masklen(parent.prefix) = max_prefix_len THEN
+		RETURN true;
+	END IF;
+
+	span_start := lower(arg_range);
+	span_end := upper(arg_range);
+
+	-- remove overlapping and adjacent free ranges, widening the span to
+	-- cover them
+	FOR r IN DELETE FROM ip_net_free_range
+		WHERE prefix_id = parent.id
+			AND (free_range && arg_range
+				OR CASE WHEN upper(free_range) < lower(arg_range) THEN upper(free_range) + 1 = lower(arg_range) ELSE false END
+				OR CASE WHEN lower(free_range) > upper(arg_range) THEN lower(free_range) - 1 = upper(arg_range) ELSE false END)
+		RETURNING free_range LOOP
+		IF lower(r.free_range) < span_start THEN
+			span_start := lower(r.free_range);
+		END IF;
+		IF upper(r.free_range) > span_end THEN
+			span_end := upper(r.free_range);
+		END IF;
+	END LOOP;
+
+	-- and add the free ranges between the direct children within the span
+	free_start := span_start;
+	FOR r IN (SELECT lower(iprange(prefix)) AS first, upper(iprange(prefix)) AS last
+			FROM ip_net_plan
+			WHERE vrf_id = parent.vrf_id
+				AND iprange(prefix) << iprange(parent.prefix)
+				AND iprange(prefix) && iprange(span_start, span_end)
+				AND parent_id = parent.id
+			ORDER BY prefix) LOOP
+		IF r.first > free_start THEN
+			INSERT INTO ip_net_free_range (prefix_id, free_range) VALUES (parent.id, iprange(free_start, r.first - 1));
+		END IF;
+
+		IF r.last >= span_end THEN
+			RETURN true;
+		END IF;
+		free_start := r.last + 1;
+	END LOOP;
+
+	INSERT INTO ip_net_free_range (prefix_id, free_range) VALUES (parent.id, iprange(free_start, span_end));
+
+	RETURN true;
+END;
+$_$ LANGUAGE plpgsql;
+
+
+
 --
 -- Return aggregated CIDRs based on ip ranges.
 --
@@ -256,9 +316,37 @@ END;
 $_$ LANGUAGE plpgsql;
 
 
+--
+-- Count the number of prefixes of a certain size that fits in an IP range,
+-- which are the prefixes of that size that are aligned on their own size
+-- and lie entirely within the range. Where cidr_count() would count the
+-- smaller prefixes at the edges of a range as fractions of a prefix, they are
+-- not counted at all here, so the counts of ranges can be added up and
+-- subtracted as ranges are split and merged.
+--
+-- Example:
+--   SELECT iprange_count('1.0.0.4-1.0.1.255', 24);
+--    iprange_count
+--   ---------------
+--               1
+--
+CREATE OR REPLACE FUNCTION iprange_count(arg_range iprange, arg_prefix_length integer) RETURNS numeric(40) AS $_$
+	SELECT GREATEST(div(upper($1) - zero + 1, size) - div(lower($1) - zero + size - 1, size), 0)
+	FROM (
+		SELECT CASE WHEN family($1) = 4 THEN '0.0.0.0'::ipaddress ELSE '::'::ipaddress END AS zero,
+			power(2::numeric, CASE WHEN family($1) = 4 THEN 32 ELSE 128 END - $2) AS size
+		) AS block;
+$_$ LANGUAGE SQL IMMUTABLE;
+
+
+
 --
 -- Calculate number of free prefixes in a pool
 --
+-- The free prefixes of a pool add up the free prefixes of its members, see
+-- calc_prefix_free_prefixes(). The triggers keep them up to date as prefixes
+-- come and go, while this counts them from scratch.
+--
 CREATE OR REPLACE FUNCTION calc_pool_free_prefixes(arg_pool_id integer, arg_family integer, arg_new_prefix cidr DEFAULT NULL) RETURNS numeric(40) AS $_$
 DECLARE
 	pool ip_net_pool;
@@ -272,7 +360,6 @@ $_$ LANGUAGE plpgsql;
 CREATE OR REPLACE FUNCTION calc_pool_free_prefixes(arg_pool ip_net_pool, arg_family integer, arg_new_prefix cidr DEFAULT NULL) RETURNS numeric(40) AS $_$
 DECLARE
 	default_prefix_length integer;
-	prefix_ids integer[];
 BEGIN
 	IF arg_family = 4 THEN
 		default_prefix_length := arg_pool.ipv4_default_prefix_length;
@@ -287,17 +374,41 @@ BEGIN
 	END IF;
 
 	-- if we don't have any member prefixes, free prefixes will be NULL
-	prefix_ids := ARRAY((SELECT id FROM ip_net_plan WHERE pool_id = arg_pool.id AND family(prefix)=arg_family));
-	IF array_length(prefix_ids, 1) IS NULL THEN
-		RETURN NULL;
-	END IF;
-
-	RETURN cidr_count(ARRAY((SELECT iprange2cidr(ARRAY((SELECT find_free_ranges(prefix_ids)))))), default_prefix_length);
+	RETURN (SELECT SUM(calc_prefix_free_prefixes(id, default_prefix_length))
+		FROM ip_net_plan
+		WHERE pool_id = arg_pool.id
+			AND family(prefix) = arg_family);
 END;
 $_$ LANGUAGE plpgsql;
 
 
 
+--
+-- Calculate number of free prefixes of a certain size in a prefix, that is the
+-- prefixes of that size which fit in its free ranges. Without a prefix length
+-- the number is NULL, as it is for pools without a default prefix length.
+--
+-- The overloaded version without a prefix length uses the default prefix
+-- length of the pool the prefix is a member of, which is what the free
+-- prefixes of the prefix stored in ip_net_plan_stats are counted in.
+--
+CREATE OR REPLACE FUNCTION calc_prefix_free_prefixes(arg_prefix_id integer, arg_prefix_length integer) RETURNS numeric(40) AS $_$
+	SELECT CASE WHEN $2 IS NOT NULL THEN COALESCE(SUM(iprange_count(free_range, $2)), 0) END
+	FROM ip_net_free_range
+	WHERE prefix_id = $1;
+$_$ LANGUAGE SQL STABLE;
+
+
+CREATE OR REPLACE FUNCTION calc_prefix_free_prefixes(arg_prefix_id integer) RETURNS numeric(40) AS $_$
+	SELECT calc_prefix_free_prefixes(inp.id,
+		CASE WHEN family(inp.prefix) = 4 THEN pool.ipv4_default_prefix_length ELSE pool.ipv6_default_prefix_length END)
+	FROM ip_net_plan AS inp
+		LEFT JOIN ip_net_pool AS pool ON (pool.id = inp.pool_id)
+	WHERE inp.id = $1;
+$_$ LANGUAGE SQL STABLE;
+
+
+
 --
 -- Count the number of prefixes of a certain size that fits in the list of
 -- CIDRs
@@ -360,18 +471,57 @@ BEGIN
 END;
 $_$ LANGUAGE plpgsql;
 
--- full function
+-- default to first-fit if no allocation strategy is specified
 CREATE OR REPLACE FUNCTION find_free_prefix(arg_vrf integer, IN arg_prefixes inet[], arg_wanted_prefix_len integer, arg_count integer) RETURNS SETOF inet AS $_$
+BEGIN
+	RETURN QUERY SELECT * FROM find_free_prefix(arg_vrf, arg_prefixes, arg_wanted_prefix_len, arg_count, 'first-fit', NULL) AS prefix;
+END;
+$_$ LANGUAGE plpgsql;
+
+-- full function
+--
+-- Rather than probing every candidate of the wanted size, the used prefixes
+-- inside each search prefix are walked in order to find the free ranges
+-- between them. Aligned prefixes of the wanted size are then carved out of
+-- the free ranges. The work done is thus proportional to the number of used
+-- prefixes and not to the size of the search prefix. For search prefixes
+-- that exist in ip_net_plan the free ranges stored in ip_net_free_range are
+-- used directly.
+--
+-- The allocation strategy decides which of the free prefixes are returned:
+--
+--   first-fit - the first free prefixes of the search prefixes
+--   next-fit  - the first free prefixes after arg_cursor, typically the
+--               last prefix allocated, wrapping around to the start of the
+--               search prefixes when reaching the end
+--   sparse    - prefixes at the start of the largest free blocks, leaving
+--               as much room as possible around each of them to grow
+--
+CREATE OR REPLACE FUNCTION find_free_prefix(arg_vrf integer, IN arg_prefixes inet[], arg_wanted_prefix_len integer, arg_count integer, arg_strategy text, arg_cursor inet) RETURNS SETOF inet AS $_$
 DECLARE
 	i_family integer;
 	i_found integer;
 	p int;
+	pass int;
 	search_prefix inet;
+	search_start inet;
+	search_end inet;
+	window_start inet;
+	window_end inet;
+	cursor_end inet;
 	current_prefix inet;
 	max_prefix_len integer;
-	covering_prefix inet;
+	search_prefix_id integer;
+	range_cursor refcursor;
+	r record;
+	have_row boolean;
+	free_start inet;
+	free_end inet;
+	blocks inet[];
+	block_search inet[];
+	best integer;
+	len integer;
 BEGIN
-	covering_prefix := NULL;
 	-- sanity checking
 	-- make sure all provided search_prefixes are of same family
 	FOR p IN SELECT generate_subscripts(arg_prefixes, 1) LOOP
@@ -395,76 +545,195 @@ BEGIN
 	IF arg_wanted_prefix_len > max_prefix_len THEN
 		RAISE EXCEPTION 'Requested prefix-length exceeds max prefix-length %', max_prefix_len;
 	END IF;
+
+	IF arg_strategy NOT IN ('first-fit', 'next-fit', 'sparse') THEN
+		RAISE EXCEPTION 'Unknown allocation strategy %', arg_strategy;
+	END IF;
 	--
 
 	i_found := 0;
+	blocks := '{}';
+	block_search := '{}';
 
-	-- loop through our search list of prefixes
-	FOR p IN SELECT generate_subscripts(arg_prefixes, 1) LOOP
-		-- save the current prefix in which we are looking for a candidate
-		search_prefix := arg_prefixes[p];
-
-		IF (masklen(search_prefix) > arg_wanted_prefix_len) THEN
-			CONTINUE;
-		END IF;
-
-		SELECT set_masklen(search_prefix, arg_wanted_prefix_len) INTO current_prefix;
+	-- next-fit continues after the last address of the cursor
+	IF arg_strategy = 'next-fit' AND family(arg_cursor) = i_family THEN
+		cursor_end := set_masklen(broadcast(arg_cursor), max_prefix_len);
+	END IF;
 
-		-- we step through our search_prefix in steps of the wanted prefix
-		-- length until we are beyond the broadcast size, ie end of our
-		-- search_prefix
-		WHILE set_masklen(current_prefix, masklen(search_prefix)) <= broadcast(search_prefix) LOOP
-			-- tests put in order of speed, fastest one first
+	-- with a cursor, what comes before it is searched in a second pass
+	FOR pass IN 1..CASE WHEN cursor_end IS NULL THEN 1 ELSE 2 END LOOP
+		-- loop through our search list of prefixes, in order of address for
+		-- next-fit
+		FOR search_prefix IN SELECT network(a.prefix)
+				FROM unnest(arg_prefixes) WITH ORDINALITY AS a(prefix, i)
+				ORDER BY CASE WHEN arg_strategy = 'next-fit' THEN network(a.prefix) END, a.i LOOP
 
-			-- the following are address family agnostic
-			IF current_prefix IS NULL THEN
-				SELECT broadcast(current_prefix) + 1 INTO current_prefix;
-				CONTINUE;
-			END IF;
-			IF EXISTS (SELECT 1 FROM ip_net_plan WHERE vrf_id = arg_vrf AND prefix = current_prefix) THEN
-				SELECT broadcast(current_prefix) + 1 INTO current_prefix;
+			IF (masklen(search_prefix) > arg_wanted_prefix_len) THEN
 				CONTINUE;
 			END IF;
 
-			-- avoid prefixes larger than the current_prefix but inside our search_prefix
-			covering_prefix := (SELECT prefix FROM ip_net_plan WHERE vrf_id = arg_vrf AND iprange(prefix) >>= iprange(current_prefix::cidr) AND iprange(prefix) << iprange(search_prefix::cidr) ORDER BY masklen(prefix) ASC LIMIT 1);
-			IF covering_prefix IS NOT NULL THEN
-				SELECT set_masklen(broadcast(covering_prefix) + 1, arg_wanted_prefix_len) INTO current_prefix;
-				CONTINUE;
+			-- first and last address of the search prefix
+			search_start := set_masklen(search_prefix, max_prefix_len);
+			search_end := set_masklen(broadcast(search_prefix), max_prefix_len);
+
+			-- the part of the search prefix to look in during this pass
+			window_start := search_start;
+			window_end := search_end;
+			IF cursor_end IS NOT NULL THEN
+				IF pass = 1 THEN
+					CONTINUE WHEN cursor_end >= search_end;
+					IF cursor_end >= search_start THEN
+						window_start := cursor_end + 1;
+					END IF;
+				ELSE
+					CONTINUE WHEN cursor_end < search_start;
+					IF cursor_end < search_end THEN
+						window_end := cursor_end;
+					END IF;
+				END IF;
 			END IF;
 
-			-- prefix must not contain any breakouts, that would mean it's not empty, ie not free
-			IF EXISTS (SELECT 1 FROM ip_net_plan WHERE vrf_id = arg_vrf AND iprange(prefix) <<= iprange(current_prefix::cidr)) THEN
-				SELECT broadcast(current_prefix) + 1 INTO current_prefix;
-				CONTINUE;
+			-- the free ranges of prefixes in the table are kept up to date by
+			-- triggers and can be used as is, for other search prefixes the
+			-- free ranges are found between the prefixes inside the search
+			-- prefix
+			SELECT id INTO search_prefix_id FROM ip_net_plan WHERE vrf_id = arg_vrf AND prefix = search_prefix::cidr;
+			IF search_prefix_id IS NOT NULL THEN
+				-- the search prefix itself is the size we are looking for and
+				-- thus not free
+				CONTINUE WHEN masklen(search_prefix) = arg_wanted_prefix_len;
+
+				OPEN range_cursor FOR SELECT set_masklen(lower(free_range)::inet, max_prefix_len) AS first,
+						set_masklen(upper(free_range)::inet, max_prefix_len) AS last
+					FROM ip_net_free_range
+					WHERE prefix_id = search_prefix_id
+						AND upper(free_range) >= window_start::ipaddress
+						AND lower(free_range) <= window_end::ipaddress
+					ORDER BY free_range;
+			ELSE
+				-- prefixes inside the search prefix, in order, and the search
+				-- prefix itself if it is the size we are looking for
+				OPEN range_cursor FOR SELECT set_masklen(prefix::inet, max_prefix_len) AS first,
+						set_masklen(broadcast(prefix), max_prefix_len) AS last
+					FROM ip_net_plan
+					WHERE vrf_id = arg_vrf
+						AND (iprange(prefix) << iprange(search_prefix::cidr)
+							OR (prefix = search_prefix::cidr AND masklen(search_prefix) = arg_wanted_prefix_len))
+						AND set_masklen(broadcast(prefix), max_prefix_len) >= window_start
+						AND set_masklen(prefix::inet, max_prefix_len) <= window_end
+					ORDER BY prefix;
 			END IF;
 
-			-- while the following two tests are family agnostic, they use
-			-- functions and so are not indexed
-			-- TODO: should they be indexed?
+			free_start := window_start;
+			LOOP
+				FETCH range_cursor INTO r;
+				have_row := FOUND;
+
+				IF search_prefix_id IS NOT NULL THEN
+					EXIT WHEN NOT have_row;
+					free_start := greatest(r.first, window_start);
+					free_end := least(r.last, window_end);
+				ELSE
+					-- prefixes within an already passed prefix are not
+					-- interesting
+					CONTINUE WHEN have_row AND r.last < free_start;
+
+					-- is there a free range before the next used prefix or
+					-- the end of the window?
+					IF have_row AND r.first <= free_start THEN
+						EXIT WHEN r.last >= window_end;
+						free_start := r.last + 1;
+						CONTINUE;
+					END IF;
+
+					IF have_row THEN
+						free_end := r.first - 1;
+					ELSE
+						free_end := window_end;
+					END IF;
+				END IF;
 
-			IF ((i_family = 4 AND masklen(search_prefix) < 31) OR i_family = 6 AND masklen(search_prefix) < 127)THEN
-				IF (set_masklen(network(search_prefix), max_prefix_len) = current_prefix) THEN
-					SELECT broadcast(current_prefix) + 1 INTO current_prefix;
-					CONTINUE;
+				IF arg_strategy = 'sparse' THEN
+					-- keep the largest aligned blocks of the free range, big
+					-- enough for the wanted prefix length, to pick from later
+					FOR current_prefix IN SELECT * FROM iprange2cidr(ARRAY[ iprange(free_start::ipaddress, free_end::ipaddress) ]) LOOP
+						IF masklen(current_prefix) <= arg_wanted_prefix_len THEN
+							blocks := blocks || current_prefix;
+							block_search := block_search || search_prefix;
+						END IF;
+					END LOOP;
+				ELSE
+					-- first aligned prefix of the wanted size in the free range
+					current_prefix := set_masklen(network(set_masklen(free_start, arg_wanted_prefix_len)), arg_wanted_prefix_len);
+					IF set_masklen(current_prefix, max_prefix_len) < free_start THEN
+						IF set_masklen(broadcast(current_prefix), max_prefix_len) >= free_end THEN
+							current_prefix := NULL;
+						ELSE
+							current_prefix := set_masklen(broadcast(current_prefix) + 1, arg_wanted_prefix_len);
+						END IF;
+					END IF;
+
+					WHILE current_prefix IS NOT NULL AND set_masklen(broadcast(current_prefix), max_prefix_len) <= free_end LOOP
+						-- don't hand out the network or broadcast address of
+						-- the search prefix as host addresses
+						IF NOT (masklen(current_prefix) = max_prefix_len AND masklen(search_prefix) < max_prefix_len - 1
+								AND current_prefix IN (search_start, search_end)) THEN
+							RETURN NEXT current_prefix;
+
+							i_found := i_found + 1;
+							IF i_found >= arg_count THEN
+								CLOSE range_cursor;
+								RETURN;
+							END IF;
+						END IF;
+
+						EXIT WHEN set_masklen(broadcast(current_prefix), max_prefix_len) >= free_end;
+						current_prefix := set_masklen(broadcast(current_prefix) + 1, arg_wanted_prefix_len);
+					END LOOP;
 				END IF;
-				IF (set_masklen(broadcast(search_prefix), max_prefix_len) = current_prefix) THEN
-					SELECT broadcast(current_prefix) + 1 INTO current_prefix;
-					CONTINUE;
+
+				IF search_prefix_id IS NULL THEN
+					EXIT WHEN NOT have_row OR r.last >= window_end;
+					free_start := r.last + 1;
 				END IF;
-			END IF;
+			END LOOP;
+			CLOSE range_cursor;
 
-			RETURN NEXT current_prefix;
+		END LOOP;
+	END LOOP;
 
-			i_found := i_found + 1;
-			IF i_found >= arg_count THEN
-				RETURN;
-			END IF;
+	-- hand out prefixes from the start of the largest free block, the lowest
+	-- one if there are several of the same size, and keep the rest of the
+	-- block as smaller blocks
+	IF arg_strategy = 'sparse' THEN
+		WHILE i_found < arg_count LOOP
+			best := NULL;
+			FOR p IN SELECT generate_subscripts(blocks, 1) LOOP
+				CONTINUE WHEN blocks[p] IS NULL;
+				IF best IS NULL OR masklen(blocks[p]) < masklen(blocks[best])
+						OR (masklen(blocks[p]) = masklen(blocks[best]) AND blocks[p] < blocks[best]) THEN
+					best := p;
+				END IF;
+			END LOOP;
+			EXIT WHEN best IS NULL;
 
-			current_prefix := broadcast(current_prefix) + 1;
+			current_prefix := set_masklen(blocks[best], arg_wanted_prefix_len);
+			search_prefix := block_search[best];
+			FOR len IN masklen(blocks[best]) + 1 .. arg_wanted_prefix_len LOOP
+				blocks := blocks || set_masklen(broadcast(set_masklen(blocks[best], len)) + 1, len);
+				block_search := block_search || search_prefix;
+			END LOOP;
+			blocks[best] := NULL;
+
+			-- don't hand out the network or broadcast address of the search
+			-- prefix as host addresses
+			IF NOT (masklen(current_prefix) = max_prefix_len AND masklen(search_prefix) < max_prefix_len - 1
+					AND current_prefix IN (set_masklen(search_prefix, max_prefix_len), set_masklen(broadcast(search_prefix), max_prefix_len))) THEN
+				RETURN NEXT current_prefix;
+				i_found := i_found + 1;
+			END IF;
 		END LOOP;
-
-	END LOOP;
+	END IF;
 
 	RETURN;
 
@@ -530,6 +799,556 @@ BEGIN
 END;
 $_$ LANGUAGE plpgsql IMMUTABLE STRICT;
 
+
+
+--
+-- calc_prefix_ancestors calculates the ancestors of all prefixes in a VRF from
+-- the prefixes themselves. The ancestors are found by looking up each of the
+-- shorter prefixes covering a prefix, which only takes as many index lookups
+-- as the prefix length.
+--
+CREATE OR REPLACE FUNCTION calc_prefix_ancestors(arg_vrf integer) RETURNS TABLE (prefix_id integer, ancestor_id integer) AS $_$
+	SELECT inp.id, anc.id
+	FROM ip_net_plan AS inp
+		CROSS JOIN generate_series(0, masklen(inp.prefix) - 1) AS len
+		JOIN ip_net_plan AS anc ON (anc.vrf_id = inp.vrf_id AND anc.prefix = set_masklen(inp.prefix, len))
+	WHERE inp.vrf_id = $1;
+$_$ LANGUAGE SQL STABLE;
+
+
+
+--
+-- calc_prefix_parents calculates the direct parent, that is the closest
+-- ancestor, of all prefixes in a VRF which have one.
+--
+CREATE OR REPLACE FUNCTION calc_prefix_parents(arg_vrf integer) RETURNS TABLE (id integer, parent_id integer, parent_prefix cidr) AS $_$
+	SELECT DISTINCT ON (a.prefix_id) a.prefix_id, anc.id, anc.prefix
+	FROM calc_prefix_ancestors($1) AS a
+		JOIN ip_net_plan AS anc ON (anc.id = a.ancestor_id)
+	ORDER BY a.prefix_id, masklen(anc.prefix) DESC;
+$_$ LANGUAGE SQL STABLE;
+
+
+
+--
+-- calc_prefix_stats calculates what the values maintained by the ip_net_plan
+-- triggers should be for all prefixes in a VRF. Like the other calc_*
+-- functions it only trusts the prefixes themselves and not any of the values
+-- derived from them, so that it can be used to find values which are off.
+--
+CREATE OR REPLACE FUNCTION calc_prefix_stats(arg_vrf integer) RETURNS TABLE (id integer, parent_id integer, children integer, display_prefix inet, total_addresses numeric(40), used_addresses numeric(40), free_addresses numeric(40), inherited_tags text[]) AS $_$
+	WITH ancestor AS (
+		SELECT * FROM calc_prefix_ancestors($1)
+	), parent AS (
+		SELECT DISTINCT ON (a.prefix_id) a.prefix_id AS id, anc.id AS parent_id, anc.prefix AS parent_prefix
+		FROM ancestor AS a
+			JOIN ip_net_plan AS anc ON (anc.id = a.ancestor_id)
+		ORDER BY a.prefix_id, masklen(anc.prefix) DESC
+	), child AS (
+		SELECT parent.parent_id AS id,
+			COUNT(1) AS children,
+			SUM(power(2::numeric, CASE WHEN family(inp.prefix) = 4 THEN 32 ELSE 128 END - masklen(inp.prefix))) AS used_addresses
+		FROM parent
+			JOIN ip_net_plan AS inp ON (inp.id = parent.id)
+		GROUP BY parent.parent_id
+	), tags AS (
+		SELECT a.prefix_id AS id, array_undup(array_agg(tag)) AS inherited_tags
+		FROM ancestor AS a
+			JOIN ip_net_plan AS anc ON (anc.id = a.ancestor_id)
+			CROSS JOIN unnest(anc.tags) AS tag
+		GROUP BY a.prefix_id
+	), stats AS (
+		SELECT inp.id,
+			parent.parent_id,
+			COALESCE(child.children, 0)::integer AS children,
+			CASE WHEN inp.type = 'host' THEN set_masklen(inp.prefix::inet, masklen(parent.parent_prefix)) ELSE inp.prefix END AS display_prefix,
+			power(2::numeric, CASE WHEN family(inp.prefix) = 4 THEN 32 ELSE 128 END - masklen(inp.prefix)) AS total_addresses,
+			-- hosts use all of their addresses
+			CASE WHEN masklen(inp.prefix) = CASE WHEN family(inp.prefix) = 4 THEN 32 ELSE 128 END THEN NULL ELSE COALESCE(child.used_addresses, 0) END AS used_addresses,
+			COALESCE(tags.inherited_tags, '{}') AS inherited_tags
+		FROM ip_net_plan AS inp
+			LEFT JOIN parent ON (parent.id = inp.id)
+			LEFT JOIN child ON (child.id = inp.id)
+			LEFT JOIN tags ON (tags.id = inp.id)
+		WHERE inp.vrf_id = $1
+	)
+	SELECT id, parent_id, children, display_prefix,
+		total_addresses::numeric(40),
+		COALESCE(used_addresses, total_addresses)::numeric(40),
+		(total_addresses - COALESCE(used_addresses, total_addresses))::numeric(40),
+		inherited_tags
+	FROM stats;
+$_$ LANGUAGE SQL STABLE;
+
+
+
+--
+-- calc_prefix_free_ranges calculates the free ranges of all prefixes in a VRF.
+-- The free ranges of a prefix are the gaps before each of its direct children
+-- and the one after the last of them, which is all of the prefix if it has no
+-- children.
+--
+CREATE OR REPLACE FUNCTION calc_prefix_free_ranges(arg_vrf integer) RETURNS TABLE (prefix_id integer, free_range iprange) AS $_$
+	WITH child AS (
+		SELECT p.parent_id, p.parent_prefix, inp.prefix
+		FROM calc_prefix_parents($1) AS p
+			JOIN ip_net_plan AS inp ON (inp.id = p.id)
+	)
+	SELECT parent_id, iprange(first, next_used - 1)
+	FROM (
+		SELECT parent_id,
+			COALESCE(lag(upper(iprange(prefix))) OVER (PARTITION BY parent_id ORDER BY prefix) + 1, lower(iprange(parent_prefix))) AS first,
+			lower(iprange(prefix)) AS next_used
+		FROM child
+		) AS gap
+	WHERE next_used > first
+	UNION ALL
+	SELECT id, iprange(CASE WHEN last_used IS NULL THEN lower(iprange(prefix)) ELSE last_used + 1 END, upper(iprange(prefix)))
+	FROM (
+		SELECT DISTINCT ON (inp.id) inp.id, inp.prefix, upper(iprange(child.prefix)) AS last_used
+		FROM ip_net_plan AS inp
+			LEFT JOIN child ON (child.parent_id = inp.id)
+		WHERE inp.vrf_id = $1
+			-- hosts can't hold any other prefixes
+			AND masklen(inp.prefix) != CASE WHEN family(inp.prefix) = 4 THEN 32 ELSE 128 END
+		ORDER BY inp.id, child.prefix DESC NULLS LAST
+		) AS tail
+	WHERE last_used IS NULL OR last_used < upper(iprange(prefix));
+$_$ LANGUAGE SQL STABLE;
+
+
+
+--
+-- calc_vrf_stats calculates the prefix statistics of a VRF from the prefixes
+-- in it.
+--
+CREATE OR REPLACE FUNCTION calc_vrf_stats(arg_vrf integer) RETURNS TABLE (id integer, num_prefixes_v4 numeric(40), num_prefixes_v6 numeric(40), total_addresses_v4 numeric(40), total_addresses_v6 numeric(40), used_addresses_v4 numeric(40), used_addresses_v6 numeric(40), free_addresses_v4 numeric(40), free_addresses_v6 numeric(40)) AS $_$
+	SELECT $1,
+		COUNT(CASE WHEN family(prefix) = 4 THEN 1 END)::numeric,
+		COUNT(CASE WHEN family(prefix) = 6 THEN 1 END)::numeric,
+		-- only top level prefixes count towards the addresses
+		COALESCE(SUM(CASE WHEN family(prefix) = 4 AND parent_id IS NULL THEN total_addresses END), 0),
+		COALESCE(SUM(CASE WHEN family(prefix) = 6 AND parent_id IS NULL THEN total_addresses END), 0),
+		COALESCE(SUM(CASE WHEN family(prefix) = 4 AND parent_id IS NULL THEN used_addresses END), 0),
+		COALESCE(SUM(CASE WHEN family(prefix) = 6 AND parent_id IS NULL THEN used_addresses END), 0),
+		COALESCE(SUM(CASE WHEN family(prefix) = 4 AND parent_id IS NULL THEN free_addresses END), 0),
+		COALESCE(SUM(CASE WHEN family(prefix) = 6 AND parent_id IS NULL THEN free_addresses END), 0)
+	FROM ip_net_plan AS inp
+		LEFT JOIN ip_net_plan_stats AS stats ON (stats.prefix_id = inp.id)
+	WHERE inp.vrf_id = $1;
+$_$ LANGUAGE SQL STABLE;
+
+
+
+--
+-- calc_pool_stats calculates the prefix statistics of the pools which have
+-- member prefixes in a VRF.
+--
+CREATE OR REPLACE FUNCTION calc_pool_stats(arg_vrf integer) RETURNS TABLE (id integer, member_prefixes_v4 numeric(40), member_prefixes_v6 numeric(40), used_prefixes_v4 numeric(40), used_prefixes_v6 numeric(40), free_prefixes_v4 numeric(40), free_prefixes_v6 numeric(40), total_prefixes_v4 numeric(40), total_prefixes_v6 numeric(40), total_addresses_v4 numeric(40), total_addresses_v6 numeric(40), used_addresses_v4 numeric(40), used_addresses_v6 numeric(40), free_addresses_v4 numeric(40), free_addresses_v6 numeric(40)) AS $_$
+	SELECT id,
+		member_prefixes_v4, member_prefixes_v6,
+		used_prefixes_v4, used_prefixes_v6,
+		free_prefixes_v4, free_prefixes_v6,
+		used_prefixes_v4 + free_prefixes_v4, used_prefixes_v6 + free_prefixes_v6,
+		total_addresses_v4, total_addresses_v6,
+		used_addresses_v4, used_addresses_v6,
+		free_addresses_v4, free_addresses_v6
+	FROM (
+		SELECT inp.pool_id AS id,
+			COUNT(CASE WHEN family(prefix) = 4 THEN 1 END)::numeric AS member_prefixes_v4,
+			COUNT(CASE WHEN family(prefix) = 6 THEN 1 END)::numeric AS member_prefixes_v6,
+			COALESCE(SUM(CASE WHEN family(prefix) = 4 THEN children END), 0) AS used_prefixes_v4,
+			COALESCE(SUM(CASE WHEN family(prefix) = 6 THEN children END), 0) AS used_prefixes_v6,
+			SUM(CASE WHEN family(prefix) = 4 THEN free_prefixes END) AS free_prefixes_v4,
+			SUM(CASE WHEN family(prefix) = 6 THEN free_prefixes END) AS free_prefixes_v6,
+			COALESCE(SUM(CASE WHEN family(prefix) = 4 THEN total_addresses END), 0) AS total_addresses_v4,
+			COALESCE(SUM(CASE WHEN family(prefix) = 6 THEN total_addresses END), 0) AS total_addresses_v6,
+			COALESCE(SUM(CASE WHEN family(prefix) = 4 THEN used_addresses END), 0) AS used_addresses_v4,
+			COALESCE(SUM(CASE WHEN family(prefix) = 6 THEN used_addresses END), 0) AS used_addresses_v6,
+			COALESCE(SUM(CASE WHEN family(prefix) = 4 THEN free_addresses END), 0) AS free_addresses_v4,
+			COALESCE(SUM(CASE WHEN family(prefix) = 6 THEN free_addresses END), 0) AS free_addresses_v6
+		FROM ip_net_plan AS inp
+			LEFT JOIN ip_net_plan_stats AS stats ON (stats.prefix_id = inp.id)
+		WHERE inp.vrf_id = $1
+			AND inp.pool_id IS NOT NULL
+		GROUP BY inp.pool_id
+		) AS stats;
+$_$ LANGUAGE SQL STABLE;
+
+
+
+--
+-- disable_prefix_triggers disables the triggers on ip_net_plan which maintain
+-- the prefix tree and statistics, leaving the kafka triggers alone. The names
+-- of the triggers which were enabled are returned, to be passed on to
+-- enable_prefix_triggers once done.
+--
+CREATE OR REPLACE FUNCTION disable_prefix_triggers() RETURNS text[] AS $_$
+DECLARE
+	triggers text[];
+BEGIN
+	triggers := ARRAY(
+		SELECT tgname
+		FROM pg_trigger
+		WHERE tgrelid = 'ip_net_plan'::regclass
+			AND NOT tgisinternal
+			AND tgenabled != 'D'
+			AND tgname !~ '^trigger_kafka_'
+		);
+	FOR i IN 1 .. COALESCE(array_length(triggers, 1), 0) LOOP
+		EXECUTE 'ALTER TABLE ip_net_plan DISABLE TRIGGER ' || quote_ident(triggers[i]);
+	END LOOP;
+
+	RETURN triggers;
+END;
+$_$ LANGUAGE plpgsql;
+
+
+CREATE OR REPLACE FUNCTION enable_prefix_triggers(arg_triggers text[]) RETURNS bool AS $_$
+BEGIN
+	FOR i IN 1 .. COALESCE(array_length(arg_triggers, 1), 0) LOOP
+		EXECUTE 'ALTER TABLE ip_net_plan ENABLE TRIGGER ' || quote_ident(arg_triggers[i]);
+	END LOOP;
+
+	RETURN true;
+END;
+$_$ LANGUAGE plpgsql;
+
+
+
+--
+-- rebuild_prefix_stats rebuilds the prefix tree, the statistics and the free
+-- ranges of all prefixes in a VRF, along with the statistics of the VRF and
+-- the pools its prefixes are members of. It does in a few statements what the
+-- ip_net_plan triggers do one prefix at a time and is used after loading
+-- prefixes in bulk. The sanity checks of the triggers are performed on the
+-- whole VRF.
+--
+-- The UPDATE triggers on ip_net_plan and the triggers on ip_net_plan_stats
+-- and ip_net_free_range are skipped while rebuilding, as they would otherwise act on the changes
+-- made here, by setting nipap.rebuild_stats for the duration. Only the rows
+-- of the VRF are locked, so several VRFs can be rebuilt in parallel. Prefixes in the VRF being changed at the same time
+-- wait for the rebuild to finish when updating the VRF statistics.
+--
+CREATE OR REPLACE FUNCTION rebuild_prefix_stats(arg_vrf integer) RETURNS bool AS $_$
+DECLARE
+	r record;
+BEGIN
+	PERFORM 1 FROM ip_net_vrf WHERE id = arg_vrf FOR UPDATE;
+	PERFORM set_config('nipap.rebuild_stats', 'on', true);
+
+	--
+	---- parent and ancestors --------------------------------------------------
+	--
+	DELETE FROM ip_net_plan_ancestor WHERE prefix_id IN (SELECT id FROM ip_net_plan WHERE vrf_id = arg_vrf);
+	INSERT INTO ip_net_plan_ancestor (prefix_id, ancestor_id)
+		SELECT prefix_id, ancestor_id FROM calc_prefix_ancestors(arg_vrf);
+
+	--
+	---- free ranges -----------------------------------------------------------
+	--
+	DELETE FROM ip_net_free_range WHERE prefix_id IN (SELECT id FROM ip_net_plan WHERE vrf_id = arg_vrf);
+	INSERT INTO ip_net_free_range (prefix_id, free_range)
+		SELECT prefix_id, free_range FROM calc_prefix_free_ranges(arg_vrf);
+
+	--
+	---- Statistics ------------------------------------------------------------
+	--
+	-- only prefixes which are off are written to, where the free prefixes
+	-- are counted in the free ranges above
+	WITH stats AS (
+		SELECT * FROM calc_prefix_stats(arg_vrf)
+	), tree AS (
+		UPDATE ip_net_plan AS inp
+		SET parent_id = stats.parent_id,
+			display_prefix = stats.display_prefix,
+			inherited_tags = stats.inherited_tags
+		FROM stats
+		WHERE inp.id = stats.id
+			AND (inp.parent_id IS DISTINCT FROM stats.parent_id
+				OR inp.display_prefix IS DISTINCT FROM stats.display_prefix
+				OR inp.inherited_tags IS DISTINCT FROM stats.inherited_tags)
+	)
+	INSERT INTO ip_net_plan_stats AS s (prefix_id, vrf_id, pool_id, family, top_level, children, total_addresses, used_addresses, free_addresses, free_prefixes)
+	SELECT stats.id, inp.vrf_id, inp.pool_id, family(inp.prefix), stats.parent_id IS NULL,
+		stats.children, stats.total_addresses, stats.used_addresses, stats.free_addresses,
+		calc_prefix_free_prefixes(inp.id)
+	FROM stats
+		JOIN ip_net_plan AS inp ON (inp.id = stats.id)
+	ON CONFLICT (prefix_id) DO UPDATE
+	SET vrf_id = EXCLUDED.vrf_id,
+		pool_id = EXCLUDED.pool_id,
+		family = EXCLUDED.family,
+		top_level = EXCLUDED.top_level,
+		children = EXCLUDED.children,
+		total_addresses = EXCLUDED.total_addresses,
+		used_addresses = EXCLUDED.used_addresses,
+		free_addresses = EXCLUDED.free_addresses,
+		free_prefixes = EXCLUDED.free_prefixes
+	WHERE (s.vrf_id, s.pool_id, s.family, s.top_level, s.children, s.total_addresses, s.used_addresses, s.free_addresses, s.free_prefixes)
+		IS DISTINCT FROM (EXCLUDED.vrf_id, EXCLUDED.pool_id, EXCLUDED.family, EXCLUDED.top_level,
+			EXCLUDED.children, EXCLUDED.total_addresses, EXCLUDED.used_addresses, EXCLUDED.free_addresses,
+			EXCLUDED.free_prefixes);
+
+	--
+	---- Various sanity checking -----------------------------------------------
+	--
+	SELECT inp.prefix, inp.type, parent.prefix AS parent_prefix, parent.type AS parent_type INTO r
+	FROM ip_net_plan AS inp
+		LEFT JOIN ip_net_plan AS parent ON (parent.id = inp.parent_id)
+	WHERE inp.vrf_id = arg_vrf
+		AND CASE WHEN inp.type = 'host' THEN parent.type IS DISTINCT FROM 'assignment' ELSE parent.type != 'reservation' END
+	LIMIT 1;
+	IF r.prefix IS NOT NULL THEN
+		IF r.parent_type IS NULL THEN
+			RAISE EXCEPTION '1200:Prefix of type host must have a parent (covering) prefix of type assignment';
+		ELSIF r.type = 'host' THEN
+			RAISE EXCEPTION '1200:Parent prefix (%) is of type % but must be of type ''assignment''', r.parent_prefix, r.parent_type;
+		ELSE
+			RAISE EXCEPTION '1200:Parent prefix (%) is of type % but must be of type ''reservation''', r.parent_prefix, r.parent_type;
+		END IF;
+	END IF;
+
+	IF EXISTS (SELECT 1 FROM ip_net_plan WHERE vrf_id = arg_vrf AND type = 'host' AND masklen(prefix) != CASE WHEN family(prefix) = 4 THEN 32 ELSE 128 END) THEN
+		RAISE EXCEPTION '1200:Prefix of type host must have all bits set in netmask';
+	END IF;
+
+	IF EXISTS (SELECT 1 FROM ip_net_plan WHERE vrf_id = arg_vrf AND type = 'reservation' AND node IS NOT NULL) THEN
+		RAISE EXCEPTION '1200:Not allowed to set ''node'' value for prefixes of type ''reservation''.';
+	END IF;
+	IF EXISTS (SELECT 1 FROM ip_net_plan WHERE vrf_id = arg_vrf AND type = 'assignment' AND node IS NOT NULL AND masklen(prefix) != CASE WHEN family(prefix) = 4 THEN 32 ELSE 128 END) THEN
+		RAISE EXCEPTION '1200:Not allowed to set ''node'' value for prefixes of type ''assignment'' which do not have all bits set in netmask.';
+	END IF;
+
+	IF EXISTS (SELECT 1 FROM ip_net_plan WHERE vrf_id = arg_vrf AND country !~ '^[A-Z]{2}$') THEN
+		RAISE EXCEPTION '1200: Please enter a two letter country code according to ISO 3166-1 alpha-2';
+	END IF;
+
+	IF EXISTS (SELECT 1 FROM ip_net_plan AS inp JOIN ip_net_plan AS member ON (member.pool_id = inp.pool_id) WHERE inp.vrf_id = arg_vrf AND member.vrf_id != arg_vrf) THEN
+		RAISE EXCEPTION '1200:Change not allowed. All member prefixes of a pool must be in a the same VRF.';
+	END IF;
+
+	--
+	---- VRF and pool statistics -----------------------------------------------
+	--
+	UPDATE ip_net_vrf AS vrf
+	SET num_prefixes_v4 = stats.num_prefixes_v4,
+		num_prefixes_v6 = stats.num_prefixes_v6,
+		total_addresses_v4 = stats.total_addresses_v4,
+		total_addresses_v6 = stats.total_addresses_v6,
+		used_addresses_v4 = stats.used_addresses_v4,
+		used_addresses_v6 = stats.used_addresses_v6,
+		free_addresses_v4 = stats.free_addresses_v4,
+		free_addresses_v6 = stats.free_addresses_v6
+	FROM calc_vrf_stats(arg_vrf) AS stats
+	WHERE vrf.id = stats.id;
+
+	UPDATE ip_net_pool AS pool
+	SET member_prefixes_v4 = stats.member_prefixes_v4,
+		member_prefixes_v6 = stats.member_prefixes_v6,
+		used_prefixes_v4 = stats.used_prefixes_v4,
+		used_prefixes_v6 = stats.used_prefixes_v6,
+		free_prefixes_v4 = stats.free_prefixes_v4,
+		free_prefixes_v6 = stats.free_prefixes_v6,
+		total_prefixes_v4 = stats.total_prefixes_v4,
+		total_prefixes_v6 = stats.total_prefixes_v6,
+		total_addresses_v4 = stats.total_addresses_v4,
+		total_addresses_v6 = stats.total_addresses_v6,
+		used_addresses_v4 = stats.used_addresses_v4,
+		used_addresses_v6 = stats.used_addresses_v6,
+		free_addresses_v4 = stats.free_addresses_v4,
+		free_addresses_v6 = stats.free_addresses_v6
+	FROM calc_pool_stats(arg_vrf) AS stats
+	WHERE pool.id = stats.id;
+
+	PERFORM set_config('nipap.rebuild_stats', 'off', true);
+
+	RETURN true;
+END;
+$_$ LANGUAGE plpgsql;
+
+
+
+--
+-- verify_prefix_stats compares the values maintained by the triggers for a VRF
+-- with what they should be, returning one row for each value which is off.
+-- The prefix tree and the prefix statistics are calculated from the prefixes
+-- alone, while the VRF and pool statistics are calculated from the stored
+-- prefix statistics, so a VRF or pool will only show up as being off because
+-- of its own values.
+--
+CREATE OR REPLACE FUNCTION verify_prefix_stats(arg_vrf integer) RETURNS TABLE (table_name text, id integer, attribute text, stored text, expected text) AS $_$
+	SELECT val.table_name, inp.id, val.attribute, val.stored, val.expected
+	FROM ip_net_plan AS inp
+		JOIN calc_prefix_stats($1) AS stats ON (stats.id = inp.id)
+		LEFT JOIN ip_net_plan_stats AS s ON (s.prefix_id = inp.id)
+		CROSS JOIN LATERAL (VALUES
+			('ip_net_plan', 'parent_id', inp.parent_id::text, stats.parent_id::text),
+			('ip_net_plan', 'display_prefix', inp.display_prefix::text, stats.display_prefix::text),
+			-- the order of inherited tags carries no meaning
+			('ip_net_plan', 'inherited_tags',
+				(SELECT array_agg(tag ORDER BY tag) FROM unnest(inp.inherited_tags) AS tag)::text,
+				(SELECT array_agg(tag ORDER BY tag) FROM unnest(stats.inherited_tags) AS tag)::text),
+			('ip_net_plan_stats', 'vrf_id', s.vrf_id::text, inp.vrf_id::text),
+			('ip_net_plan_stats', 'pool_id', s.pool_id::text, inp.pool_id::text),
+			('ip_net_plan_stats', 'family', s.family::text, family(inp.prefix)::text),
+			('ip_net_plan_stats', 'top_level', s.top_level::text, (stats.parent_id IS NULL)::text),
+			('ip_net_plan_stats', 'children', s.children::text, stats.children::text),
+			('ip_net_plan_stats', 'total_addresses', s.total_addresses::text, stats.total_addresses::text),
+			('ip_net_plan_stats', 'used_addresses', s.used_addresses::text, stats.used_addresses::text),
+			('ip_net_plan_stats', 'free_addresses', s.free_addresses::text, stats.free_addresses::text),
+			('ip_net_plan_stats', 'free_prefixes', s.free_prefixes::text, calc_prefix_free_prefixes(inp.id)::text)
+			) AS val (table_name, attribute, stored, expected)
+	WHERE val.stored IS DISTINCT FROM val.expected
+	UNION ALL
+	SELECT 'ip_net_plan_ancestor', prefix_id, 'ancestor_id', stored.ancestors::text, expected.ancestors::text
+	FROM (
+		SELECT a.prefix_id, array_agg(a.ancestor_id ORDER BY a.ancestor_id) AS ancestors
+		FROM ip_net_plan_ancestor AS a
+			JOIN ip_net_plan AS inp ON (inp.id = a.prefix_id)
+		WHERE inp.vrf_id = $1
+		GROUP BY a.prefix_id
+		) AS stored
+		FULL JOIN (
+			SELECT prefix_id, array_agg(ancestor_id ORDER BY ancestor_id) AS ancestors
+			FROM calc_prefix_ancestors($1)
+			GROUP BY prefix_id
+		) AS expected USING (prefix_id)
+	WHERE stored.ancestors IS DISTINCT FROM expected.ancestors
+	UNION ALL
+	SELECT 'ip_net_free_range', prefix_id, 'free_range', stored.free_ranges::text, expected.free_ranges::text
+	FROM (
+		SELECT fr.prefix_id, array_agg(fr.free_range ORDER BY fr.free_range) AS free_ranges
+		FROM ip_net_free_range AS fr
+			JOIN ip_net_plan AS inp ON (inp.id = fr.prefix_id)
+		WHERE inp.vrf_id = $1
+		GROUP BY fr.prefix_id
+		) AS stored
+		FULL JOIN (
+			SELECT prefix_id, array_agg(free_range ORDER BY free_range) AS free_ranges
+			FROM calc_prefix_free_ranges($1)
+			GROUP BY prefix_id
+		) AS expected USING (prefix_id)
+	WHERE stored.free_ranges IS DISTINCT FROM expected.free_ranges
+	UNION ALL
+	SELECT 'ip_net_vrf', vrf.id, val.attribute, val.stored, val.expected
+	FROM ip_net_vrf AS vrf
+		JOIN calc_vrf_stats($1) AS stats ON (stats.id = vrf.id)
+		CROSS JOIN LATERAL (VALUES
+			('num_prefixes_v4', vrf.num_prefixes_v4::text, stats.num_prefixes_v4::text),
+			('num_prefixes_v6', vrf.num_prefixes_v6::text, stats.num_prefixes_v6::text),
+			('total_addresses_v4', vrf.total_addresses_v4::text, stats.total_addresses_v4::text),
+			('total_addresses_v6', vrf.total_addresses_v6::text, stats.total_addresses_v6::text),
+			('used_addresses_v4', vrf.used_addresses_v4::text, stats.used_addresses_v4::text),
+			('used_addresses_v6', vrf.used_addresses_v6::text, stats.used_addresses_v6::text),
+			('free_addresses_v4', vrf.free_addresses_v4::text, stats.free_addresses_v4::text),
+			('free_addresses_v6', vrf.free_addresses_v6::text, stats.free_addresses_v6::text)
+			) AS val (attribute, stored, expected)
+	WHERE val.stored IS DISTINCT FROM val.expected
+	UNION ALL
+	SELECT 'ip_net_pool', pool.id, val.attribute, val.stored, val.expected
+	FROM ip_net_pool AS pool
+		JOIN calc_pool_stats($1) AS stats ON (stats.id = pool.id)
+		CROSS JOIN LATERAL (VALUES
+			('member_prefixes_v4', pool.member_prefixes_v4::text, stats.member_prefixes_v4::text),
+			('member_prefixes_v6', pool.member_prefixes_v6::text, stats.member_prefixes_v6::text),
+			('used_prefixes_v4', pool.used_prefixes_v4::text, stats.used_prefixes_v4::text),
+			('used_prefixes_v6', pool.used_prefixes_v6::text, stats.used_prefixes_v6::text),
+			('free_prefixes_v4', pool.free_prefixes_v4::text, stats.free_prefixes_v4::text),
+			('free_prefixes_v6', pool.free_prefixes_v6::text, stats.free_prefixes_v6::text),
+			('total_prefixes_v4', pool.total_prefixes_v4::text, stats.total_prefixes_v4::text),
+			('total_prefixes_v6', pool.total_prefixes_v6::text, stats.total_prefixes_v6::text),
+			('total_addresses_v4', pool.total_addresses_v4::text, stats.total_addresses_v4::text),
+			('total_addresses_v6', pool.total_addresses_v6::text, stats.total_addresses_v6::text),
+			('used_addresses_v4', pool.used_addresses_v4::text, stats.used_addresses_v4::text),
+			('used_addresses_v6', pool.used_addresses_v6::text, stats.used_addresses_v6::text),
+			('free_addresses_v4', pool.free_addresses_v4::text, stats.free_addresses_v4::text),
+			('free_addresses_v6', pool.free_addresses_v6::text, stats.free_addresses_v6::text)
+			) AS val (attribute, stored, expected)
+	WHERE val.stored IS DISTINCT FROM val.expected;
+$_$ LANGUAGE SQL STABLE;
+
+
+--
+-- remove_prefix_subtree removes a prefix and all prefixes it covers in a VRF.
+-- With the whole subtree gone there are no children to hand over, so rather
+-- than having the row level triggers maintain the prefix tree for every
+-- prefix removed, only the free ranges of the parent of the subtree are
+-- recalculated, once. The ancestors and free ranges of the removed prefixes
+-- go with them and the statistics of the parent, the VRF and the pools are
+-- updated by the statement level triggers. Returns the number of prefixes
+-- removed.
+--
+CREATE OR REPLACE FUNCTION remove_prefix_subtree(arg_vrf integer, arg_prefix cidr) RETURNS integer AS $_$
+DECLARE
+	parent ip_net_plan;
+	num_removed integer;
+BEGIN
+	SELECT * INTO parent
+	FROM ip_net_plan
+	WHERE vrf_id = arg_vrf
+		AND iprange(prefix) >> iprange(arg_prefix)
+	ORDER BY masklen(prefix) DESC LIMIT 1;
+
+	PERFORM set_config('nipap.remove_subtree', 'on', true);
+	DELETE FROM ip_net_plan WHERE vrf_id = arg_vrf AND iprange(prefix) <<= iprange(arg_prefix);
+	GET DIAGNOSTICS num_removed = ROW_COUNT;
+	PERFORM set_config('nipap.remove_subtree', 'off', true);
+
+	IF num_removed > 0 AND parent.id IS NOT NULL THEN
+		PERFORM calc_free_ranges(parent.id, iprange(arg_prefix));
+	END IF;
+
+	RETURN num_removed;
+END;
+$_$ LANGUAGE plpgsql;
+
+
+--
+-- remove_vrf_prefixes removes all prefixes of a VRF which is about to be
+-- removed. Neither the row level nor the statement level triggers run, as
+-- there is no prefix tree left to maintain. Pools only have members in a
+-- single VRF, so the pools which had members in the VRF are left without
+-- members and their statistics are simply reset, as are those of the VRF.
+-- Returns the number of prefixes removed.
+--
+CREATE OR REPLACE FUNCTION remove_vrf_prefixes(arg_vrf integer) RETURNS integer AS $_$
+DECLARE
+	pool_ids integer[];
+	num_removed integer;
+BEGIN
+	PERFORM 1 FROM ip_net_vrf WHERE id = arg_vrf FOR UPDATE;
+	pool_ids := ARRAY(SELECT DISTINCT pool_id FROM ip_net_plan WHERE vrf_id = arg_vrf AND pool_id IS NOT NULL);
+
+	PERFORM set_config('nipap.remove_subtree', 'on', true);
+	PERFORM set_config('nipap.remove_vrf', 'on', true);
+	DELETE FROM ip_net_plan WHERE vrf_id = arg_vrf;
+	GET DIAGNOSTICS num_removed = ROW_COUNT;
+	PERFORM set_config('nipap.remove_vrf', 'off', true);
+	PERFORM set_config('nipap.remove_subtree', 'off', true);
+
+	UPDATE ip_net_vrf
+	SET num_prefixes_v4 = 0, num_prefixes_v6 = 0,
+		total_addresses_v4 = 0, total_addresses_v6 = 0,
+		used_addresses_v4 = 0, used_addresses_v6 = 0,
+		free_addresses_v4 = 0, free_addresses_v6 = 0
+	WHERE id = arg_vrf;
+
+	UPDATE ip_net_pool AS pool
+	SET member_prefixes_v4 = 0, member_prefixes_v6 = 0,
+		used_prefixes_v4 = 0, used_prefixes_v6 = 0,
+		free_prefixes_v4 = NULL, free_prefixes_v6 = NULL,
+		total_prefixes_v4 = NULL, total_prefixes_v6 = NULL,
+		total_addresses_v4 = 0, total_addresses_v6 = 0,
+		used_addresses_v4 = 0, used_addresses_v6 = 0,
+		free_addresses_v4 = 0, free_addresses_v6 = 0
+	WHERE id = ANY(pool_ids);
+
+	RETURN num_removed;
+END;
+$_$ LANGUAGE plpgsql;
+
+
 CREATE OR REPLACE FUNCTION tf_kafka_produce_event() RETURNS trigger AS $$
 BEGIN
 	IF TG_OP = 'DELETE' THEN
@@ -548,7 +1367,7 @@ ip_net = """
 --
 --------------------------------------------
 
-COMMENT ON DATABASE %s IS 'NIPAP database - schema version: 8';
+COMMENT ON DATABASE %s IS 'NIPAP database - schema version: 9';
 
 CREATE EXTENSION IF NOT EXISTS ip4r;
 CREATE EXTENSION IF NOT EXISTS hstore;
@@ -556,6 +1375,7 @@ CREATE EXTENSION IF NOT EXISTS citext;
 
 CREATE TYPE ip_net_plan_type AS ENUM ('reservation', 'assignment', 'host');
 CREATE TYPE ip_net_plan_status AS ENUM ('assigned', 'reserved', 'quarantine');
+CREATE TYPE ip_net_pool_allocation_strategy AS ENUM ('first-fit', 'next-fit', 'sparse');
 
 CREATE TYPE priority_5step AS ENUM ('warning', 'low', 'medium', 'high', 'critical');
 
@@ -574,6 +1394,7 @@ COMMENT ON COLUMN ip_net_asn.name IS 'ASN name';
 CREATE TABLE ip_net_vrf (
 	id serial PRIMARY KEY,
 	rt text,
+	rt_order bigint,
 	name text NOT NULL,
 	description text,
 	num_prefixes_v4 numeric(40) DEFAULT 0,
@@ -598,11 +1419,14 @@ INSERT INTO ip_net_vrf (id, rt, name, description) VALUES (0, NULL, 'default', '
 
 CREATE UNIQUE INDEX ip_net_vrf__rt__index ON ip_net_vrf (rt) WHERE rt IS NOT NULL;
 CREATE UNIQUE INDEX ip_net_vrf__name__index ON ip_net_vrf (lower(name)) WHERE name IS NOT NULL;
+CREATE INDEX ip_net_vrf__rt_order__index ON ip_net_vrf (rt_order NULLS FIRST);
 
 COMMENT ON TABLE ip_net_vrf IS 'IP Address VRFs';
 COMMENT ON INDEX ip_net_vrf__rt__index IS 'VRF RT';
 COMMENT ON INDEX ip_net_vrf__name__index IS 'VRF name';
+COMMENT ON INDEX ip_net_vrf__rt_order__index IS 'VRF RT order';
 COMMENT ON COLUMN ip_net_vrf.rt IS 'VRF RT';
+COMMENT ON COLUMN ip_net_vrf.rt_order IS 'VRF RT as a number to sort on, see vrf_rt_order()';
 COMMENT ON COLUMN ip_net_vrf.name IS 'VRF name';
 COMMENT ON COLUMN ip_net_vrf.description IS 'VRF description';
 COMMENT ON COLUMN ip_net_vrf.num_prefixes_v4 IS 'Number of IPv4 prefixes in this VRF';
@@ -644,6 +1468,9 @@ CREATE TABLE ip_net_pool (
 	free_prefixes_v6 numeric(40) DEFAULT NULL,
 	total_prefixes_v4 numeric(40) DEFAULT NULL,
 	total_prefixes_v6 numeric(40) DEFAULT NULL,
+	allocation_strategy ip_net_pool_allocation_strategy NOT NULL DEFAULT 'first-fit',
+	allocation_cursor_v4 cidr,
+	allocation_cursor_v6 cidr,
 	tags text[] DEFAULT '{}',
 	avps hstore NOT NULL DEFAULT ''
 );
@@ -674,6 +1501,9 @@ COMMENT ON COLUMN ip_net_pool.free_prefixes_v4 IS 'Number of potentially free IP
 COMMENT ON COLUMN ip_net_pool.free_prefixes_v6 IS 'Number of potentially free IPv6 prefixes of the default assignment size';
 COMMENT ON COLUMN ip_net_pool.total_prefixes_v4 IS 'Potentially the total number of IPv4 child prefixes in pool. This is based on current number of childs and potential childs of the default assignment size, which is why it can vary.';
 COMMENT ON COLUMN ip_net_pool.total_prefixes_v6 IS 'Potentially the total number of IPv6 child prefixes in pool. This is based on current number of childs and potential childs of the default assignment size, which is why it can vary.';
+COMMENT ON COLUMN ip_net_pool.allocation_strategy IS 'How free prefixes are picked when allocating from the pool; first-fit, next-fit or sparse';
+COMMENT ON COLUMN ip_net_pool.allocation_cursor_v4 IS 'Last IPv4 prefix allocated from the pool, where next-fit allocation resumes';
+COMMENT ON COLUMN ip_net_pool.allocation_cursor_v6 IS 'Last IPv6 prefix allocated from the pool, where next-fit allocation resumes';
 COMMENT ON COLUMN ip_net_pool.tags IS 'Tags associated with the pool';
 
 
@@ -695,7 +1525,7 @@ CREATE TABLE ip_net_plan (
 	node text,
 	pool_id integer REFERENCES ip_net_pool (id) ON UPDATE CASCADE ON DELETE SET NULL,
 	type ip_net_plan_type NOT NULL,
-	indent integer,
+	parent_id integer,
 	country text,
 	order_id text,
 	customer_id text,
@@ -703,15 +1533,11 @@ CREATE TABLE ip_net_plan (
 	authoritative_source text NOT NULL DEFAULT 'nipap',
 	alarm_priority priority_5step,
 	monitor boolean,
-	children integer,
 	vlan integer,
 	tags text[] DEFAULT '{}',
 	inherited_tags text[] DEFAULT '{}',
 	added timestamp with time zone DEFAULT NOW(),
 	last_modified timestamp with time zone DEFAULT NOW(),
-	total_addresses numeric(40),
-	used_addresses numeric(40),
-	free_addresses numeric(40),
 	status ip_net_plan_status NOT NULL DEFAULT 'assigned',
 	avps hstore NOT NULL DEFAULT '',
 	expires timestamp with time zone DEFAULT 'infinity'
@@ -727,7 +1553,7 @@ COMMENT ON COLUMN ip_net_plan.comment IS 'Comment!';
 COMMENT ON COLUMN ip_net_plan.node IS 'Name of the node, typically the hostname or FQDN of the node (router/switch/host) on which the address is configured';
 COMMENT ON COLUMN ip_net_plan.pool_id IS 'Pool that this prefix is part of';
 COMMENT ON COLUMN ip_net_plan.type IS 'Type is one of "reservation", "assignment" or "host"';
-COMMENT ON COLUMN ip_net_plan.indent IS 'Number of indents to properly render this prefix';
+COMMENT ON COLUMN ip_net_plan.parent_id IS 'Direct parent prefix, NULL for top level prefixes';
 COMMENT ON COLUMN ip_net_plan.country IS 'ISO3166-1 two letter country code';
 COMMENT ON COLUMN ip_net_plan.order_id IS 'Order identifier';
 COMMENT ON COLUMN ip_net_plan.customer_id IS 'Customer identifier';
@@ -735,15 +1561,11 @@ COMMENT ON COLUMN ip_net_plan.external_key IS 'Field for use by exernal systems
 COMMENT ON COLUMN ip_net_plan.authoritative_source IS 'The authoritative source for information regarding this prefix';
 COMMENT ON COLUMN ip_net_plan.alarm_priority IS 'Priority of alarms sent for this prefix to NetWatch.';
 COMMENT ON COLUMN ip_net_plan.monitor IS 'Whether the prefix should be monitored or not.';
-COMMENT ON COLUMN ip_net_plan.children IS 'Number of direct sub-prefixes';
 COMMENT ON COLUMN ip_net_plan.vlan IS 'VLAN ID';
 COMMENT ON COLUMN ip_net_plan.tags IS 'Tags associated with the prefix';
 COMMENT ON COLUMN ip_net_plan.inherited_tags IS 'Tags inherited from parent (and grand-parent) prefixes';
 COMMENT ON COLUMN ip_net_plan.added IS 'The date and time when the prefix was added';
 COMMENT ON COLUMN ip_net_plan.last_modified IS 'The date and time when the prefix was last modified';
-COMMENT ON COLUMN ip_net_plan.total_addresses IS 'Total number of addresses in this prefix';
-COMMENT ON COLUMN ip_net_plan.used_addresses IS 'Number of used addresses in this prefix';
-COMMENT ON COLUMN ip_net_plan.free_addresses IS 'Number of free addresses in this prefix';
 COMMENT ON COLUMN ip_net_plan.avps IS 'Extra values / AVPs (Attribute Value Pairs)';
 COMMENT ON COLUMN ip_net_plan.expires IS 'Expire time of prefix';
 
@@ -754,9 +1576,88 @@ CREATE INDEX ip_net_plan__node__index ON ip_net_plan (node);
 CREATE INDEX ip_net_plan__family__index ON ip_net_plan (family(prefix));
 CREATE INDEX ip_net_plan__prefix_iprange_index ON ip_net_plan USING gist(iprange(prefix));
 CREATE INDEX ip_net_plan__pool_id__index ON ip_net_plan (pool_id);
+CREATE INDEX ip_net_plan__parent_id__index ON ip_net_plan (parent_id);
+CREATE INDEX ip_net_plan__inherited_tags__index ON ip_net_plan USING gin(inherited_tags);
 
 COMMENT ON INDEX ip_net_plan__vrf_id_prefix__index IS 'prefix';
 
+--
+-- Prefix ancestors
+--
+-- All prefixes covering a prefix, not only its direct parent. Kept up to date
+-- by the triggers on ip_net_plan so that a prefix added or removed in the
+-- middle of the tree only needs to update the parent of its direct children,
+-- while the indent of a prefix is the number of its ancestors.
+--
+CREATE TABLE ip_net_plan_ancestor (
+	prefix_id integer NOT NULL REFERENCES ip_net_plan (id) ON UPDATE CASCADE ON DELETE CASCADE,
+	ancestor_id integer NOT NULL REFERENCES ip_net_plan (id) ON UPDATE CASCADE ON DELETE CASCADE,
+	PRIMARY KEY (prefix_id, ancestor_id)
+);
+
+CREATE INDEX ip_net_plan_ancestor__ancestor_id__index ON ip_net_plan_ancestor (ancestor_id);
+
+COMMENT ON TABLE ip_net_plan_ancestor IS 'Ancestors of prefixes';
+
+COMMENT ON COLUMN ip_net_plan_ancestor.prefix_id IS 'Prefix';
+COMMENT ON COLUMN ip_net_plan_ancestor.ancestor_id IS 'Prefix covering prefix_id';
+
+
+--
+-- Prefix statistics
+--
+-- The statistics of prefixes which change as prefixes are added and removed
+-- below them. They are kept apart from the wide ip_net_plan rows so that
+-- adding a prefix only rewrites the narrow row of its parent, leaving room
+-- on the page for the new row version. The VRF, pool and family of the prefix
+-- and whether it is top level are kept along with them, so that the VRF and
+-- pool statistics add up over this table alone.
+--
+CREATE TABLE ip_net_plan_stats (
+	prefix_id integer PRIMARY KEY REFERENCES ip_net_plan (id) ON UPDATE CASCADE ON DELETE CASCADE,
+	vrf_id integer NOT NULL,
+	pool_id integer,
+	family integer NOT NULL,
+	top_level boolean NOT NULL,
+	children integer NOT NULL DEFAULT 0,
+	total_addresses numeric(40) NOT NULL,
+	used_addresses numeric(40) NOT NULL,
+	free_addresses numeric(40) NOT NULL,
+	free_prefixes numeric(40)
+) WITH (fillfactor = 50);
+
+COMMENT ON TABLE ip_net_plan_stats IS 'Statistics of prefixes';
+
+COMMENT ON COLUMN ip_net_plan_stats.prefix_id IS 'Prefix';
+COMMENT ON COLUMN ip_net_plan_stats.vrf_id IS 'VRF in which the prefix resides';
+COMMENT ON COLUMN ip_net_plan_stats.pool_id IS 'Pool that the prefix is part of';
+COMMENT ON COLUMN ip_net_plan_stats.family IS 'Address family of the prefix';
+COMMENT ON COLUMN ip_net_plan_stats.top_level IS 'Whether the prefix lacks a parent prefix';
+COMMENT ON COLUMN ip_net_plan_stats.children IS 'Number of direct sub-prefixes';
+COMMENT ON COLUMN ip_net_plan_stats.total_addresses IS 'Total number of addresses in the prefix';
+COMMENT ON COLUMN ip_net_plan_stats.used_addresses IS 'Number of used addresses in the prefix';
+COMMENT ON COLUMN ip_net_plan_stats.free_addresses IS 'Number of free addresses in the prefix';
+COMMENT ON COLUMN ip_net_plan_stats.free_prefixes IS 'Number of free prefixes of the default assignment size of the pool, for pool members';
+
+--
+-- Free ranges
+--
+-- Ranges of addresses within a prefix which are not covered by any of its
+-- child prefixes. The ranges are kept up to date by the triggers on
+-- ip_net_plan and are used when allocating new prefixes and when counting
+-- the number of free prefixes in a pool.
+--
+CREATE TABLE ip_net_free_range (
+	prefix_id integer NOT NULL REFERENCES ip_net_plan (id) ON UPDATE CASCADE ON DELETE CASCADE,
+	free_range iprange NOT NULL,
+	PRIMARY KEY (prefix_id, free_range)
+);
+
+COMMENT ON TABLE ip_net_free_range IS 'Free address ranges within prefixes';
+
+COMMENT ON COLUMN ip_net_free_range.prefix_id IS 'Prefix in which the range is free';
+COMMENT ON COLUMN ip_net_free_range.free_range IS 'Range of addresses not covered by any child prefix';
+
 --
 -- Audit log table
 --
@@ -823,7 +1724,9 @@ triggers = """
 
 --
 -- Trigger function to validate VRF input, prominently the RT attribute which
--- needs to follow the allowed formats
+-- needs to follow the allowed formats. The RT is also stored as a number in
+-- rt_order, as calculated by vrf_rt_order(), for VRFs and their prefixes to
+-- be sorted on.
 --
 CREATE OR REPLACE FUNCTION tf_ip_net_vrf_iu_before() RETURNS trigger AS $_$
 DECLARE
@@ -837,6 +1740,7 @@ BEGIN
 		IF NEW.rt IS NOT NULL THEN
 			RAISE EXCEPTION 'Invalid input for column rt, must be NULL for VRF id 0';
 		END IF;
+		NEW.rt_order := NULL;
 	ELSE -- make sure all VRF except for VRF id 0 has a proper RT
 		-- make sure we only have two fields delimited by a colon
 		IF (SELECT COUNT(1) FROM regexp_matches(NEW.rt, '(:)', 'g')) != 1 THEN
@@ -891,6 +1795,8 @@ BEGIN
 		ELSE
 			RAISE EXCEPTION '1200:Invalid input for column rt, should be ASN:id (123:456) or IP:id (1.3.3.7:456)';
 		END IF;
+
+		NEW.rt_order := (rt_part_one::bigint << 32) + rt_part_two::bigint;
 	END IF;
 
 	RETURN NEW;
@@ -924,8 +1830,6 @@ DECLARE
 	new_parent RECORD;
 	child RECORD;
 	i_max_pref_len integer;
-	p RECORD;
-	num_used numeric(40);
 BEGIN
 	-- this is a shortcut to avoid running the rest of this trigger as it
 	-- can be fairly costly performance wise
@@ -1057,80 +1961,6 @@ BEGIN
 	END IF;
 
 
-	--
-	---- Calculate indent for new prefix ---------------------------------------
-	--
-	-- Trigger on: vrf_id, prefix
-	--
-	-- use parent prefix indent+1 or if parent is not set, it means we are a
-	-- top level prefix and we use indent 0
-	NEW.indent := COALESCE(new_parent.indent+1, 0);
-
-
-	--
-	---- Statistics ------------------------------------------------------------
-	--
-	-- Trigger on: vrf_id, prefix
-	--
-
-	-- total addresses
-	IF family(NEW.prefix) = 4 THEN
-		NEW.total_addresses = power(2::numeric, 32 - masklen(NEW.prefix));
-	ELSE
-		NEW.total_addresses = power(2::numeric, 128 - masklen(NEW.prefix));
-	END IF;
-
-	-- used addresses
-	-- special case for hosts
-	IF masklen(NEW.prefix) = i_max_pref_len THEN
-		NEW.used_addresses := NEW.total_addresses;
-	ELSE
-		num_used := 0;
-		IF TG_OP = 'INSERT' THEN
-			FOR p IN (SELECT * FROM ip_net_plan WHERE prefix << NEW.prefix AND vrf_id = NEW.vrf_id AND indent = COALESCE(new_parent.indent+1, 0) ORDER BY prefix ASC) LOOP
-				num_used := num_used + (SELECT power(2::numeric, i_max_pref_len-masklen(p.prefix)))::numeric(39);
-			END LOOP;
-		ELSIF TG_OP = 'UPDATE' THEN
-			IF OLD.prefix = NEW.prefix THEN
-				-- No change - keep old value
-				num_used := OLD.used_addresses;
-			ELSIF NEW.prefix << OLD.prefix AND OLD.indent = NEW.indent THEN -- NEW is smaller and covered by OLD
-				FOR p IN (SELECT * FROM ip_net_plan WHERE prefix << NEW.prefix AND vrf_id = NEW.vrf_id AND indent = NEW.indent+1 ORDER BY prefix ASC) LOOP
-					num_used := num_used + (SELECT power(2::numeric, i_max_pref_len-masklen(p.prefix)))::numeric(39);
-				END LOOP;
-			ELSIF NEW.prefix << OLD.prefix THEN -- NEW is smaller and covered by OLD
-				--
-				FOR p IN (SELECT * FROM ip_net_plan WHERE prefix << NEW.prefix AND vrf_id = NEW.vrf_id AND indent = NEW.indent ORDER BY prefix ASC) LOOP
-					num_used := num_used + (SELECT power(2::numeric, i_max_pref_len-masklen(p.prefix)))::numeric(39);
-				END LOOP;
-			ELSIF NEW.prefix >> OLD.prefix AND OLD.indent = NEW.indent THEN -- NEW is larger and covers OLD, but same indent
-				-- since the new prefix covers the old prefix but the indent
-				-- hasn't been updated yet, we will see child prefixes with
-				-- OLD.indent + 1 and then the part that is now covered by
-				-- NEW.prefix but wasn't covered by OLD.prefix will have
-				-- indent = NEW.indent ( to be NEW.indent+1 after update)
-				FOR p IN (SELECT * FROM ip_net_plan WHERE vrf_id = NEW.vrf_id AND prefix != OLD.prefix AND ((indent = OLD.indent+1 AND prefix << OLD.prefix) OR indent = NEW.indent AND prefix << NEW.prefix) ORDER BY prefix ASC) LOOP
-					num_used := num_used + (SELECT power(2::numeric, i_max_pref_len-masklen(p.prefix)))::numeric(39);
-				END LOOP;
-
-			ELSIF NEW.prefix >> OLD.prefix THEN -- NEW is larger and covers OLD but with different indent
-				FOR p IN (SELECT * FROM ip_net_plan WHERE vrf_id = NEW.vrf_id AND prefix != OLD.prefix AND (indent = NEW.indent AND prefix << NEW.prefix) ORDER BY prefix ASC) LOOP
-					num_used := num_used + (SELECT power(2::numeric, i_max_pref_len-masklen(p.prefix)))::numeric(39);
-				END LOOP;
-			ELSE -- prefix has been moved and doesn't cover or is covered by OLD
-				FOR p IN (SELECT * FROM ip_net_plan WHERE vrf_id = NEW.vrf_id AND prefix << NEW.prefix AND indent = COALESCE(new_parent.indent+1, 0) ORDER BY prefix ASC) LOOP
-					num_used := num_used + (SELECT power(2::numeric, i_max_pref_len-masklen(p.prefix)))::numeric(39);
-				END LOOP;
-
-			END IF;
-		END IF;
-		NEW.used_addresses = num_used;
-	END IF;
-
-	-- free addresses
-	NEW.free_addresses := NEW.total_addresses - NEW.used_addresses;
-
-
 	--
 	---- Inherited Tags --------------------------------------------------------
 	-- Update inherited tags
@@ -1189,19 +2019,13 @@ $_$ LANGUAGE plpgsql;
 
 
 --
--- Trigger function to set indent and children on the new prefix.
+-- Trigger function to set the parent of the new prefix.
 --
-CREATE OR REPLACE FUNCTION tf_ip_net_plan__indent_children__iu_before() RETURNS trigger AS $_$
-DECLARE
-	new_parent record;
+CREATE OR REPLACE FUNCTION tf_ip_net_plan__parent_children__iu_before() RETURNS trigger AS $_$
 BEGIN
-	SELECT * INTO new_parent FROM ip_net_plan WHERE vrf_id = NEW.vrf_id AND iprange(prefix) >> iprange(NEW.prefix) ORDER BY prefix DESC LIMIT 1;
-
-	IF TG_OP = 'UPDATE' THEN
-		NEW.children := (SELECT COUNT(1) FROM ip_net_plan WHERE vrf_id = NEW.vrf_id AND iprange(prefix) << iprange(NEW.prefix) AND prefix != OLD.prefix AND indent = COALESCE(new_parent.indent+1, 1));
-	ELSE
-		NEW.children := (SELECT COUNT(1) FROM ip_net_plan WHERE vrf_id = NEW.vrf_id AND iprange(prefix) << iprange(NEW.prefix) AND indent = COALESCE(new_parent.indent+1, 0));
-	END IF;
+	-- The parent is the smallest prefix covering the new prefix. For an
+	-- UPDATE the old prefix is still in the table and must not be picked.
+	NEW.parent_id := (SELECT id FROM ip_net_plan WHERE vrf_id = NEW.vrf_id AND iprange(prefix) >> iprange(NEW.prefix) AND id != NEW.id ORDER BY masklen(prefix) DESC LIMIT 1);
 
 	RETURN NEW;
 END;
@@ -1215,20 +2039,8 @@ CREATE OR REPLACE FUNCTION tf_ip_net_plan__prefix_iu_after() RETURNS trigger AS
 DECLARE
 	old_parent RECORD;
 	new_parent RECORD;
-	old_parent_pool RECORD;
-	new_parent_pool RECORD;
-	child RECORD;
-	i_max_pref_len integer;
-	p RECORD;
-	free_prefixes numeric(40);
+	new_inherited_tags text[];
 BEGIN
-	i_max_pref_len := 32;
-	IF TG_OP IN ('INSERT', 'UPDATE') THEN
-		IF family(NEW.prefix) = 6 THEN
-			i_max_pref_len := 128;
-		END IF;
-	END IF;
-
 	--
 	-- get old and new parents
 	--
@@ -1259,71 +2071,86 @@ BEGIN
 		ORDER BY prefix DESC LIMIT 1;
 	END IF;
 
-	-- store old and new parents pool
-	IF TG_OP IN ('DELETE', 'UPDATE') THEN
-		SELECT * INTO old_parent_pool FROM ip_net_pool WHERE id = old_parent.pool_id;
-	END IF;
-	IF TG_OP IN ('INSERT', 'UPDATE') THEN
-		SELECT * INTO new_parent_pool FROM ip_net_pool WHERE id = new_parent.pool_id;
-	END IF;
-
 	--
-	---- indent ----------------------------------------------------------------
+	---- parent and ancestors --------------------------------------------------
 	--
-	-- Trigger on: vrf_id, prefix
+	-- Trigger on: prefix
+	--
+	-- A removed prefix hands its children over to its parent and an added
+	-- prefix takes over the children of its parent that it covers. A changed
+	-- prefix is first removed and then added back, though its children which
+	-- it still covers are left alone. Only the direct children get a new
+	-- parent; the prefixes further down merely get an ancestor added or
+	-- removed in ip_net_plan_ancestor, from which their indent is derived.
+	--
+	-- The old and new parent are used rather than OLD.parent_id and
+	-- NEW.parent_id as the latter might have been removed by the same
+	-- statement.
 	--
 	IF TG_OP = 'DELETE' THEN
-		-- remove one indentation level where the old prefix used to be
-		PERFORM calc_indent(OLD.vrf_id, OLD.prefix, -1);
-	ELSIF TG_OP = 'INSERT' THEN
-		-- add one indentation level to where the new prefix is
-		PERFORM calc_indent(NEW.vrf_id, NEW.prefix, 1);
+		UPDATE ip_net_plan SET parent_id = old_parent.id WHERE parent_id = OLD.id;
 	ELSIF TG_OP = 'UPDATE' AND OLD.prefix != NEW.prefix THEN
-		-- remove one indentation level where the old prefix used to be
-		PERFORM calc_indent(OLD.vrf_id, OLD.prefix, -1);
-		-- add one indentation level to where the new prefix is
-		PERFORM calc_indent(NEW.vrf_id, NEW.prefix, 1);
+		UPDATE ip_net_plan SET parent_id = old_parent.id WHERE parent_id = OLD.id
+			AND NOT (iprange(prefix) << iprange(NEW.prefix) AND old_parent.id IS NOT DISTINCT FROM new_parent.id);
+		DELETE FROM ip_net_plan_ancestor WHERE prefix_id = OLD.id OR ancestor_id = OLD.id;
+	END IF;
+
+	IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND OLD.prefix != NEW.prefix) THEN
+		INSERT INTO ip_net_plan_ancestor (prefix_id, ancestor_id)
+			SELECT NEW.id, id FROM ip_net_plan WHERE vrf_id = NEW.vrf_id AND iprange(prefix) >> iprange(NEW.prefix)
+			UNION ALL
+			SELECT id, NEW.id FROM ip_net_plan WHERE vrf_id = NEW.vrf_id AND iprange(prefix) << iprange(NEW.prefix)
+			-- added by a prefix inserted in the same statement
+			EXCEPT
+			SELECT prefix_id, ancestor_id FROM ip_net_plan_ancestor WHERE prefix_id = NEW.id OR ancestor_id = NEW.id;
+
+		-- All rows of a statement are in the table by the time the AFTER
+		-- triggers fire while the BEFORE trigger only saw the rows added
+		-- before it, so with several nested prefixes added at once the parent
+		-- found then might not be the closest one. The covered prefixes to
+		-- take over are the ones whose parent is an ancestor of the new
+		-- prefix, or who lack a parent, for the same reason. The parent might
+		-- also have had its inherited tags recalculated since.
+		new_inherited_tags := COALESCE(array_undup(array_cat(new_parent.inherited_tags, new_parent.tags)), '{}');
+		UPDATE ip_net_plan SET
+			parent_id = new_parent.id,
+			inherited_tags = new_inherited_tags
+			WHERE id = NEW.id
+				AND (parent_id IS DISTINCT FROM new_parent.id
+					OR NOT (inherited_tags @> new_inherited_tags AND inherited_tags <@ new_inherited_tags));
+		UPDATE ip_net_plan SET parent_id = NEW.id
+			WHERE vrf_id = NEW.vrf_id
+				AND iprange(prefix) << iprange(NEW.prefix)
+				AND (parent_id IS NULL OR parent_id IN (SELECT ancestor_id FROM ip_net_plan_ancestor WHERE prefix_id = NEW.id));
 	END IF;
 
 
 	--
-	---- children ----------------------------------------------------------------
+	---- free ranges -----------------------------------------------------------
 	--
-	-- Trigger on: vrf_id, prefix
+	-- Trigger on: prefix
 	--
-	-- This only sets the number of children prefix for the old or new parent
-	-- prefix. The number of children for the prefix being modified is
-	-- calculated in the before trigger.
+	-- Only the part of the old and new parent covered by the old and new
+	-- prefix is recalculated, splitting or merging the free ranges around it.
+	-- The free ranges of the prefix itself are calculated in full.
 	--
-	-- NOTE: this is dependent upon indent already being correctly set
-	-- NOTE: old and new parent needs to be set
+	-- NOTE: this is dependent upon parent_id already being correctly set
 	--
-	IF TG_OP IN ('DELETE', 'UPDATE') THEN
-		-- do we have a old parent? if not, this is a top level prefix and we
-		-- have no parent to update children count for!
+	IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.prefix != NEW.prefix) THEN
 		IF old_parent.id IS NOT NULL THEN
-			UPDATE ip_net_plan SET children =
-					(SELECT COUNT(1)
-					FROM ip_net_plan
-					WHERE vrf_id = OLD.vrf_id
-						AND iprange(prefix) << iprange(old_parent.prefix)
-						AND indent = old_parent.indent+1)
-				WHERE id = old_parent.id;
+			PERFORM calc_free_ranges(old_parent.id, iprange(OLD.prefix));
 		END IF;
 	END IF;
 
-	IF TG_OP IN ('INSERT', 'UPDATE') THEN
-		-- do we have a new parent? if not, this is a top level prefix and we
-		-- have no parent to update children count for!
+	IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND OLD.prefix != NEW.prefix) THEN
 		IF new_parent.id IS NOT NULL THEN
-			UPDATE ip_net_plan SET children =
-					(SELECT COUNT(1)
-					FROM ip_net_plan
-					WHERE vrf_id = NEW.vrf_id
-						AND iprange(prefix) << iprange(new_parent.prefix)
-						AND indent = new_parent.indent+1)
-				WHERE id = new_parent.id;
+			PERFORM calc_free_ranges(new_parent.id, iprange(NEW.prefix));
 		END IF;
+
+		IF TG_OP = 'UPDATE' THEN
+			DELETE FROM ip_net_free_range WHERE prefix_id = NEW.id;
+		END IF;
+		PERFORM calc_free_ranges(NEW.id, iprange(NEW.prefix));
 	END IF;
 
 
@@ -1344,277 +2171,344 @@ BEGIN
 
 
 	--
-	---- Prefix statistics -----------------------------------------------------
+	---- Inherited Tags --------------------------------------------------------
+	-- Update inherited tags
 	--
-	-- Trigger on: vrf_id, prefix
+	-- Trigger: prefix, tags
+	--
+	-- The prefixes covered by the old prefix lose it as an ancestor while
+	-- those covered by the new prefix gain it, so the inherited tags of
+	-- both subtrees are recalculated. calc_tags handles the whole subtree
+	-- at once, which is why a change to the inherited tags does not fire
+	-- this trigger.
 	--
-
-	-- update old and new parent
 	IF TG_OP = 'DELETE' THEN
-		-- do we have a old parent? if not, this is a top level prefix and we
-		-- have no parent to update children count for!
-		IF old_parent.id IS NOT NULL THEN
-			-- update old parent's used and free addresses to account for the
-			-- removal of 'this' prefix while increasing for previous indirect
-			-- children that are now direct children of old parent
-			UPDATE ip_net_plan SET
-				used_addresses = old_parent.used_addresses - (OLD.total_addresses - CASE WHEN masklen(OLD.prefix) = i_max_pref_len THEN 0 ELSE OLD.used_addresses END),
-				free_addresses = total_addresses - (old_parent.used_addresses - (OLD.total_addresses - CASE WHEN masklen(OLD.prefix) = i_max_pref_len THEN 0 ELSE OLD.used_addresses END))
-				WHERE id = old_parent.id;
-		END IF;
+		PERFORM calc_tags(OLD.vrf_id, OLD.prefix);
 	ELSIF TG_OP = 'INSERT' THEN
-		-- do we have a new parent? if not, this is a top level prefix and we
-		-- have no parent to update children count for!
-		IF new_parent.id IS NOT NULL THEN
-			-- update new parent's used and free addresses to account for the
-			-- addition of 'this' prefix while decreasing for previous direct
-			-- children that are now covered by 'this'
-			UPDATE ip_net_plan SET
-				used_addresses = new_parent.used_addresses + (NEW.total_addresses - CASE WHEN masklen(NEW.prefix) = i_max_pref_len THEN 0 ELSE NEW.used_addresses END),
-				free_addresses = total_addresses - (new_parent.used_addresses + (NEW.total_addresses - CASE WHEN masklen(NEW.prefix) = i_max_pref_len THEN 0 ELSE NEW.used_addresses END))
-				WHERE id = new_parent.id;
-		END IF;
+		PERFORM calc_tags(NEW.vrf_id, NEW.prefix);
 	ELSIF TG_OP = 'UPDATE' THEN
 		IF OLD.prefix != NEW.prefix THEN
-			IF old_parent.id = new_parent.id THEN
-				UPDATE ip_net_plan SET
-					used_addresses = (new_parent.used_addresses - (OLD.total_addresses - CASE WHEN masklen(OLD.prefix) = i_max_pref_len THEN 0 ELSE OLD.used_addresses END)) + (NEW.total_addresses - CASE WHEN masklen(NEW.prefix) = i_max_pref_len THEN 0 ELSE NEW.used_addresses END),
-					free_addresses = total_addresses - ((new_parent.used_addresses - (OLD.total_addresses - CASE WHEN masklen(OLD.prefix) = i_max_pref_len THEN 0 ELSE OLD.used_addresses END)) + (NEW.total_addresses - CASE WHEN masklen(NEW.prefix) = i_max_pref_len THEN 0 ELSE NEW.used_addresses END))
-					WHERE id = new_parent.id;
-			ELSE
-				IF old_parent.id IS NOT NULL THEN
-					-- update old parent's used and free addresses to account for the
-					-- removal of 'this' prefix while increasing for previous indirect
-					-- children that are now direct children of old parent
-					UPDATE ip_net_plan SET
-						used_addresses = old_parent.used_addresses - (OLD.total_addresses - CASE WHEN masklen(OLD.prefix) = i_max_pref_len THEN 0 ELSE OLD.used_addresses END),
-						free_addresses = total_addresses - (old_parent.used_addresses - (OLD.total_addresses - CASE WHEN masklen(OLD.prefix) = i_max_pref_len THEN 0 ELSE OLD.used_addresses END))
-						WHERE id = old_parent.id;
-				END IF;
-				IF new_parent.id IS NOT NULL THEN
-					-- update new parent's used and free addresses to account for the
-					-- addition of 'this' prefix while decreasing for previous direct
-					-- children that are now covered by 'this'
-					UPDATE ip_net_plan SET
-						used_addresses = new_parent.used_addresses + (NEW.total_addresses - CASE WHEN masklen(NEW.prefix) = i_max_pref_len THEN 0 ELSE NEW.used_addresses END),
-						free_addresses = total_addresses - (new_parent.used_addresses + (NEW.total_addresses - CASE WHEN masklen(NEW.prefix) = i_max_pref_len THEN 0 ELSE NEW.used_addresses END))
-						WHERE id = new_parent.id;
-				END IF;
-			END IF;
+			PERFORM calc_tags(OLD.vrf_id, OLD.prefix);
 		END IF;
+		PERFORM calc_tags(NEW.vrf_id, NEW.prefix);
 	END IF;
 
 
-	--
-	---- VRF statistics --------------------------------------------------------
-	--
-	-- Trigger on: vrf_id, prefix, indent, used_addresses
-	--
+	-- all is well, return
+	RETURN NEW;
+END;
+$_$ LANGUAGE plpgsql;
 
-	-- update number of prefixes in VRF
-	IF TG_OP = 'DELETE' THEN
-		IF family(OLD.prefix) = 4 THEN
-			UPDATE ip_net_vrf SET num_prefixes_v4 = num_prefixes_v4 - 1 WHERE id = OLD.vrf_id;
-		ELSE
-			UPDATE ip_net_vrf SET num_prefixes_v6 = num_prefixes_v6 - 1 WHERE id = OLD.vrf_id;
-		END IF;
-	ELSIF TG_OP = 'INSERT' THEN
-		IF family(NEW.prefix) = 4 THEN
-			UPDATE ip_net_vrf SET num_prefixes_v4 = num_prefixes_v4 + 1 WHERE id = NEW.vrf_id;
-		ELSE
-			UPDATE ip_net_vrf SET num_prefixes_v6 = num_prefixes_v6 + 1 WHERE id = NEW.vrf_id;
-		END IF;
+
+--
+-- Trigger function to update the statistics which add up the values of many
+-- prefixes; the children and used addresses of a parent prefix. It runs once
+-- per statement and applies the difference between the old and new versions
+-- of the rows changed by the statement, as found in the transition tables, so
+-- that adding or removing a whole subtree updates every parent once rather
+-- than once per prefix. The row
+-- level triggers hand over children with statements of their own, which in
+-- turn adjust the statistics the same way.
+--
+-- The statistics of prefixes are kept in ip_net_plan_stats, where the
+-- statistics of VRFs and pools follow from the changes made here, see
+-- tf_ip_net_plan_stats__stats_after(). The free prefixes of pool members
+-- follow their free ranges, see tf_ip_net_free_range__stats_after().
+--
+CREATE OR REPLACE FUNCTION tf_ip_net_plan__stats_after() RETURNS trigger AS $_$
+DECLARE
+	old_rows ip_net_plan[];
+	new_rows ip_net_plan[];
+BEGIN
+	IF TG_OP = 'INSERT' THEN
+		SELECT array_agg(n) INTO new_rows FROM new_prefixes AS n;
+	ELSIF TG_OP = 'DELETE' THEN
+		SELECT array_agg(o) INTO old_rows FROM old_prefixes AS o;
+	ELSE
+		-- Most UPDATEs do not touch any of the values the statistics depend
+		-- on. The query is planned for every statement, as a cached plan
+		-- would be made for the handful of rows changed by the statements of
+		-- the row level triggers and join large transition tables row by row.
+		EXECUTE 'SELECT array_agg(o), array_agg(n)
+			FROM old_prefixes AS o
+				JOIN new_prefixes AS n ON n.id = o.id
+			WHERE (o.vrf_id, o.prefix, o.parent_id, o.pool_id)
+				IS DISTINCT FROM (n.vrf_id, n.prefix, n.parent_id, n.pool_id)'
+			INTO old_rows, new_rows;
 	END IF;
-	-- update total / used / free addresses in VRF
-	IF TG_OP = 'UPDATE' AND OLD.indent = 0 AND NEW.indent = 0 AND (OLD.prefix != NEW.prefix OR OLD.used_addresses != NEW.used_addresses) THEN
-		-- we were and still are a top level prefix but used_addresses changed
-		IF family(OLD.prefix) = 4 THEN
-			UPDATE ip_net_vrf
-			SET
-				total_addresses_v4 = (total_addresses_v4 - OLD.total_addresses) + NEW.total_addresses,
-				used_addresses_v4 = (used_addresses_v4 - OLD.used_addresses) + NEW.used_addresses,
-				free_addresses_v4 = (free_addresses_v4 - OLD.free_addresses) + NEW.free_addresses
-			WHERE id = OLD.vrf_id;
-		ELSE
-			UPDATE ip_net_vrf
-			SET
-				total_addresses_v6 = (total_addresses_v6 - OLD.total_addresses) + NEW.total_addresses,
-				used_addresses_v6 = (used_addresses_v6 - OLD.used_addresses) + NEW.used_addresses,
-				free_addresses_v6 = (free_addresses_v6 - OLD.free_addresses) + NEW.free_addresses
-			WHERE id = OLD.vrf_id;
-		END IF;
-	ELSIF (TG_OP = 'DELETE' AND OLD.indent = 0) OR (TG_OP = 'UPDATE' AND NEW.indent > 0 AND OLD.indent = 0) THEN
-		-- we were a top level prefix and became a NON top level
-		IF family(OLD.prefix) = 4 THEN
-			UPDATE ip_net_vrf
-			SET
-				total_addresses_v4 = total_addresses_v4 - OLD.total_addresses,
-				used_addresses_v4 = used_addresses_v4 - OLD.used_addresses,
-				free_addresses_v4 = free_addresses_v4 - OLD.free_addresses
-			WHERE id = OLD.vrf_id;
-		ELSE
-			UPDATE ip_net_vrf
-			SET
-				total_addresses_v6 = total_addresses_v6 - OLD.total_addresses,
-				used_addresses_v6 = used_addresses_v6 - OLD.used_addresses,
-				free_addresses_v6 = free_addresses_v6 - OLD.free_addresses
-			WHERE id = OLD.vrf_id;
-		END IF;
-	ELSIF (TG_OP = 'INSERT' AND NEW.indent = 0) OR (TG_OP = 'UPDATE' AND OLD.indent > 0 AND NEW.indent = 0) THEN
-		-- we were a NON top level prefix and became a top level
-		IF family(NEW.prefix) = 4 THEN
-			UPDATE ip_net_vrf
-			SET
-				total_addresses_v4 = total_addresses_v4 + NEW.total_addresses,
-				used_addresses_v4 = used_addresses_v4 + NEW.used_addresses,
-				free_addresses_v4 = free_addresses_v4 + NEW.free_addresses
-			WHERE id = NEW.vrf_id;
-		ELSE
-			UPDATE ip_net_vrf
-			SET
-				total_addresses_v6 = total_addresses_v6 + NEW.total_addresses,
-				used_addresses_v6 = used_addresses_v6 + NEW.used_addresses,
-				free_addresses_v6 = free_addresses_v6 + NEW.free_addresses
-			WHERE id = NEW.vrf_id;
-		END IF;
+
+	-- the row level triggers run many statements which change nothing
+	IF old_rows IS NULL AND new_rows IS NULL THEN
+		RETURN NULL;
 	END IF;
 
+	-- The statistics of the prefixes themselves, where the current rows are
+	-- used as the row level triggers might have changed them since. A new
+	-- prefix which took over prefixes already got its statistics then, when
+	-- they were added to it below. The statistics of removed prefixes are
+	-- removed along with them.
 	--
-	---- Pool statistics -------------------------------------------------------
-	--
-	-- Update pool statistics
-	--
-
-	-- we are a member prefix of a pool, update pool total
-	IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND (OLD.pool_id IS DISTINCT FROM NEW.pool_id OR OLD.prefix != NEW.prefix)) THEN
-		free_prefixes := calc_pool_free_prefixes(OLD.pool_id, family(OLD.prefix));
-		IF family(OLD.prefix) = 4 THEN
-			UPDATE ip_net_pool
-			SET member_prefixes_v4 = member_prefixes_v4 - 1,
-				used_prefixes_v4 = used_prefixes_v4 - OLD.children,
-				free_prefixes_v4 = free_prefixes,
-				total_prefixes_v4 = (used_prefixes_v4 - OLD.children) + free_prefixes,
-				total_addresses_v4 = total_addresses_v4 - OLD.total_addresses,
-				free_addresses_v4 = free_addresses_v4 - OLD.free_addresses,
-				used_addresses_v4 = used_addresses_v4 - OLD.used_addresses
-			WHERE id = OLD.pool_id;
-		ELSE
-			UPDATE ip_net_pool
-			SET member_prefixes_v6 = member_prefixes_v6 - 1,
-				used_prefixes_v6 = used_prefixes_v6 - OLD.children,
-				free_prefixes_v6 = free_prefixes,
-				total_prefixes_v6 = (used_prefixes_v6 - OLD.children) + free_prefixes,
-				total_addresses_v6 = total_addresses_v6 - OLD.total_addresses,
-				free_addresses_v6 = free_addresses_v6 - OLD.free_addresses,
-				used_addresses_v6 = used_addresses_v6 - OLD.used_addresses
-			WHERE id = OLD.pool_id;
-		END IF;
-	END IF;
-	IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND (OLD.pool_id IS DISTINCT FROM NEW.pool_id OR OLD.prefix != NEW.prefix)) THEN
-		free_prefixes := calc_pool_free_prefixes(NEW.pool_id, family(NEW.prefix));
-		IF family(NEW.prefix) = 4 THEN
-			UPDATE ip_net_pool
-			SET member_prefixes_v4 = member_prefixes_v4 + 1,
-				used_prefixes_v4 = used_prefixes_v4 + NEW.children,
-				free_prefixes_v4 = free_prefixes,
-				total_prefixes_v4 = (used_prefixes_v4 + NEW.children) + free_prefixes,
-				total_addresses_v4 = total_addresses_v4 + NEW.total_addresses,
-				free_addresses_v4 = free_addresses_v4 + NEW.free_addresses,
-				used_addresses_v4 = used_addresses_v4 + NEW.used_addresses
-			WHERE id = NEW.pool_id;
-		ELSE
-			UPDATE ip_net_pool
-			SET member_prefixes_v6 = member_prefixes_v6 + 1,
-				used_prefixes_v6 = used_prefixes_v6 + NEW.children,
-				free_prefixes_v6 = free_prefixes,
-				total_prefixes_v6 = (used_prefixes_v6 + NEW.children) + free_prefixes,
-				total_addresses_v6 = total_addresses_v6 + NEW.total_addresses,
-				free_addresses_v6 = free_addresses_v6 + NEW.free_addresses,
-				used_addresses_v6 = used_addresses_v6 + NEW.used_addresses
-			WHERE id = NEW.pool_id;
-		END IF;
+	-- A prefix with all bits set in the netmask uses all of its addresses
+	-- while other prefixes use the addresses of their direct children, so the
+	-- addresses of the prefix itself are taken off once it becomes shorter.
+	-- The free prefixes are counted in the default prefix length of the pool
+	-- and have to be counted over when the prefix moves to another pool.
+	IF TG_OP = 'INSERT' THEN
+		INSERT INTO ip_net_plan_stats (prefix_id, vrf_id, pool_id, family, top_level, total_addresses, used_addresses, free_addresses, free_prefixes)
+		SELECT inp.id, inp.vrf_id, inp.pool_id, family(inp.prefix), inp.parent_id IS NULL,
+			size.total_addresses,
+			CASE WHEN size.host THEN size.total_addresses ELSE 0 END,
+			CASE WHEN size.host THEN 0 ELSE size.total_addresses END,
+			calc_prefix_free_prefixes(inp.id)
+		FROM unnest(new_rows) AS n
+			JOIN ip_net_plan AS inp ON (inp.id = n.id)
+			CROSS JOIN LATERAL (
+				SELECT power(2::numeric, CASE WHEN family(inp.prefix) = 4 THEN 32 ELSE 128 END - masklen(inp.prefix)) AS total_addresses,
+					masklen(inp.prefix) = CASE WHEN family(inp.prefix) = 4 THEN 32 ELSE 128 END AS host
+			) AS size
+		ON CONFLICT (prefix_id) DO NOTHING;
+	ELSIF TG_OP = 'UPDATE' THEN
+		UPDATE ip_net_plan_stats AS stats
+		SET vrf_id = chg.vrf_id,
+			pool_id = chg.pool_id,
+			family = chg.family,
+			top_level = chg.top_level,
+			total_addresses = chg.total_addresses,
+			used_addresses = CASE WHEN chg.host THEN chg.total_addresses
+				WHEN chg.old_host THEN stats.used_addresses - stats.total_addresses
+				ELSE stats.used_addresses END,
+			free_addresses = chg.total_addresses - CASE WHEN chg.host THEN chg.total_addresses
+				WHEN chg.old_host THEN stats.used_addresses - stats.total_addresses
+				ELSE stats.used_addresses END,
+			free_prefixes = CASE WHEN chg.pool_id IS DISTINCT FROM chg.old_pool_id OR chg.family != family(chg.old_prefix)
+				THEN calc_prefix_free_prefixes(chg.id)
+				ELSE stats.free_prefixes END
+		FROM (
+			SELECT inp.id, inp.vrf_id, inp.pool_id, family(inp.prefix) AS family, inp.parent_id IS NULL AS top_level,
+				power(2::numeric, CASE WHEN family(inp.prefix) = 4 THEN 32 ELSE 128 END - masklen(inp.prefix)) AS total_addresses,
+				masklen(inp.prefix) = CASE WHEN family(inp.prefix) = 4 THEN 32 ELSE 128 END AS host,
+				masklen(o.prefix) = CASE WHEN family(o.prefix) = 4 THEN 32 ELSE 128 END AS old_host,
+				o.pool_id AS old_pool_id, o.prefix AS old_prefix
+			FROM unnest(old_rows) AS o
+				JOIN ip_net_plan AS inp ON (inp.id = o.id)
+			) AS chg
+		WHERE stats.prefix_id = chg.id;
 	END IF;
 
-	-- we are the child of a pool, ie our parent prefix is a member of the pool, update used / free
-	IF (TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND OLD.prefix != NEW.prefix)) THEN
-		IF old_parent.pool_id IS NOT NULL THEN
-			free_prefixes := calc_pool_free_prefixes(old_parent.pool_id, family(old_parent.prefix));
-			IF family(OLD.prefix) = 4 THEN
-				UPDATE ip_net_pool
-				SET used_prefixes_v4 = used_prefixes_v4 - 1,
-					free_prefixes_v4 = free_prefixes,
-					total_prefixes_v4 = (used_prefixes_v4 - 1) + free_prefixes,
-					free_addresses_v4 = free_addresses_v4 + OLD.total_addresses,
-					used_addresses_v4 = used_addresses_v4 - OLD.total_addresses
-				WHERE id = old_parent_pool.id;
-			ELSE
-				UPDATE ip_net_pool
-				SET used_prefixes_v6 = used_prefixes_v6 - 1,
-					free_prefixes_v6 = free_prefixes,
-					total_prefixes_v6 = (used_prefixes_v6 - 1) + free_prefixes,
-					free_addresses_v6 = free_addresses_v6 + OLD.total_addresses,
-					used_addresses_v6 = used_addresses_v6 - OLD.total_addresses
-				WHERE id = old_parent_pool.id;
-			END IF;
-		END IF;
+	-- children and used addresses of parents, which are the addresses of
+	-- their direct children
+	WITH change AS (
+		SELECT 1 AS sign, * FROM unnest(new_rows)
+		UNION ALL
+		SELECT -1, * FROM unnest(old_rows)
+	), delta AS (
+		SELECT parent_id AS id,
+			SUM(sign) AS children,
+			SUM(sign * power(2::numeric, CASE WHEN family(prefix) = 4 THEN 32 ELSE 128 END - masklen(prefix))) AS used_addresses
+		FROM change
+		WHERE parent_id IS NOT NULL
+		GROUP BY parent_id
+	)
+	INSERT INTO ip_net_plan_stats AS stats (prefix_id, vrf_id, pool_id, family, top_level, children, total_addresses, used_addresses, free_addresses, free_prefixes)
+	SELECT inp.id, inp.vrf_id, inp.pool_id, family(inp.prefix), inp.parent_id IS NULL,
+		delta.children,
+		size.total_addresses,
+		delta.used_addresses,
+		size.total_addresses - delta.used_addresses,
+		calc_prefix_free_prefixes(inp.id)
+	FROM delta
+		-- parents removed by the same statement are gone
+		JOIN ip_net_plan AS inp ON (inp.id = delta.id)
+		CROSS JOIN LATERAL (
+			SELECT power(2::numeric, CASE WHEN family(inp.prefix) = 4 THEN 32 ELSE 128 END - masklen(inp.prefix)) AS total_addresses
+		) AS size
+	WHERE delta.children != 0 OR delta.used_addresses != 0
+	ON CONFLICT (prefix_id) DO UPDATE
+	SET children = stats.children + EXCLUDED.children,
+		used_addresses = stats.used_addresses + EXCLUDED.used_addresses,
+		free_addresses = stats.free_addresses - EXCLUDED.used_addresses;
+
+	RETURN NULL;
+END;
+$_$ LANGUAGE plpgsql;
+
+
+
+--
+-- Trigger function to update the statistics of VRFs and pools, which add up
+-- the statistics of their prefixes in ip_net_plan_stats. Like the statistics
+-- of the prefixes it runs once per statement and applies the difference
+-- between the old and new versions of the rows changed by the statement.
+--
+CREATE OR REPLACE FUNCTION tf_ip_net_plan_stats__stats_after() RETURNS trigger AS $_$
+DECLARE
+	old_rows ip_net_plan_stats[];
+	new_rows ip_net_plan_stats[];
+BEGIN
+	IF TG_OP = 'INSERT' THEN
+		SELECT array_agg(n) INTO new_rows FROM new_stats AS n;
+	ELSIF TG_OP = 'DELETE' THEN
+		SELECT array_agg(o) INTO old_rows FROM old_stats AS o;
+	ELSE
+		SELECT array_agg(o) INTO old_rows FROM old_stats AS o;
+		SELECT array_agg(n) INTO new_rows FROM new_stats AS n;
 	END IF;
-	IF (TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND OLD.prefix != NEW.prefix)) THEN
-		IF new_parent.pool_id IS NOT NULL THEN
-			free_prefixes := calc_pool_free_prefixes(new_parent.pool_id, family(new_parent.prefix));
-			IF family(NEW.prefix) = 4 THEN
-				UPDATE ip_net_pool
-				SET used_prefixes_v4 = used_prefixes_v4 + 1,
-					free_prefixes_v4 = free_prefixes,
-					total_prefixes_v4 = (used_prefixes_v4 + 1) + free_prefixes,
-					free_addresses_v4 = free_addresses_v4 - NEW.total_addresses,
-					used_addresses_v4 = used_addresses_v4 + NEW.total_addresses
-				WHERE id = new_parent_pool.id;
-			ELSE
-				UPDATE ip_net_pool
-				SET used_prefixes_v6 = used_prefixes_v6 + 1,
-					free_prefixes_v6 = free_prefixes,
-					total_prefixes_v6 = (used_prefixes_v6 + 1) + free_prefixes,
-					free_addresses_v6 = free_addresses_v6 - NEW.total_addresses,
-					used_addresses_v6 = used_addresses_v6 + NEW.total_addresses
-				WHERE id = new_parent_pool.id;
-			END IF;
-		END IF;
+
+	IF old_rows IS NULL AND new_rows IS NULL THEN
+		RETURN NULL;
 	END IF;
 
-	--
-	---- Inherited Tags --------------------------------------------------------
-	-- Update inherited tags
-	--
-	-- Trigger: prefix, tags, inherited_tags
-	--
-	IF TG_OP = 'DELETE' THEN
-		-- parent is NULL if we are top level
-		IF old_parent.id IS NULL THEN
-			-- calc tags from parent of the deleted prefix to what is now the
-			-- direct children of the parent prefix
-			PERFORM calc_tags(OLD.vrf_id, OLD.prefix);
-		ELSE
-			PERFORM calc_tags(OLD.vrf_id, old_parent.prefix);
-		END IF;
+	-- VRF statistics, where only top level prefixes count towards the
+	-- addresses
+	WITH change AS (
+		SELECT 1 AS sign, * FROM unnest(new_rows)
+		UNION ALL
+		SELECT -1, * FROM unnest(old_rows)
+	), delta AS (
+		SELECT vrf_id AS id,
+			SUM(CASE WHEN family = 4 THEN sign ELSE 0 END) AS num_prefixes_v4,
+			SUM(CASE WHEN family = 6 THEN sign ELSE 0 END) AS num_prefixes_v6,
+			SUM(CASE WHEN family = 4 AND top_level THEN sign * total_addresses ELSE 0 END) AS total_addresses_v4,
+			SUM(CASE WHEN family = 6 AND top_level THEN sign * total_addresses ELSE 0 END) AS total_addresses_v6,
+			SUM(CASE WHEN family = 4 AND top_level THEN sign * used_addresses ELSE 0 END) AS used_addresses_v4,
+			SUM(CASE WHEN family = 6 AND top_level THEN sign * used_addresses ELSE 0 END) AS used_addresses_v6,
+			SUM(CASE WHEN family = 4 AND top_level THEN sign * free_addresses ELSE 0 END) AS free_addresses_v4,
+			SUM(CASE WHEN family = 6 AND top_level THEN sign * free_addresses ELSE 0 END) AS free_addresses_v6
+		FROM change
+		GROUP BY vrf_id
+	)
+	UPDATE ip_net_vrf AS vrf
+	SET num_prefixes_v4 = vrf.num_prefixes_v4 + delta.num_prefixes_v4,
+		num_prefixes_v6 = vrf.num_prefixes_v6 + delta.num_prefixes_v6,
+		total_addresses_v4 = vrf.total_addresses_v4 + delta.total_addresses_v4,
+		total_addresses_v6 = vrf.total_addresses_v6 + delta.total_addresses_v6,
+		used_addresses_v4 = vrf.used_addresses_v4 + delta.used_addresses_v4,
+		used_addresses_v6 = vrf.used_addresses_v6 + delta.used_addresses_v6,
+		free_addresses_v4 = vrf.free_addresses_v4 + delta.free_addresses_v4,
+		free_addresses_v6 = vrf.free_addresses_v6 + delta.free_addresses_v6
+	FROM delta
+	WHERE vrf.id = delta.id
+		AND (delta.num_prefixes_v4, delta.num_prefixes_v6,
+			delta.total_addresses_v4, delta.total_addresses_v6,
+			delta.used_addresses_v4, delta.used_addresses_v6,
+			delta.free_addresses_v4, delta.free_addresses_v6)
+			!= (0, 0, 0, 0, 0, 0, 0, 0);
+
+	-- pool statistics, added up over the member prefixes
+	WITH change AS (
+		SELECT 1 AS sign, * FROM unnest(new_rows)
+		UNION ALL
+		SELECT -1, * FROM unnest(old_rows)
+	), delta AS (
+		SELECT pool_id AS id,
+			SUM(CASE WHEN family = 4 THEN sign ELSE 0 END) AS member_prefixes_v4,
+			SUM(CASE WHEN family = 6 THEN sign ELSE 0 END) AS member_prefixes_v6,
+			SUM(CASE WHEN family = 4 THEN sign * children ELSE 0 END) AS used_prefixes_v4,
+			SUM(CASE WHEN family = 6 THEN sign * children ELSE 0 END) AS used_prefixes_v6,
+			SUM(CASE WHEN family = 4 THEN sign * COALESCE(free_prefixes, 0) ELSE 0 END) AS free_prefixes_v4,
+			SUM(CASE WHEN family = 6 THEN sign * COALESCE(free_prefixes, 0) ELSE 0 END) AS free_prefixes_v6,
+			SUM(CASE WHEN family = 4 THEN sign * total_addresses ELSE 0 END) AS total_addresses_v4,
+			SUM(CASE WHEN family = 6 THEN sign * total_addresses ELSE 0 END) AS total_addresses_v6,
+			SUM(CASE WHEN family = 4 THEN sign * used_addresses ELSE 0 END) AS used_addresses_v4,
+			SUM(CASE WHEN family = 6 THEN sign * used_addresses ELSE 0 END) AS used_addresses_v6,
+			SUM(CASE WHEN family = 4 THEN sign * free_addresses ELSE 0 END) AS free_addresses_v4,
+			SUM(CASE WHEN family = 6 THEN sign * free_addresses ELSE 0 END) AS free_addresses_v6
+		FROM change
+		WHERE pool_id IS NOT NULL
+		GROUP BY pool_id
+	)
+	UPDATE ip_net_pool AS pool
+	SET member_prefixes_v4 = pool.member_prefixes_v4 + delta.member_prefixes_v4,
+		member_prefixes_v6 = pool.member_prefixes_v6 + delta.member_prefixes_v6,
+		used_prefixes_v4 = pool.used_prefixes_v4 + delta.used_prefixes_v4,
+		used_prefixes_v6 = pool.used_prefixes_v6 + delta.used_prefixes_v6,
+		-- free prefixes are NULL without a default prefix length or members
+		free_prefixes_v4 = CASE WHEN pool.ipv4_default_prefix_length IS NOT NULL
+				AND pool.member_prefixes_v4 + delta.member_prefixes_v4 > 0
+			THEN COALESCE(pool.free_prefixes_v4, 0) + delta.free_prefixes_v4 END,
+		free_prefixes_v6 = CASE WHEN pool.ipv6_default_prefix_length IS NOT NULL
+				AND pool.member_prefixes_v6 + delta.member_prefixes_v6 > 0
+			THEN COALESCE(pool.free_prefixes_v6, 0) + delta.free_prefixes_v6 END,
+		total_prefixes_v4 = pool.used_prefixes_v4 + delta.used_prefixes_v4
+			+ CASE WHEN pool.ipv4_default_prefix_length IS NOT NULL
+				AND pool.member_prefixes_v4 + delta.member_prefixes_v4 > 0
+			THEN COALESCE(pool.free_prefixes_v4, 0) + delta.free_prefixes_v4 END,
+		total_prefixes_v6 = pool.used_prefixes_v6 + delta.used_prefixes_v6
+			+ CASE WHEN pool.ipv6_default_prefix_length IS NOT NULL
+				AND pool.member_prefixes_v6 + delta.member_prefixes_v6 > 0
+			THEN COALESCE(pool.free_prefixes_v6, 0) + delta.free_prefixes_v6 END,
+		total_addresses_v4 = pool.total_addresses_v4 + delta.total_addresses_v4,
+		total_addresses_v6 = pool.total_addresses_v6 + delta.total_addresses_v6,
+		used_addresses_v4 = pool.used_addresses_v4 + delta.used_addresses_v4,
+		used_addresses_v6 = pool.used_addresses_v6 + delta.used_addresses_v6,
+		free_addresses_v4 = pool.free_addresses_v4 + delta.free_addresses_v4,
+		free_addresses_v6 = pool.free_addresses_v6 + delta.free_addresses_v6
+	FROM delta
+	WHERE pool.id = delta.id
+		AND (delta.member_prefixes_v4, delta.member_prefixes_v6,
+			delta.used_prefixes_v4, delta.used_prefixes_v6,
+			delta.free_prefixes_v4, delta.free_prefixes_v6,
+			delta.total_addresses_v4, delta.total_addresses_v6,
+			delta.used_addresses_v4, delta.used_addresses_v6,
+			delta.free_addresses_v4, delta.free_addresses_v6)
+			!= (0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0);
+
+	RETURN NULL;
+END;
+$_$ LANGUAGE plpgsql;
 
-	ELSIF TG_OP = 'INSERT' THEN
-		-- now push tags from the new prefix to its children
-		PERFORM calc_tags(NEW.vrf_id, NEW.prefix);
-		IF NEW.children > 0 AND (NEW.tags != '{}' OR NEW.inherited_tags != '{}') THEN
-			PERFORM calc_tags(NEW.vrf_id, NEW.prefix);
-		END IF;
-	ELSIF TG_OP = 'UPDATE' THEN
-		PERFORM calc_tags(OLD.vrf_id, OLD.prefix);
-		PERFORM calc_tags(NEW.vrf_id, NEW.prefix);
+
+--
+-- Trigger function to update the free prefixes of pool members as their free
+-- ranges are split and merged. Each free range holds a number of prefixes of
+-- the default prefix length of the pool, given by its size and alignment,
+-- which is added or taken off the member, and in turn its pool, rather than
+-- counting the free prefixes of every member of the pool again.
+--
+-- Members which are new or which moved to another pool have their free
+-- prefixes counted by tf_ip_net_plan__stats_after(), which keeps their
+-- statistics, as do the free ranges of removed prefixes.
+--
+CREATE OR REPLACE FUNCTION tf_ip_net_free_range__stats_after() RETURNS trigger AS $_$
+DECLARE
+	old_rows ip_net_free_range[];
+	new_rows ip_net_free_range[];
+BEGIN
+	IF TG_OP = 'INSERT' THEN
+		SELECT array_agg(n) INTO new_rows FROM new_ranges AS n;
+	ELSE
+		SELECT array_agg(o) INTO old_rows FROM old_ranges AS o;
 	END IF;
 
+	IF old_rows IS NULL AND new_rows IS NULL THEN
+		RETURN NULL;
+	END IF;
 
-	-- all is well, return
-	RETURN NEW;
+	WITH change AS (
+		SELECT 1 AS sign, * FROM unnest(new_rows)
+		UNION ALL
+		SELECT -1, * FROM unnest(old_rows)
+	), delta AS (
+		SELECT change.prefix_id,
+			SUM(change.sign * iprange_count(change.free_range,
+				CASE WHEN stats.family = 4 THEN pool.ipv4_default_prefix_length ELSE pool.ipv6_default_prefix_length END)) AS free_prefixes
+		FROM change
+			JOIN ip_net_plan_stats AS stats ON (stats.prefix_id = change.prefix_id)
+			JOIN ip_net_pool AS pool ON (pool.id = stats.pool_id)
+		GROUP BY change.prefix_id
+	)
+	UPDATE ip_net_plan_stats AS stats
+	SET free_prefixes = stats.free_prefixes + delta.free_prefixes
+	FROM delta
+	WHERE stats.prefix_id = delta.prefix_id
+		AND delta.free_prefixes != 0;
+
+	RETURN NULL;
 END;
 $_$ LANGUAGE plpgsql;
 
 
+
 --
 -- Trigger function to update inherited tags.
 --
@@ -1635,6 +2529,8 @@ END;
 $$ LANGUAGE plpgsql;
 
 CREATE OR REPLACE FUNCTION tf_ip_net_pool__iu_before() RETURNS trigger AS $_$
+DECLARE
+	rebuild_stats text;
 BEGIN
 	IF TG_OP = 'INSERT' THEN
 		NEW.free_prefixes_v4 := calc_pool_free_prefixes(NEW, 4);
@@ -1642,15 +2538,38 @@ BEGIN
 		NEW.free_prefixes_v6 := calc_pool_free_prefixes(NEW, 6);
 		NEW.total_prefixes_v6 := NEW.used_prefixes_v6 + NEW.free_prefixes_v6;
 	ELSIF TG_OP = 'UPDATE' THEN
+		-- The free prefixes of the members are counted in the default prefix
+		-- length, so they are all counted over and added up for the pool.
+		-- The triggers on ip_net_plan_stats are skipped as they would update
+		-- this very pool.
+		rebuild_stats := current_setting('nipap.rebuild_stats', true);
+		PERFORM set_config('nipap.rebuild_stats', 'on', true);
+
 		IF OLD.ipv4_default_prefix_length IS DISTINCT FROM NEW.ipv4_default_prefix_length THEN
-			NEW.free_prefixes_v4 := calc_pool_free_prefixes(NEW, 4);
+			WITH member AS (
+				UPDATE ip_net_plan_stats
+				SET free_prefixes = calc_prefix_free_prefixes(prefix_id, NEW.ipv4_default_prefix_length)
+				WHERE pool_id = NEW.id
+					AND family = 4
+				RETURNING free_prefixes
+			)
+			SELECT SUM(free_prefixes) INTO NEW.free_prefixes_v4 FROM member;
 			NEW.total_prefixes_v4 := NEW.used_prefixes_v4 + NEW.free_prefixes_v4;
 		END IF;
 
 		IF OLD.ipv6_default_prefix_length IS DISTINCT FROM NEW.ipv6_default_prefix_length THEN
-			NEW.free_prefixes_v6 := calc_pool_free_prefixes(NEW, 6);
+			WITH member AS (
+				UPDATE ip_net_plan_stats
+				SET free_prefixes = calc_prefix_free_prefixes(prefix_id, NEW.ipv6_default_prefix_length)
+				WHERE pool_id = NEW.id
+					AND family = 6
+				RETURNING free_prefixes
+			)
+			SELECT SUM(free_prefixes) INTO NEW.free_prefixes_v6 FROM member;
 			NEW.total_prefixes_v6 := NEW.used_prefixes_v6 + NEW.free_prefixes_v6;
 		END IF;
+
+		PERFORM set_config('nipap.rebuild_stats', COALESCE(rebuild_stats, 'off'), true);
 	END IF;
 
 	RETURN NEW;
@@ -1672,6 +2591,12 @@ BEGIN
 	FOR r IN (SELECT DISTINCT trigger_name FROM information_schema.triggers WHERE event_object_table = 'ip_net_plan' AND trigger_schema NOT IN ('pg_catalog', 'information_schema')) LOOP
 		EXECUTE 'DROP TRIGGER ' || r.trigger_name || ' ON ip_net_plan';
 	END LOOP;
+	FOR r IN (SELECT DISTINCT trigger_name FROM information_schema.triggers WHERE event_object_table = 'ip_net_plan_stats' AND trigger_schema NOT IN ('pg_catalog', 'information_schema')) LOOP
+		EXECUTE 'DROP TRIGGER ' || r.trigger_name || ' ON ip_net_plan_stats';
+	END LOOP;
+	FOR r IN (SELECT DISTINCT trigger_name FROM information_schema.triggers WHERE event_object_table = 'ip_net_free_range' AND trigger_schema NOT IN ('pg_catalog', 'information_schema')) LOOP
+		EXECUTE 'DROP TRIGGER ' || r.trigger_name || ' ON ip_net_free_range';
+	END LOOP;
 	FOR r IN (SELECT DISTINCT trigger_name FROM information_schema.triggers WHERE event_object_table = 'ip_net_pool' AND trigger_schema NOT IN ('pg_catalog', 'information_schema')) LOOP
 		EXECUTE 'DROP TRIGGER ' || r.trigger_name || ' ON ip_net_pool';
 	END LOOP;
@@ -1700,7 +2625,7 @@ CREATE TRIGGER trigger_ip_net_vrf__d_before
 
 
 --
--- Triggers for consistency checking and updating indent level on ip_net_plan
+-- Triggers for consistency checking and updating the prefix tree on ip_net_plan
 -- table.
 --
 
@@ -1713,35 +2638,112 @@ CREATE TRIGGER trigger_ip_net_plan__i_before
 	EXECUTE PROCEDURE tf_ip_net_plan__prefix_iu_before();
 
 -- sanity checking of UPDATEs on ip_net_plan
+-- the UPDATE triggers are skipped while rebuild_prefix_stats() rewrites the
+-- values they maintain
 CREATE TRIGGER trigger_ip_net_plan__vrf_prefix_type__u_before
 	BEFORE UPDATE
 	ON ip_net_plan
 	FOR EACH ROW
+	WHEN (current_setting('nipap.rebuild_stats', true) IS DISTINCT FROM 'on')
 	EXECUTE PROCEDURE tf_ip_net_plan__prefix_iu_before();
 
 -- actions to be performed after an UPDATE on ip_net_plan
 -- sanity checks are performed in the before trigger, so this is only to
 -- execute various changes that need to happen once a prefix has been updated
+--
+-- remove_prefix_subtree() skips the row level DELETE triggers as it removes
+-- all prefixes below the one they would maintain
 CREATE TRIGGER trigger_ip_net_plan__vrf_prefix_type__id_after
 	AFTER INSERT OR DELETE
 	ON ip_net_plan
 	FOR EACH ROW
+	WHEN (current_setting('nipap.remove_subtree', true) IS DISTINCT FROM 'on')
 	EXECUTE PROCEDURE tf_ip_net_plan__prefix_iu_after();
 
+-- calc_tags() sets nipap.calc_tags while it updates the inherited tags of a
+-- whole subtree, for which neither tags nor statistics need maintaining
 CREATE TRIGGER trigger_ip_net_plan__vrf_prefix_type__u_after
-	AFTER UPDATE OF vrf_id, prefix, indent, type, pool_id, used_addresses, tags, inherited_tags
+	AFTER UPDATE OF prefix, tags
 	ON ip_net_plan
 	FOR EACH ROW
-	WHEN (OLD.vrf_id != NEW.vrf_id
-		OR OLD.prefix != NEW.prefix
-		OR OLD.indent != NEW.indent
-		OR OLD.type != NEW.type
-		OR OLD.tags IS DISTINCT FROM NEW.tags
-		OR OLD.inherited_tags IS DISTINCT FROM NEW.inherited_tags
-		OR OLD.pool_id IS DISTINCT FROM NEW.pool_id
-		OR OLD.used_addresses != NEW.used_addresses)
+	WHEN ((OLD.prefix != NEW.prefix
+		OR OLD.tags IS DISTINCT FROM NEW.tags)
+		AND current_setting('nipap.rebuild_stats', true) IS DISTINCT FROM 'on'
+		AND current_setting('nipap.calc_tags', true) IS DISTINCT FROM 'on')
 	EXECUTE PROCEDURE tf_ip_net_plan__prefix_iu_after();
 
+-- statistics of parents, VRFs and pools, updated once per statement
+CREATE TRIGGER trigger_ip_net_plan__stats__i_after
+	AFTER INSERT
+	ON ip_net_plan
+	REFERENCING NEW TABLE AS new_prefixes
+	FOR EACH STATEMENT
+	EXECUTE PROCEDURE tf_ip_net_plan__stats_after();
+
+CREATE TRIGGER trigger_ip_net_plan__stats__u_after
+	AFTER UPDATE
+	ON ip_net_plan
+	REFERENCING OLD TABLE AS old_prefixes NEW TABLE AS new_prefixes
+	FOR EACH STATEMENT
+	WHEN (current_setting('nipap.rebuild_stats', true) IS DISTINCT FROM 'on'
+		AND current_setting('nipap.calc_tags', true) IS DISTINCT FROM 'on')
+	EXECUTE PROCEDURE tf_ip_net_plan__stats_after();
+
+-- skipped by remove_vrf_prefixes() which removes all prefixes of a VRF
+CREATE TRIGGER trigger_ip_net_plan__stats__d_after
+	AFTER DELETE
+	ON ip_net_plan
+	REFERENCING OLD TABLE AS old_prefixes
+	FOR EACH STATEMENT
+	WHEN (current_setting('nipap.remove_vrf', true) IS DISTINCT FROM 'on')
+	EXECUTE PROCEDURE tf_ip_net_plan__stats_after();
+
+-- statistics of VRFs and pools, updated once per statement from the
+-- statistics of their prefixes
+CREATE TRIGGER trigger_ip_net_plan_stats__stats__i_after
+	AFTER INSERT
+	ON ip_net_plan_stats
+	REFERENCING NEW TABLE AS new_stats
+	FOR EACH STATEMENT
+	WHEN (current_setting('nipap.rebuild_stats', true) IS DISTINCT FROM 'on')
+	EXECUTE PROCEDURE tf_ip_net_plan_stats__stats_after();
+
+CREATE TRIGGER trigger_ip_net_plan_stats__stats__u_after
+	AFTER UPDATE
+	ON ip_net_plan_stats
+	REFERENCING OLD TABLE AS old_stats NEW TABLE AS new_stats
+	FOR EACH STATEMENT
+	WHEN (current_setting('nipap.rebuild_stats', true) IS DISTINCT FROM 'on')
+	EXECUTE PROCEDURE tf_ip_net_plan_stats__stats_after();
+
+CREATE TRIGGER trigger_ip_net_plan_stats__stats__d_after
+	AFTER DELETE
+	ON ip_net_plan_stats
+	REFERENCING OLD TABLE AS old_stats
+	FOR EACH STATEMENT
+	WHEN (current_setting('nipap.rebuild_stats', true) IS DISTINCT FROM 'on'
+		AND current_setting('nipap.remove_vrf', true) IS DISTINCT FROM 'on')
+	EXECUTE PROCEDURE tf_ip_net_plan_stats__stats_after();
+
+-- free prefixes of pool members, updated once per statement from the changes
+-- to their free ranges
+CREATE TRIGGER trigger_ip_net_free_range__stats__i_after
+	AFTER INSERT
+	ON ip_net_free_range
+	REFERENCING NEW TABLE AS new_ranges
+	FOR EACH STATEMENT
+	WHEN (current_setting('nipap.rebuild_stats', true) IS DISTINCT FROM 'on')
+	EXECUTE PROCEDURE tf_ip_net_free_range__stats_after();
+
+CREATE TRIGGER trigger_ip_net_free_range__stats__d_after
+	AFTER DELETE
+	ON ip_net_free_range
+	REFERENCING OLD TABLE AS old_ranges
+	FOR EACH STATEMENT
+	WHEN (current_setting('nipap.rebuild_stats', true) IS DISTINCT FROM 'on'
+		AND current_setting('nipap.remove_vrf', true) IS DISTINCT FROM 'on')
+	EXECUTE PROCEDURE tf_ip_net_free_range__stats_after();
+
 -- check country code is correct
 CREATE TRIGGER trigger_ip_net_plan__other__i_before
 	BEFORE INSERT
@@ -1757,24 +2759,25 @@ CREATE TRIGGER trigger_ip_net_plan__other__u_before
 	EXECUTE PROCEDURE tf_ip_net_plan__other__iu_before();
 
 
--- ip_net_plan - update indent and number of children
-CREATE TRIGGER trigger_ip_net_plan__indent_children__i_before
+-- ip_net_plan - update parent and number of children
+CREATE TRIGGER trigger_ip_net_plan__parent_children__i_before
 	BEFORE INSERT
 	ON ip_net_plan
 	FOR EACH ROW
-	EXECUTE PROCEDURE tf_ip_net_plan__indent_children__iu_before();
+	EXECUTE PROCEDURE tf_ip_net_plan__parent_children__iu_before();
 
-CREATE TRIGGER trigger_ip_net_plan__indent_children__u_before
+CREATE TRIGGER trigger_ip_net_plan__parent_children__u_before
 	BEFORE UPDATE OF prefix
 	ON ip_net_plan
 	FOR EACH ROW
 	WHEN (OLD.prefix != NEW.prefix)
-	EXECUTE PROCEDURE tf_ip_net_plan__indent_children__iu_before();
+	EXECUTE PROCEDURE tf_ip_net_plan__parent_children__iu_before();
 
 CREATE TRIGGER trigger_ip_net_plan_prefix__d_before
 	BEFORE DELETE
 	ON ip_net_plan
 	FOR EACH ROW
+	WHEN (current_setting('nipap.remove_subtree', true) IS DISTINCT FROM 'on')
 	EXECUTE PROCEDURE tf_ip_net_prefix_d_before();
 
 
@@ -2369,4 +3372,133 @@ CREATE TRIGGER trigger_kafka_ip_net_pool
 -- update database schema version
 COMMENT ON DATABASE %s IS 'NIPAP database - schema version: 8';
 """,
+"""
+--
+-- Upgrade from NIPAP database schema version 8 to 9
+--
+
+-- find_free_prefix is replaced by a version working on the free ranges
+-- between used prefixes, which is installed with the rest of the functions
+
+-- the prefix tree is kept as the direct parent of each prefix together with
+-- all of its ancestors, from which the indent is derived, instead of an
+-- indent which had to be rewritten for all prefixes below a changed prefix
+ALTER TABLE ip_net_plan ADD COLUMN parent_id integer;
+COMMENT ON COLUMN ip_net_plan.parent_id IS 'Direct parent prefix, NULL for top level prefixes';
+CREATE INDEX ip_net_plan__parent_id__index ON ip_net_plan (parent_id);
+
+CREATE TABLE ip_net_plan_ancestor (
+	prefix_id integer NOT NULL REFERENCES ip_net_plan (id) ON UPDATE CASCADE ON DELETE CASCADE,
+	ancestor_id integer NOT NULL REFERENCES ip_net_plan (id) ON UPDATE CASCADE ON DELETE CASCADE,
+	PRIMARY KEY (prefix_id, ancestor_id)
+);
+
+CREATE INDEX ip_net_plan_ancestor__ancestor_id__index ON ip_net_plan_ancestor (ancestor_id);
+
+COMMENT ON TABLE ip_net_plan_ancestor IS 'Ancestors of prefixes';
+
+COMMENT ON COLUMN ip_net_plan_ancestor.prefix_id IS 'Prefix';
+COMMENT ON COLUMN ip_net_plan_ancestor.ancestor_id IS 'Prefix covering prefix_id';
+
+INSERT INTO ip_net_plan_ancestor (prefix_id, ancestor_id) SELECT inp.id, inp2.id FROM ip_net_plan AS inp JOIN ip_net_plan AS inp2 ON (inp2.vrf_id = inp.vrf_id AND iprange(inp2.prefix) >> iprange(inp.prefix));
+
+-- the prefixes are not otherwise changed, so the triggers of the previous
+-- version, which would set last_modified and queue kafka events for every
+-- prefix, are kept from firing
+ALTER TABLE ip_net_plan DISABLE TRIGGER USER;
+UPDATE ip_net_plan AS inp SET parent_id = (SELECT inp2.id FROM ip_net_plan AS inp2 WHERE inp2.vrf_id = inp.vrf_id AND iprange(inp2.prefix) >> iprange(inp.prefix) AND inp2.indent = inp.indent - 1) WHERE indent > 0;
+ALTER TABLE ip_net_plan ENABLE TRIGGER USER;
+
+-- the triggers depending on indent are recreated along with the rest
+ALTER TABLE ip_net_plan DROP COLUMN indent CASCADE;
+DROP FUNCTION calc_indent(integer, inet, integer);
+DROP FUNCTION tf_ip_net_plan__indent_children__iu_before() CASCADE;
+
+-- free ranges within prefixes, maintained by the ip_net_plan triggers
+CREATE TABLE ip_net_free_range (
+	prefix_id integer NOT NULL REFERENCES ip_net_plan (id) ON UPDATE CASCADE ON DELETE CASCADE,
+	free_range iprange NOT NULL,
+	PRIMARY KEY (prefix_id, free_range)
+);
+
+COMMENT ON TABLE ip_net_free_range IS 'Free address ranges within prefixes';
+
+COMMENT ON COLUMN ip_net_free_range.prefix_id IS 'Prefix in which the range is free';
+COMMENT ON COLUMN ip_net_free_range.free_range IS 'Range of addresses not covered by any child prefix';
+
+-- populate with the free ranges of existing prefixes
+SELECT calc_free_ranges(id, iprange(prefix)) FROM ip_net_plan;
+
+-- allocation strategy of pools
+CREATE TYPE ip_net_pool_allocation_strategy AS ENUM ('first-fit', 'next-fit', 'sparse');
+ALTER TABLE ip_net_pool ADD COLUMN allocation_strategy ip_net_pool_allocation_strategy NOT NULL DEFAULT 'first-fit';
+ALTER TABLE ip_net_pool ADD COLUMN allocation_cursor_v4 cidr;
+ALTER TABLE ip_net_pool ADD COLUMN allocation_cursor_v6 cidr;
+
+COMMENT ON COLUMN ip_net_pool.allocation_strategy IS 'How free prefixes are picked when allocating from the pool; first-fit, next-fit or sparse';
+COMMENT ON COLUMN ip_net_pool.allocation_cursor_v4 IS 'Last IPv4 prefix allocated from the pool, where next-fit allocation resumes';
+COMMENT ON COLUMN ip_net_pool.allocation_cursor_v6 IS 'Last IPv6 prefix allocated from the pool, where next-fit allocation resumes';
+
+-- the number of children of a prefix is now adjusted incrementally rather
+-- than recounted on every change, so it has to start out right
+ALTER TABLE ip_net_plan DISABLE TRIGGER USER;
+UPDATE ip_net_plan AS inp SET children = (SELECT COUNT(1) FROM ip_net_plan AS inp2 WHERE inp2.parent_id = inp.id);
+ALTER TABLE ip_net_plan ENABLE TRIGGER USER;
+
+-- inherited tags are compared to the recalculated ones to only update the
+-- prefixes whose tags actually change
+CREATE INDEX ip_net_plan__inherited_tags__index ON ip_net_plan USING gin(inherited_tags);
+
+-- the statistics of prefixes are kept in a table of their own
+CREATE TABLE ip_net_plan_stats (
+	prefix_id integer PRIMARY KEY REFERENCES ip_net_plan (id) ON UPDATE CASCADE ON DELETE CASCADE,
+	vrf_id integer NOT NULL,
+	pool_id integer,
+	family integer NOT NULL,
+	top_level boolean NOT NULL,
+	children integer NOT NULL DEFAULT 0,
+	total_addresses numeric(40) NOT NULL,
+	used_addresses numeric(40) NOT NULL,
+	free_addresses numeric(40) NOT NULL,
+	free_prefixes numeric(40)
+) WITH (fillfactor = 50);
+
+COMMENT ON TABLE ip_net_plan_stats IS 'Statistics of prefixes';
+
+COMMENT ON COLUMN ip_net_plan_stats.prefix_id IS 'Prefix';
+COMMENT ON COLUMN ip_net_plan_stats.vrf_id IS 'VRF in which the prefix resides';
+COMMENT ON COLUMN ip_net_plan_stats.pool_id IS 'Pool that the prefix is part of';
+COMMENT ON COLUMN ip_net_plan_stats.family IS 'Address family of the prefix';
+COMMENT ON COLUMN ip_net_plan_stats.top_level IS 'Whether the prefix lacks a parent prefix';
+COMMENT ON COLUMN ip_net_plan_stats.children IS 'Number of direct sub-prefixes';
+COMMENT ON COLUMN ip_net_plan_stats.total_addresses IS 'Total number of addresses in the prefix';
+COMMENT ON COLUMN ip_net_plan_stats.used_addresses IS 'Number of used addresses in the prefix';
+COMMENT ON COLUMN ip_net_plan_stats.free_addresses IS 'Number of free addresses in the prefix';
+COMMENT ON COLUMN ip_net_plan_stats.free_prefixes IS 'Number of free prefixes of the default assignment size of the pool, for pool members';
+
+INSERT INTO ip_net_plan_stats (prefix_id, vrf_id, pool_id, family, top_level, children, total_addresses, used_addresses, free_addresses)
+	SELECT id, vrf_id, pool_id, family(prefix), parent_id IS NULL, children, total_addresses, used_addresses, free_addresses FROM ip_net_plan;
+
+-- free prefixes of pools are added up from those of their members, counting
+-- only whole prefixes of the default assignment size
+UPDATE ip_net_plan_stats SET free_prefixes = calc_prefix_free_prefixes(prefix_id) WHERE pool_id IS NOT NULL;
+UPDATE ip_net_pool SET free_prefixes_v4 = calc_pool_free_prefixes(id, 4), free_prefixes_v6 = calc_pool_free_prefixes(id, 6);
+UPDATE ip_net_pool SET total_prefixes_v4 = used_prefixes_v4 + free_prefixes_v4, total_prefixes_v6 = used_prefixes_v6 + free_prefixes_v6;
+
+ALTER TABLE ip_net_plan DROP COLUMN children;
+ALTER TABLE ip_net_plan DROP COLUMN total_addresses;
+ALTER TABLE ip_net_plan DROP COLUMN used_addresses;
+ALTER TABLE ip_net_plan DROP COLUMN free_addresses;
+
+-- the RT order of VRFs is stored, for prefixes to be sorted on it without
+-- calculating it for each of them
+ALTER TABLE ip_net_vrf ADD COLUMN rt_order bigint;
+COMMENT ON COLUMN ip_net_vrf.rt_order IS 'VRF RT as a number to sort on, see vrf_rt_order()';
+UPDATE ip_net_vrf SET rt_order = vrf_rt_order(rt);
+CREATE INDEX ip_net_vrf__rt_order__index ON ip_net_vrf (rt_order NULLS FIRST);
+COMMENT ON INDEX ip_net_vrf__rt_order__index IS 'VRF RT order';
+
+-- update database schema version
+COMMENT ON DATABASE %s IS 'NIPAP database - schema version: 9';
+""",
 ]
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# Administrative tasks on the NIPAP database
+#
+
+import sys
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import nipap
+import nipap.authlib
+from nipap.nipapconfig import NipapConfig, NipapConfigError
+from nipap.errors import NipapError
+
+
+def stats(nip, auth, args):
+    """ Verify or rebuild the statistics of one or all VRFs
+    """
+
+    if args.vrf_rt is None:
+        spec = None
+    elif args.vrf_rt == 'none':
+        spec = {'id': 0}
+    else:
+        spec = {'rt': args.vrf_rt}
+
+    vrfs = nip.list_vrf(auth, spec)
+    if len(vrfs) == 0:
+        print("No VRF with RT '%s' found" % args.vrf_rt, file=sys.stderr)
+        sys.exit(1)
+
+    # every VRF is handled by a call of its own, making it possible to
+    # process several of them in parallel
+    if args.action == 'verify':
+        fun = nip.verify_stats
+    else:
+        fun = nip.rebuild_stats
+
+    num_off = 0
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(lambda vrf: fun(auth, {'id': vrf['id']}), vrfs)
+        for vrf, drift in zip(vrfs, results):
+            num_off += len(drift)
+            if len(drift) == 0:
+                print("VRF %s: ok" % (vrf['rt'] or '-'))
+                continue
+
+            if args.action == 'verify':
+                print("VRF %s: %d values off" % (vrf['rt'] or '-', len(drift)))
+            else:
+                print("VRF %s: %d values off, rebuilt" % (vrf['rt'] or '-', len(drift)))
+            for row in drift:
+                print("  %s %d %s: %s, expected %s" % (row['table_name'], row['id'], row['attribute'],
+                                                      row['stored'], row['expected']))
+
+    # tell scripts running verify that something is off
+    if args.action == 'verify' and num_off > 0:
+        sys.exit(2)
+
+
+def run():
+    # parse arguments
+    parser = argparse.ArgumentParser(description='NIPAP database administration')
+    parser.add_argument('-c', '--config', dest='config',
+                        default='/etc/nipap/nipap.conf', type=str, help=
+                        'read configuration from CONFIG [default:/etc/nipap/nipap.conf]')
+    parser.add_argument('--version', action='version',
+                        version='nipap-admin version %s' % nipap.__version__)
+    subparsers = parser.add_subparsers(dest='command', metavar='{stats}')
+
+    stats_parser = subparsers.add_parser('stats', help='verify or rebuild prefix, VRF and pool statistics')
+    stats_parser.add_argument('action', type=str, choices=['verify', 'rebuild'],
+                              help='report values which are off or rebuild them')
+    stats_parser.add_argument('--vrf', dest='vrf_rt', type=str, metavar='RT',
+                              help="only the VRF with route target RT, 'none' for the default VRF [default: all VRFs]")
+    stats_parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                              help='number of VRFs to process in parallel [default: 1]')
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    log_format = "%(levelname)-8s %(message)s"
+    log_stream = logging.StreamHandler()
+    log_stream.setFormatter(logging.Formatter("%(asctime)s: " + log_format))
+    logger.setLevel(logging.WARNING)
+    logger.addHandler(log_stream)
+
+    try:
+        cfg = NipapConfig(args.config)
+    except NipapConfigError as exc:
+        print("The specified configuration file ('" + args.config + "') does not exist", file=sys.stderr)
+        sys.exit(1)
+
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.command == 'stats' and args.jobs < 1:
+        print("The number of jobs must be at least 1", file=sys.stderr)
+        sys.exit(1)
+
+    from nipap.backend import Nipap
+
+    # run as the local user, who has access to the database through the
+    # configuration file rather than by authenticating
+    auth = nipap.authlib.local_auth()
+
+    try:
+        nip = Nipap()
+        stats(nip, auth, args)
+    except NipapError as exc:
+        print("ERROR:", str(exc), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run()
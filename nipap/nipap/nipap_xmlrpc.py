@@ -540,17 +540,46 @@ class NipapXMLRPC:
                 Arguments for addition of prefix, such as what pool or prefix
                 it should be allocated from.
 
-            Returns ID of created prefix.
+            Returns ID of created prefix, or a list of the created prefixes
+            when allocating many at once using `count`.
         """
         try:
             res = self.nip.add_prefix(args.get('auth'), args.get('attr'), args.get('args'))
             # mangle result
+            if isinstance(res, list):
+                return [_mangle_prefix(prefix) for prefix in res]
             res = _mangle_prefix(res)
             return res
         except (AuthError, NipapError) as exc:
             self.logger.debug(str(exc))
             raise Fault(exc.error_code, str(exc))
 
+    @requires_auth
+    def add_prefixes(self, args):
+        """ Add many prefixes in one transaction.
+
+            Valid keys in the `args`-struct:
+
+            * `auth` [struct]
+                Authentication options passed to the :class:`AuthFactory`.
+            * `attrs` [array of structs]
+                Attributes of the prefixes to add.
+            * `options` [struct]
+                Options for the operation, such as if it should be atomic.
+
+            Returns a struct with the added prefixes in `result` and the
+            prefixes which could not be added in `errors`.
+        """
+        try:
+            res = self.nip.add_prefixes(args.get('auth'), args.get('attrs'), args.get('options'))
+            # mangle result
+            for prefix in res['result']:
+                prefix = _mangle_prefix(prefix)
+            return res
+        except (AuthError, NipapError) as exc:
+            self.logger.debug(str(exc))
+            raise Fault(exc.error_code, str(exc))
+
     @requires_auth
     def list_prefix(self, args):
         """ List prefixes.
@@ -637,7 +666,8 @@ class NipapXMLRPC:
                 of results returned.
 
             Returns a struct containing the search result together with the
-            search options used.
+            search options used and a `next_cursor`, which can be passed as
+            the `after` search option to fetch the next page of the result.
 
             Certain values are casted from numbers to strings because XML-RPC
             simply cannot handle anything bigger than an integer.
@@ -670,7 +700,9 @@ class NipapXMLRPC:
                 extracted from the query string.
 
             Returns a struct containing search result, interpretation of the
-            query string and the search options used.
+            query string, the search options used and a `next_cursor`, which
+            can be passed as the `after` search option to fetch the next page
+            of the result.
 
             Certain values are casted from numbers to strings because XML-RPC
             simply cannot handle anything bigger than an integer.
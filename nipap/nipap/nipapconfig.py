@@ -5,6 +5,7 @@ DEFAULT = {
     'debug': 'false',
     'foreground': 'false',
     'forks': 0,
+    'threads': '0',
     'pid_file': '',
     'listen': '127.0.0.1',
     'port': '1337',
@@ -17,6 +18,12 @@ DEFAULT = {
     'db_user': 'nipap',
     'db_pass': 'papin',
     'db_sslmode': 'require',
+    'db_pool_min_size': '1',
+    'db_pool_max_size': '10',
+    'db_pool_check_interval': '30',
+    'db_pool_timeout': '30',
+    'allocation_batch_window': '0',
+    'query_cache_size': '1000',
     'auth_cache_timeout': '3600',
     'user': '',
     'group': '',
@@ -9,6 +9,7 @@ import os
 import sys
 import configparser
 import ssl
+from concurrent.futures import ThreadPoolExecutor
 
 from tornado.netutil import bind_sockets
 from tornado.httpserver import HTTPServer
@@ -104,6 +105,8 @@ def run():
     parser.add_argument('--version', action='store_true', help='display version information and exit')
     parser.add_argument("--db-version", dest="dbversion", action="store_true",
                         help="display database schema version information and exit")
+    parser.add_argument('--bulk-load', dest='bulk_load', type=str, metavar='FILE',
+                        help='load prefixes from CSV file FILE and exit')
     # Arguments overwriting config settings
     cfg_args = ['debug', 'foreground', 'port', 'config_file']
 
@@ -226,6 +229,20 @@ def run():
         print("nipap db schema:", nip._get_db_version())
         sys.exit(0)
 
+    if args.bulk_load:
+        from nipap import authlib
+
+        # bulk loading is done locally by whoever can reach the database, so
+        # we act as the local user rather than authenticating
+        auth = authlib.local_auth()
+        try:
+            with open(args.bulk_load, newline='') as f:
+                print("Loaded %d prefixes" % nip.bulk_load_prefixes(auth, f))
+        except (IOError, NipapError) as e:
+            print("Could not load prefixes: %s" % e, file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
     # check local auth db version
     from nipap import authlib
 
@@ -375,8 +392,13 @@ def run():
         rest.logger.addHandler(log_syslog)
 
 
+    # serve requests from a pool of threads, or one at a time in the IOLoop
+    executor = None
+    if cfg.getint('nipapd', 'threads') > 0:
+        executor = ThreadPoolExecutor(cfg.getint('nipapd', 'threads'))
+
     if setup_plaintext:
-        http_server = HTTPServer(WSGIContainer(app))
+        http_server = HTTPServer(WSGIContainer(app, executor=executor))
         http_server.add_sockets(sockets)
 
     if setup_ssl:
@@ -388,7 +410,7 @@ def run():
             logging.error("SSL Initialization failed: %s", err)
             sys.exit(1)
 
-        https_server = HTTPServer(WSGIContainer(app), ssl_options=ssl_ctx)
+        https_server = HTTPServer(WSGIContainer(app, executor=executor), ssl_options=ssl_ctx)
         https_server.add_sockets(ssl_sockets)
 
     # start Tornado
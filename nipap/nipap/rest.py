@@ -50,6 +50,11 @@ def combine_request_args():
             if request_nipap_fullname:
                 args['auth'].update({'full_name': request_nipap_fullname})
 
+        # options for adding many prefixes at once
+        if request.method == 'POST' and 'atomic' in request_queries:
+            atomic = request_queries.pop('atomic').lower() in ('true', '1')
+            args['options'] = {'atomic': atomic}
+
         if request_queries and request.method == 'POST':
             temp_args = {}
             if request_queries.get("fromPoolName"):
@@ -64,6 +69,8 @@ def combine_request_args():
                 prefix_length = {"prefix_length": request_queries.get("prefixLength")}
                 temp_args.update(from_prefix)
                 temp_args.update(prefix_length)
+            if request_queries.get("count"):
+                temp_args.update({"count": int(request_queries.get("count"))})
 
             args.update({'args': temp_args})
 
@@ -251,7 +258,12 @@ class NipapPrefix(Resource):
             # mangle result
             result['result'] = [ _mangle_prefix(prefix) for prefix in result['result'] ]
 
-            return jsonify(result['result'])
+            response = jsonify(result['result'])
+            # cursor for the next page, pass as query parameter 'after'
+            if result['next_cursor'] is not None:
+                response.headers['NIPAP-Next-Cursor'] = result['next_cursor']
+
+            return response
 
         except (AuthError, NipapError) as exc:
             self.logger.debug(str(exc))
@@ -264,12 +276,26 @@ class NipapPrefix(Resource):
     @create_span_rest
     def post(self, args):
         """ Add prefix
+
+            If the request body is a list, all prefixes in it are added.
         """
         try:
+            if isinstance(args.get('attr'), list):
+                result = self.nip.add_prefixes(args.get('auth'),
+                                               args.get('attr'),
+                                               args.get('options'))
+
+                result['result'] = [_mangle_prefix(prefix) for prefix in result['result']]
+                return jsonify(result)
+
             result = self.nip.add_prefix(args.get('auth'),
                                          args.get('attr'),
                                          args.get('args'))
 
+            # many prefixes are allocated at once when count is given
+            if isinstance(result, list):
+                return jsonify([_mangle_prefix(prefix) for prefix in result])
+
             return jsonify(_mangle_prefix(result))
 
         except (AuthError, NipapError) as exc:
@@ -13,6 +13,7 @@ def get_data_files():
     try:
         publish_cmdline(writer=manpage.Writer(), argv=["nipapd.man.rst", "nipapd.8"])
         publish_cmdline(writer=manpage.Writer(), argv=["nipap-passwd.man.rst", "nipap-passwd.1"])
+        publish_cmdline(writer=manpage.Writer(), argv=["nipap-admin.man.rst", "nipap-admin.1"])
     except OSError as exc:
         print("rst2man failed to run: %s" % str(exc), file=sys.stderr)
         sys.exit(1)
@@ -26,13 +27,15 @@ def get_data_files():
             'sql/upgrade-4-5.plsql',
             'sql/upgrade-5-6.plsql',
             'sql/upgrade-6-7.plsql',
+            'sql/upgrade-7-8.plsql',
+            'sql/upgrade-8-9.plsql',
             'sql/functions.plsql',
             'sql/triggers.plsql',
             'sql/ip_net.plsql',
         ],
         ),
         ('share/man/man8/', ['nipapd.8']),
-        ('share/man/man1/', ['nipap-passwd.1']),
+        ('share/man/man1/', ['nipap-passwd.1', 'nipap-admin.1']),
     ]
 
     return files
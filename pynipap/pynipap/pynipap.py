@@ -679,6 +679,7 @@ class Pool(Pynipap):
     default_type = None
     ipv4_default_prefix_length = None
     ipv6_default_prefix_length = None
+    allocation_strategy = None
     vrf = None
     member_prefixes_v4 = None
     member_prefixes_v6 = None
@@ -725,6 +726,9 @@ class Pool(Pynipap):
             'tags': [],
             'avps': self.avps
         }
+        # leave out to get the default strategy of the backend
+        if self.allocation_strategy is not None:
+            data['allocation_strategy'] = self.allocation_strategy
         for tag_name in self.tags:
             data['tags'].append(tag_name)
 
@@ -898,6 +902,7 @@ class Pool(Pynipap):
         pool.default_type = parm['default_type']
         pool.ipv4_default_prefix_length = parm['ipv4_default_prefix_length']
         pool.ipv6_default_prefix_length = parm['ipv6_default_prefix_length']
+        pool.allocation_strategy = parm['allocation_strategy']
         for val in ('member_prefixes_v4', 'member_prefixes_v6',
                 'used_prefixes_v4', 'used_prefixes_v6', 'free_prefixes_v4',
                 'free_prefixes_v6', 'total_prefixes_v4', 'total_prefixes_v6',
@@ -1080,6 +1085,7 @@ class Prefix(Pynipap):
         result = dict()
         result['result'] = []
         result['search_options'] = search_result['search_options']
+        result['next_cursor'] = search_result.get('next_cursor')
         for prefix in search_result['result']:
             p = Prefix.from_dict(prefix)
             result['result'].append(p)
@@ -1116,6 +1122,7 @@ class Prefix(Pynipap):
         result = dict()
         result['interpretation'] = smart_result['interpretation']
         result['search_options'] = smart_result['search_options']
+        result['next_cursor'] = smart_result.get('next_cursor')
         result['error'] = smart_result['error']
         if 'error_message' in smart_result:
             result['error_message'] = smart_result['error_message']
@@ -1157,24 +1164,10 @@ class Prefix(Pynipap):
 
         return res
 
-    @create_span
-    def save(self, args=None):
-        """ Save prefix to NIPAP.
-
-            If the object represents a new prefix unknown to NIPAP (attribute
-            `id` is `None`) this function maps to the function
-            :py:func:`nipap.backend.Nipap.add_prefix` in the backend, used to
-            create a new prefix. Otherwise it maps to the function
-            :py:func:`nipap.backend.Nipap.edit_prefix` in the backend, used to
-            modify the VRF. Please see the documentation for the backend
-            functions for information regarding input arguments and return
-            values.
+    def _attr_dict(self):
+        """ Get the attributes to send to NIPAP when saving the prefix.
         """
 
-        if args is None:
-            args = {}
-
-        xmlrpc = XMLRPCConnection()
         data = {
             'description': self.description,
             'comment': self.comment,
@@ -1216,25 +1209,138 @@ class Prefix(Pynipap):
                 raise NipapValueError("'pool' attribute not instance of Pool class.")
             data['pool_id'] = self.pool.id
 
+        return data
+
+    @staticmethod
+    def _add_args(args):
+        """ Format the arguments for allocating a prefix.
+        """
+
+        x_args = {}
+        if 'from-pool' in args:
+            x_args['from-pool'] = { 'id': args['from-pool'].id }
+        if 'family' in args:
+            x_args['family'] = args['family']
+        if 'from-prefix' in args:
+            x_args['from-prefix'] = args['from-prefix']
+        if 'prefix_length' in args:
+            x_args['prefix_length'] = args['prefix_length']
+        if 'allocation_strategy' in args:
+            x_args['allocation_strategy'] = args['allocation_strategy']
+
+        return x_args
+
+    @classmethod
+    @create_span
+    def allocate(cls, template, args, count=None, overrides=None):
+        """ Allocate many new prefixes from a pool or prefix at once.
+
+            The new prefixes get the attributes of the Prefix object
+            `template`, overridden per prefix by the dicts in the list
+            `overrides` if given. `args` is formatted as for :func:`save`.
+            Either `count` or `overrides` decide the number of prefixes.
+
+            Maps to the function :py:func:`nipap.backend.Nipap.add_prefix`
+            in the backend. Returns a list of the new prefixes.
+        """
+
+        x_args = cls._add_args(args)
+        if count is not None:
+            x_args['count'] = count
+        if overrides is not None:
+            x_args['overrides'] = overrides
+        if 'count' not in x_args and 'overrides' not in x_args:
+            x_args['count'] = 1
+
+        xmlrpc = XMLRPCConnection()
+        try:
+            add_result = xmlrpc.connection.add_prefix(
+                {
+                    'attr': template._attr_dict(),
+                    'args': x_args,
+                    'auth': template._auth_opts.options
+                })
+        except xmlrpclib.Fault as xml_fault:
+            raise _fault_to_exception(xml_fault)
+
+        res = []
+        for pref in add_result:
+            prefix = Prefix.from_dict(pref)
+            _cache['Prefix'][prefix.id] = prefix
+            res.append(prefix)
+
+        if template.pool is not None:
+            if template.pool.id in _cache['Pool']:
+                del _cache['Pool'][template.pool.id]
+
+        return res
+
+    @classmethod
+    @create_span
+    def add_many(cls, prefixes, atomic=False):
+        """ Add many new prefixes to NIPAP at once.
+
+            Maps to the function :py:func:`nipap.backend.Nipap.add_prefixes`
+            in the backend. The prefixes which were added are updated with
+            the data from NIPAP. Returns a list of dicts describing the
+            prefixes which could not be added, see the documentation for the
+            backend function for details.
+        """
+
+        xmlrpc = XMLRPCConnection()
+        try:
+            add_result = xmlrpc.connection.add_prefixes(
+                {
+                    'attrs': [ p._attr_dict() for p in prefixes ],
+                    'options': { 'atomic': atomic },
+                    'auth': AuthOptions().options
+                })
+        except xmlrpclib.Fault as xml_fault:
+            raise _fault_to_exception(xml_fault)
+
+        # match the added prefixes with the objects, in order skipping the
+        # failed ones
+        failed = set(error['index'] for error in add_result['errors'])
+        added = iter(add_result['result'])
+        for index, prefix in enumerate(prefixes):
+            if index in failed:
+                continue
+            Prefix.from_dict(next(added), prefix)
+            _cache['Prefix'][prefix.id] = prefix
+            if prefix.pool is not None:
+                if prefix.pool.id in _cache['Pool']:
+                    del _cache['Pool'][prefix.pool.id]
+
+        return add_result['errors']
+
+    @create_span
+    def save(self, args=None):
+        """ Save prefix to NIPAP.
+
+            If the object represents a new prefix unknown to NIPAP (attribute
+            `id` is `None`) this function maps to the function
+            :py:func:`nipap.backend.Nipap.add_prefix` in the backend, used to
+            create a new prefix. Otherwise it maps to the function
+            :py:func:`nipap.backend.Nipap.edit_prefix` in the backend, used to
+            modify the VRF. Please see the documentation for the backend
+            functions for information regarding input arguments and return
+            values.
+        """
+
+        if args is None:
+            args = {}
+
+        xmlrpc = XMLRPCConnection()
+        data = self._attr_dict()
+
         # New object, create from scratch
         if self.id is None:
 
-            # format args
-            x_args = {}
-            if 'from-pool' in args:
-                x_args['from-pool'] = { 'id': args['from-pool'].id }
-            if 'family' in args:
-                x_args['family'] = args['family']
-            if 'from-prefix' in args:
-                x_args['from-prefix'] = args['from-prefix']
-            if 'prefix_length' in args:
-                x_args['prefix_length'] = args['prefix_length']
-
             try:
                 prefix = xmlrpc.connection.add_prefix(
                     {
                         'attr': data,
-                        'args': x_args,
+                        'args': self._add_args(args),
                         'auth': self._auth_opts.options
                     })
             except xmlrpclib.Fault as xml_fault:
@@ -9,10 +9,12 @@
 #
 
 import datetime
+import io
 import logging
 import unittest
 import sys
 import os
+import threading
 import time
 
 MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -264,6 +266,37 @@ class TestPrefixIndent(unittest.TestCase):
         self.assertEqual(expected, result)
 
 
+    def test_prefix_add_intermediate(self):
+        """ Verify only the direct children are updated when adding and
+            removing a prefix in the middle of the tree
+        """
+        th = TestHelper()
+        p1 = th.add_prefix('192.168.0.0/16', 'reservation', 'test')
+        p2 = th.add_prefix('192.168.0.0/22', 'reservation', 'test')
+        p3 = th.add_prefix('192.168.0.0/24', 'reservation', 'test')
+
+        n = Nipap()
+        def row_version(prefix):
+            with n._db_connection():
+                n._execute("SELECT xmin::text AS xmin FROM ip_net_plan WHERE id = %s", (prefix.id,))
+                return n._curs_pg.fetchone()['xmin']
+        p3_version = row_version(p3)
+
+        p4 = th.add_prefix('192.168.0.0/20', 'reservation', 'test')
+
+        res = Prefix.smart_search('0.0.0.0/0', {})
+        self.assertEqual([[p1.prefix, 0], [p4.prefix, 1], [p2.prefix, 2], [p3.prefix, 3]],
+                         [[p.prefix, p.indent] for p in res['result']])
+        self.assertEqual(p3_version, row_version(p3))
+
+        p4.remove()
+
+        res = Prefix.smart_search('0.0.0.0/0', {})
+        self.assertEqual([[p1.prefix, 0], [p2.prefix, 1], [p3.prefix, 2]],
+                         [[p.prefix, p.indent] for p in res['result']])
+        self.assertEqual(p3_version, row_version(p3))
+
+
 
 class TestPrefixTags(unittest.TestCase):
     """ Test prefix tag calculation
@@ -337,6 +370,45 @@ class TestPrefixTags(unittest.TestCase):
         self.assertEqual(['b'], list(res['result'][5].inherited_tags.keys()))
 
 
+    def test_tags_subtree(self):
+        """ Verify tags of a whole subtree follow changes in the middle of it
+        """
+        th = TestHelper()
+        p1 = th.add_prefix('1.0.0.0/8', 'reservation', 'test', tags=['a'])
+        p2 = th.add_prefix('1.0.0.0/16', 'reservation', 'test', tags=['b'])
+        th.add_prefix('1.0.0.0/24', 'reservation', 'test', tags=['c'])
+        th.add_prefix('1.0.0.0/28', 'reservation', 'test')
+        th.add_prefix('1.0.1.0/24', 'reservation', 'test', tags=['a'])
+
+        def inherited():
+            return dict((p.prefix, sorted(p.inherited_tags.keys())) for p in
+                    Prefix.smart_search('1.0.0.0/8', {})['result'])
+
+        self.assertEqual(inherited(), {
+            '1.0.0.0/8': [],
+            '1.0.0.0/16': ['a'],
+            '1.0.0.0/24': ['a', 'b'],
+            '1.0.0.0/28': ['a', 'b', 'c'],
+            '1.0.1.0/24': ['a', 'b'],
+            })
+
+        p2.tags = ['d']
+        p2.save()
+        self.assertEqual(inherited()['1.0.0.0/28'], ['a', 'c', 'd'])
+
+        p1.tags = []
+        p1.save()
+        self.assertEqual(inherited()['1.0.0.0/28'], ['c', 'd'])
+
+        p2.remove()
+        self.assertEqual(inherited(), {
+            '1.0.0.0/8': [],
+            '1.0.0.0/24': [],
+            '1.0.0.0/28': ['c'],
+            '1.0.1.0/24': [],
+            })
+
+
 
 class TestPrefixChildren(unittest.TestCase):
     """ Test calculation of children prefixes
@@ -1016,6 +1088,41 @@ class TestPoolStatistics(unittest.TestCase):
 
 
 
+    def test_stats_default_prefix_length(self):
+        """ Check free prefixes follow the default prefix length of the pool
+        """
+        th = TestHelper()
+
+        pool1 = th.add_pool('test', 'assignment', 28, 64)
+        p1 = th.add_prefix('1.0.0.0/24', 'reservation', 'test', pool_id=pool1.id)
+
+        # a /30 takes up a whole /28 out of the 16 that fit in the member
+        pc1 = th.add_prefix('1.0.0.4/30', 'reservation', 'foo')
+        res = Pool.get(pool1.id)
+        self.assertEqual(1, res.used_prefixes_v4)
+        self.assertEqual(15, res.free_prefixes_v4)
+        self.assertEqual(16, res.total_prefixes_v4)
+
+        # and a whole /26 out of 4 once that is the default prefix length
+        res.ipv4_default_prefix_length = 26
+        res.save()
+        res = Pool.get(pool1.id)
+        self.assertEqual(3, res.free_prefixes_v4)
+        self.assertEqual(4, res.total_prefixes_v4)
+
+        pc1.remove()
+        res = Pool.get(pool1.id)
+        self.assertEqual(0, res.used_prefixes_v4)
+        self.assertEqual(4, res.free_prefixes_v4)
+        self.assertEqual(4, res.total_prefixes_v4)
+
+        res.ipv4_default_prefix_length = None
+        res.save()
+        res = Pool.get(pool1.id)
+        self.assertEqual(None, res.free_prefixes_v4)
+        self.assertEqual(None, res.total_prefixes_v4)
+
+
 class TestPrefixStatistics(unittest.TestCase):
     """ Test calculation of statistics for prefixes
     """
@@ -1343,6 +1450,87 @@ class TestVrf(unittest.TestCase):
         self.assertEqual("123.123.123.123:456", VRF.list({"name": "test-vrf"})[0].rt)
 
 
+    def test_vrf_order(self):
+        """ Check VRFs and their prefixes are sorted on RT
+        """
+        for rt in ('1.3.3.7:456', '1234:456', '199:456'):
+            v = VRF()
+            v.rt = rt
+            v.name = 'test-vrf-%s' % rt
+            v.save()
+
+            p = Prefix()
+            p.prefix = '1.3.0.0/16'
+            p.type = 'reservation'
+            p.vrf = v
+            p.save()
+
+        self.assertEqual([None, '199:456', '1234:456', '1.3.3.7:456'],
+                [v.rt for v in VRF.list()])
+        res = Prefix.search({'operator': 'equals', 'val1': 'prefix', 'val2': '1.3.0.0/16'})
+        self.assertEqual(['199:456', '1234:456', '1.3.3.7:456'],
+                [p.vrf.rt for p in res['result']])
+        self.assertEqual(['199:456', '1234:456', '1.3.3.7:456'],
+                [p.vrf.rt for p in Prefix.list({'prefix': '1.3.0.0/16'})])
+
+        # changing the RT moves the VRF along with its prefixes
+        v = VRF.list({'rt': '1234:456'})[0]
+        v.rt = '99:456'
+        v.save()
+        self.assertEqual([None, '99:456', '199:456', '1.3.3.7:456'],
+                [v.rt for v in VRF.list()])
+        res = Prefix.search({'operator': 'equals', 'val1': 'prefix', 'val2': '1.3.0.0/16'})
+        self.assertEqual(['99:456', '199:456', '1.3.3.7:456'],
+                [p.vrf.rt for p in res['result']])
+        self.assertEqual(['99:456', '199:456', '1.3.3.7:456'],
+                [p.vrf.rt for p in Prefix.list({'prefix': '1.3.0.0/16'})])
+
+
+    def test_remove_vrf(self):
+        """ Remove a VRF with prefixes and check its pool is emptied
+        """
+        v = VRF()
+        v.rt = '123:456'
+        v.name = 'test-vrf'
+        v.save()
+
+        th = TestHelper()
+        pool1 = th.add_pool('test', 'assignment', 28, 112)
+        for prefix, type in (('1.3.0.0/16', 'reservation'), ('1.3.1.0/24', 'assignment'),
+                ('1.3.1.1/32', 'host'), ('2001:db8::/32', 'reservation')):
+            p = Prefix()
+            p.prefix = prefix
+            p.type = type
+            p.status = 'assigned'
+            p.vrf = v
+            if type == 'reservation':
+                p.pool = pool1
+            p.save()
+        p0 = th.add_prefix('1.3.0.0/16', 'reservation', 'test')
+
+        v.remove()
+
+        self.assertEqual([p.id for p in Prefix.list()], [p0.id])
+        pool = Pool.get(pool1.id)
+        self.assertEqual(pool.member_prefixes_v4, 0)
+        self.assertEqual(pool.member_prefixes_v6, 0)
+        self.assertEqual(pool.used_prefixes_v4, 0)
+        self.assertEqual(pool.total_addresses_v4, 0)
+        self.assertEqual(pool.free_prefixes_v4, None)
+        self.assertEqual(VRF.get(0).num_prefixes_v4, 1)
+
+        n = Nipap()
+        auth = SqliteAuth('local', 'unittest', 'gottatest', 'nipap')
+        auth.authenticate()
+        self.assertEqual(n.verify_stats(auth), [])
+
+        # the removal is logged as a single entry for the VRF
+        with n._db_connection():
+            n._execute("SELECT description FROM ip_net_log WHERE vrf_id = %s AND description LIKE 'Removed%%'", (v.id,))
+            log = [row['description'] for row in n._curs_pg]
+        self.assertEqual(log, ['Removed vrf 123:456 with 4 prefixes'])
+
+
 
 class TestVrfStatistics(unittest.TestCase):
     """ Test calculation of statistics for VRFs
@@ -1580,6 +1768,125 @@ class TestAddressListing(unittest.TestCase):
         self.assertEqual(expected, result)
 
 
+    def testCursorPaging(self):
+        """ Page through a search result using the 'after' cursor
+        """
+
+        th = TestHelper()
+        th.add_prefix('192.168.0.0/16', 'reservation', 'root')
+        th.add_prefix('192.168.0.0/20', 'reservation', 'test')
+        th.add_prefix('192.168.0.0/24', 'reservation', 'test')
+        th.add_prefix('192.168.1.0/24', 'assignment', 'test')
+        th.add_prefix('192.168.1.1/32', 'host', 'test')
+        th.add_prefix('192.168.1.2/32', 'host', 'test')
+        th.add_prefix('192.168.2.0/24', 'reservation', 'test')
+        th.add_prefix('192.168.32.0/20', 'reservation', 'test')
+
+        v = VRF()
+        v.rt = '123:456'
+        v.name = 'test-vrf'
+        v.save()
+        for prefix in ('10.0.0.0/8', '10.0.0.0/16', '10.1.0.0/16'):
+            p = Prefix()
+            p.prefix = prefix
+            p.type = 'reservation'
+            p.description = 'test'
+            p.vrf = v
+            p.save()
+
+        for search_options in ({}, { 'children_depth': -1 }, { 'parents_depth': -1, 'include_neighbors': True }):
+            opts = dict(search_options)
+            opts['max_result'] = False
+            expected = [ (p.vrf.rt, p.prefix) for p in Prefix.smart_search('test', opts)['result'] ]
+
+            result = []
+            after = None
+            while True:
+                opts = dict(search_options)
+                opts['max_result'] = 3
+                opts['after'] = after
+                res = Prefix.smart_search('test', opts)
+                result += [ (p.vrf.rt, p.prefix) for p in res['result'] ]
+                if res['next_cursor'] is None:
+                    break
+                after = res['next_cursor']
+
+            if 'parents_depth' in search_options:
+                # parents are repeated on the pages of their children
+                self.assertEqual(sorted(set(result), key=expected.index), expected)
+            else:
+                self.assertEqual(expected, result)
+
+        with self.assertRaisesRegex(NipapValueError, "Invalid value for option 'after'"):
+            Prefix.smart_search('test', { 'after': 'foo' })
+
+
+    def testCursorPagingParents(self):
+        """ Page through a nested tree with the parents of the matches
+        """
+
+        th = TestHelper()
+        parent = {}
+        for prefix, prefix_type, description, parent_prefix in (
+                ('10.0.0.0/8', 'reservation', 'root', None),
+                ('10.1.0.0/16', 'reservation', 'mid', '10.0.0.0/8'),
+                ('10.1.1.0/24', 'reservation', 'test', '10.1.0.0/16'),
+                ('10.2.0.0/16', 'reservation', 'test', '10.0.0.0/8'),
+                ('10.2.1.0/24', 'assignment', 'mid', '10.2.0.0/16'),
+                ('10.2.1.1/32', 'host', 'test', '10.2.1.0/24'),
+                ('10.3.0.0/16', 'reservation', 'test', '10.0.0.0/8')):
+            th.add_prefix(prefix, prefix_type, description)
+            parent[prefix] = parent_prefix
+
+        for parents_depth in (1, -1):
+            expected = [ p.prefix for p in Prefix.smart_search('test',
+                { 'parents_depth': parents_depth, 'max_result': False })['result'] ]
+
+            for max_result in (1, 2, 3):
+                result = []
+                after = None
+                while True:
+                    res = Prefix.smart_search('test', { 'parents_depth': parents_depth,
+                        'max_result': max_result, 'after': after })
+                    page = [ p.prefix for p in res['result'] ]
+                    self.assertEqual(page, sorted(page, key=expected.index))
+
+                    # the parents of the matches are on the same page
+                    for p in res['result']:
+                        if p.match and parent[p.prefix] is not None:
+                            self.assertIn(parent[p.prefix], page)
+
+                    result += page
+                    if res['next_cursor'] is None:
+                        break
+                    after = res['next_cursor']
+
+                self.assertEqual(sorted(set(result), key=expected.index), expected)
+
+
+    def testInOperator(self):
+        """ Search prefixes with the 'in' operator on typed columns
+        """
+
+        th = TestHelper()
+        th.add_prefix('192.168.0.0/16', 'reservation', 'test')
+        th.add_prefix('192.168.1.0/24', 'assignment', 'test')
+        th.add_prefix('192.168.1.1/32', 'host', 'test')
+
+        res = Prefix.search({ 'operator': 'in', 'val1': 'prefix',
+                              'val2': ['192.168.0.0/16', '192.168.1.1/32', '10.0.0.0/8'] })
+        self.assertEqual([ p.prefix for p in res['result'] ], ['192.168.0.0/16', '192.168.1.1/32'])
+
+        res = Prefix.search({ 'operator': 'in', 'val1': 'type', 'val2': ['assignment', 'host'] })
+        self.assertEqual([ p.prefix for p in res['result'] ], ['192.168.1.0/24', '192.168.1.1/32'])
+
+        res = Prefix.search({ 'operator': 'in', 'val1': 'type', 'val2': [] })
+        self.assertEqual(res['result'], [])
+
+        with self.assertRaisesRegex(NipapValueError, "Operator 'in' requires a list"):
+            Prefix.search({ 'operator': 'in', 'val1': 'type', 'val2': 'host' })
+
+
 
 class TestPrefixLastModified(unittest.TestCase):
     """ Test updates of the last modified value
@@ -1611,6 +1918,612 @@ class TestPrefixLastModified(unittest.TestCase):
         self.assertNotEqual(p1.added, p1.last_modified)
 
 
+    def test_inherited_tags(self):
+        """ The last_modified timestamp of children should be updated when
+            their inherited tags change
+        """
+        th = TestHelper()
+        p1 = th.add_prefix('1.3.0.0/16', 'reservation', 'test')
+        p2 = th.add_prefix('1.3.1.0/24', 'assignment', 'test')
+
+        time.sleep(1)
+
+        p1.tags = ['foo']
+        p1.save()
+
+        p2 = Prefix.get(p2.id)
+        self.assertEqual(['foo'], list(p2.inherited_tags.keys()))
+        self.assertNotEqual(p2.added, p2.last_modified)
+
+
+
+class TestFindFreePrefix(unittest.TestCase):
+    """ Test finding free prefixes
+    """
+
+    def setUp(self):
+        """ Test setup, which essentially means to empty the database
+        """
+        TestHelper.clear_database()
+
+    def test_fragmented(self):
+        """ Find free prefixes in between used ones
+        """
+        th = TestHelper()
+        th.add_prefix('1.3.0.0/16', 'reservation', 'test')
+        th.add_prefix('1.3.0.0/24', 'reservation', 'test')
+        th.add_prefix('1.3.1.128/25', 'reservation', 'test')
+        th.add_prefix('1.3.1.128/26', 'reservation', 'test')
+        th.add_prefix('1.3.2.0/23', 'reservation', 'test')
+        th.add_prefix('1.3.4.64/26', 'assignment', 'test')
+        th.add_prefix('1.3.4.65/32', 'host', 'test')
+
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.0.0/16'], 'prefix_length': 24, 'count': 3 }),
+                ['1.3.5.0/24', '1.3.6.0/24', '1.3.7.0/24'])
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.0.0/16'], 'prefix_length': 25, 'count': 3 }),
+                ['1.3.1.0/25', '1.3.4.128/25', '1.3.5.0/25'])
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.0.0/16'], 'prefix_length': 26, 'count': 3 }),
+                ['1.3.1.0/26', '1.3.1.64/26', '1.3.4.0/26'])
+        # the search prefix itself is taken
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.0.0/24'], 'prefix_length': 24, 'count': 1 }),
+                [])
+        # network and broadcast address are not handed out
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.4.64/26'], 'prefix_length': 32, 'count': 2 }),
+                ['1.3.4.66', '1.3.4.67'])
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.4.64/26'], 'prefix_length': 32,
+            'count': 100 })[-1], '1.3.4.126')
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.1.0/31'], 'prefix_length': 32, 'count': 100 }),
+                ['1.3.1.0', '1.3.1.1'])
+
+    def test_changes(self):
+        """ Find free prefixes as prefixes are added, changed and removed
+        """
+        th = TestHelper()
+        pool = th.add_pool('test', 'assignment', 26, 64)
+        th.add_prefix('1.3.0.0/24', 'reservation', 'test', pool_id=pool.id)
+        p1 = th.add_prefix('1.3.0.64/26', 'reservation', 'test')
+        p2 = th.add_prefix('1.3.0.128/26', 'reservation', 'test')
+
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.0.0/24'], 'prefix_length': 26, 'count': 4 }),
+                ['1.3.0.0/26', '1.3.0.192/26'])
+        self.assertEqual(Pool.get(pool.id).free_prefixes_v4, 2)
+
+        # removing a prefix merges the free ranges around it
+        p1.remove()
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.0.0/24'], 'prefix_length': 25, 'count': 4 }),
+                ['1.3.0.0/25'])
+        self.assertEqual(Pool.get(pool.id).free_prefixes_v4, 3)
+
+        # as does moving one
+        p2.prefix = '1.3.0.0/26'
+        p2.save()
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.0.0/24'], 'prefix_length': 25, 'count': 4 }),
+                ['1.3.0.128/25'])
+        self.assertEqual(Pool.get(pool.id).free_prefixes_v4, 3)
+
+        # a prefix covering existing ones
+        th.add_prefix('1.3.0.0/25', 'reservation', 'test')
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.0.0/24'], 'prefix_length': 26, 'count': 4 }),
+                ['1.3.0.128/26', '1.3.0.192/26'])
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.3.0.0/25'], 'prefix_length': 26, 'count': 4 }),
+                ['1.3.0.64/26'])
+        self.assertEqual(Pool.get(pool.id).free_prefixes_v4, 2)
+
+    def test_allocation_strategy(self):
+        """ Find free prefixes using the different allocation strategies
+        """
+        th = TestHelper()
+        pool = th.add_pool('test', 'assignment', 26, 64)
+        pool.allocation_strategy = 'next-fit'
+        pool.save()
+        th.add_prefix('1.3.0.0/24', 'reservation', 'test', pool_id=pool.id)
+
+        def allocate():
+            p = Prefix()
+            p.type = 'assignment'
+            p.status = 'assigned'
+            p.description = 'test'
+            p.save({ 'from-pool': pool, 'family': 4 })
+            return p
+
+        p1 = allocate()
+        p2 = allocate()
+        self.assertEqual([p1.prefix, p2.prefix], ['1.3.0.0/26', '1.3.0.64/26'])
+
+        # next-fit continues after the last allocation instead of filling holes
+        p1.remove()
+        self.assertEqual(allocate().prefix, '1.3.0.128/26')
+        self.assertEqual(allocate().prefix, '1.3.0.192/26')
+        # and wraps around when reaching the end of the pool
+        self.assertEqual(allocate().prefix, '1.3.0.0/26')
+        self.assertEqual(Prefix.find_free(None, { 'from-pool': { 'id': pool.id }, 'family': 4 }), [])
+
+        # the strategy of the pool can be overridden
+        th.add_prefix('1.4.0.0/24', 'reservation', 'test', pool_id=pool.id)
+        self.assertEqual(Prefix.find_free(None, { 'from-pool': { 'id': pool.id }, 'family': 4,
+            'prefix_length': 27, 'count': 2, 'allocation_strategy': 'first-fit' }),
+                ['1.4.0.0/27', '1.4.0.32/27'])
+
+        # sparse allocation spreads prefixes out over the largest free blocks
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.4.0.0/24'], 'prefix_length': 27,
+            'count': 5, 'allocation_strategy': 'sparse' }),
+                ['1.4.0.0/27', '1.4.0.128/27', '1.4.0.64/27', '1.4.0.192/27', '1.4.0.32/27'])
+        th.add_prefix('1.4.0.0/26', 'reservation', 'test')
+        self.assertEqual(Prefix.find_free(None, { 'from-prefix': ['1.4.0.0/24'], 'prefix_length': 27,
+            'count': 3, 'allocation_strategy': 'sparse' }),
+                ['1.4.0.128/27', '1.4.0.64/27', '1.4.0.192/27'])
+
+        with self.assertRaisesRegex(NipapValueError, 'Allocation strategy must be one of'):
+            Prefix.find_free(None, { 'from-prefix': ['1.4.0.0/24'], 'prefix_length': 27,
+                'allocation_strategy': 'worst-fit' })
+
+    def test_concurrent_allocation(self):
+        """ Concurrent allocations from a pool all get a prefix of their own
+        """
+        th = TestHelper()
+        pool = th.add_pool('test', 'assignment', 28, 64)
+        th.add_prefix('1.3.0.0/24', 'reservation', 'test', pool_id=pool.id)
+
+        auth = SqliteAuth('local', 'unittest', 'gottatest', 'nipap')
+        auth.authenticate()
+        results = []
+        errors = []
+
+        def allocate():
+            try:
+                res = Nipap().add_prefix(auth, { 'type': 'assignment', 'status': 'assigned',
+                    'description': 'test' }, { 'from-pool': { 'id': pool.id }, 'family': 4 })
+                results.append(res['prefix'])
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=allocate) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(results, key=lambda p: int(p.split('.')[3].split('/')[0])),
+                ['1.3.0.%d/28' % (i * 16) for i in range(8)])
+
+    def test_batched_allocation(self):
+        """ Concurrent allocations from a pool are handled in one batch
+        """
+        th = TestHelper()
+        pool = th.add_pool('test', 'assignment', 28, 64)
+        th.add_prefix('1.3.0.0/27', 'reservation', 'test', pool_id=pool.id)
+
+        auth = SqliteAuth('local', 'unittest', 'gottatest', 'nipap')
+        auth.authenticate()
+        results = []
+        errors = []
+
+        # one instance shared by threads, like the XML-RPC API does
+        n = Nipap()
+        find_free_prefix = n.find_free_prefix
+        calls = []
+        def counting_find_free_prefix(*args):
+            calls.append(args)
+            return find_free_prefix(*args)
+        n.find_free_prefix = counting_find_free_prefix
+
+        def allocate(description):
+            try:
+                res = n.add_prefix(auth, { 'type': 'assignment', 'status': 'assigned',
+                    'description': description }, { 'from-pool': { 'id': pool.id }, 'family': 4 })
+                results.append((res['prefix'], res['description']))
+            except Exception as exc:
+                errors.append(exc)
+
+        # no database connections are held while waiting for the batch
+        used = []
+        def sample_used():
+            time.sleep(0.1)
+            used.append(n._pool._used)
+
+        cfg = NipapConfig('/etc/nipap/nipap.conf')
+        cfg.set('nipapd', 'allocation_batch_window', '200')
+        try:
+            threads = [threading.Thread(target=allocate, args=('test %d' % i,)) for i in range(3)]
+            threads.append(threading.Thread(target=sample_used))
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            cfg.set('nipapd', 'allocation_batch_window', '0')
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(used, [0])
+        self.assertEqual(sorted(p for p, d in results), ['1.3.0.0/28', '1.3.0.16/28'])
+        self.assertEqual(len(set(d for p, d in results)), 2)
+        # the pool only has room for two of the three prefixes
+        self.assertEqual(len(errors), 1)
+        self.assertIsInstance(errors[0], nipap.backend.NipapNonExistentError)
+
+
+
+class TestAllocateMany(unittest.TestCase):
+    """ Test allocating many prefixes at once
+    """
+
+    def setUp(self):
+        """ Test setup, which essentially means to empty the database
+        """
+        TestHelper.clear_database()
+
+    def test_from_pool(self):
+        """ Allocate prefixes from a pool using a template
+        """
+        th = TestHelper()
+        pool = th.add_pool('test', 'assignment', 24, 64)
+        th.add_prefix('2001:db8::/60', 'reservation', 'test', pool_id=pool.id)
+
+        template = Prefix()
+        template.type = 'assignment'
+        template.status = 'assigned'
+        template.description = 'customer'
+        template.tags = ['cust']
+
+        res = Prefix.allocate(template, { 'from-pool': pool, 'family': 6 }, count=3)
+        self.assertEqual([p.prefix for p in res], ['2001:db8::/64', '2001:db8:0:1::/64', '2001:db8:0:2::/64'])
+        self.assertEqual([p.description for p in res], ['customer'] * 3)
+        self.assertEqual(list(res[0].tags), ['cust'])
+
+        # per prefix overrides
+        res = Prefix.allocate(template, { 'from-pool': pool, 'family': 6 },
+                overrides=[{ 'description': 'customer 1' }, { 'description': 'customer 2', 'customer_id': 'c2' }])
+        self.assertEqual([(p.prefix, p.description, p.customer_id) for p in res],
+                [('2001:db8:0:3::/64', 'customer 1', None), ('2001:db8:0:4::/64', 'customer 2', 'c2')])
+
+        # nothing is added unless all prefixes fit
+        with self.assertRaisesRegex(NipapNonExistentError, 'only 11 of 12'):
+            Prefix.allocate(template, { 'from-pool': pool, 'family': 6 }, count=12)
+        self.assertEqual(len(Prefix.list({ 'type': 'assignment' })), 5)
+
+        with self.assertRaisesRegex(NipapValueError, 'count and the number of overrides differ'):
+            Prefix.allocate(template, { 'from-pool': pool, 'family': 6 }, count=2, overrides=[{}])
+
+    def test_from_prefix(self):
+        """ Allocate prefixes from a prefix
+        """
+        th = TestHelper()
+        th.add_prefix('1.3.0.0/24', 'reservation', 'test')
+        th.add_prefix('1.3.0.64/26', 'assignment', 'test')
+
+        template = Prefix()
+        template.type = 'assignment'
+        template.status = 'assigned'
+        template.description = 'test'
+        res = Prefix.allocate(template, { 'from-prefix': ['1.3.0.0/24'], 'prefix_length': 26 }, count=3)
+        self.assertEqual([p.prefix for p in res], ['1.3.0.0/26', '1.3.0.128/26', '1.3.0.192/26'])
+
+
+
+class TestAddPrefixes(unittest.TestCase):
+    """ Test adding many prefixes at once
+    """
+
+    def setUp(self):
+        """ Test setup, which essentially means to empty the database
+        """
+        TestHelper.clear_database()
+
+    def test_add_many(self):
+        """ Add prefixes to a pool in one call and check they are updated
+        """
+        th = TestHelper()
+        pool1 = th.add_pool('test', 'assignment', 31, 112)
+
+        prefixes = []
+        for prefix in ('1.3.0.0/24', '1.3.1.0/24', '1.3.1.0/24', '2001:db8::/48'):
+            p = Prefix()
+            p.prefix = prefix
+            p.type = 'reservation'
+            p.description = 'test'
+            p.pool = pool1
+            prefixes.append(p)
+
+        errors = Prefix.add_many(prefixes)
+        self.assertEqual([ e['index'] for e in errors ], [2])
+        self.assertIn("Duplicate value for 'prefix'", errors[0]['message'])
+        self.assertIsNotNone(prefixes[0].id)
+        self.assertIsNone(prefixes[2].id)
+        self.assertEqual(prefixes[3].family, 6)
+        self.assertEqual(Prefix.get(prefixes[1].id).description, 'test')
+
+        # pool statistics are maintained as usual
+        res = Pool.get(pool1.id)
+        self.assertEqual(2, res.member_prefixes_v4)
+        self.assertEqual(1, res.member_prefixes_v6)
+        self.assertEqual(512, res.total_addresses_v4)
+
+        # nothing is added if one fails
+        p = Prefix()
+        p.prefix = '1.3.2.0/24'
+        p.type = 'reservation'
+        p.description = 'test'
+        with self.assertRaisesRegex(NipapDuplicateError, "Duplicate value"):
+            Prefix.add_many([p, prefixes[2]], atomic=True)
+        self.assertEqual(len(Prefix.list()), 3)
+
+    def test_add_many_nested(self):
+        """ Add nested prefixes, children first, in one call
+        """
+        attrs = (('1.3.1.1/32', 'host'), ('1.3.1.2/32', 'host'),
+                 ('1.3.1.0/24', 'assignment'), ('1.3.2.0/24', 'assignment'),
+                 ('1.3.0.0/16', 'reservation'), ('1.0.0.0/8', 'reservation'))
+        prefixes = []
+        for prefix, prefix_type in attrs:
+            p = Prefix()
+            p.prefix = prefix
+            p.type = prefix_type
+            prefixes.append(p)
+
+        self.assertEqual(Prefix.add_many(prefixes), [])
+
+        res = { p.prefix: p for p in Prefix.smart_search('0.0.0.0/0', {})['result'] }
+        self.assertEqual(res['1.0.0.0/8'].children, 1)
+        self.assertEqual(res['1.0.0.0/8'].used_addresses, 65536)
+        self.assertEqual(res['1.3.0.0/16'].children, 2)
+        self.assertEqual(res['1.3.0.0/16'].used_addresses, 512)
+        self.assertEqual(res['1.3.0.0/16'].indent, 1)
+        self.assertEqual(res['1.3.1.0/24'].children, 2)
+        self.assertEqual(res['1.3.1.0/24'].used_addresses, 2)
+        self.assertEqual(res['1.3.1.1/32'].indent, 3)
+        # the result is in the order given
+        for p, (prefix, prefix_type) in zip(prefixes, attrs):
+            self.assertEqual(res[prefix].id, p.id)
+
+    def test_insert_nested(self):
+        """ Insert nested prefixes in one statement, children first
+        """
+        n = Nipap()
+        n._execute("INSERT INTO ip_net_plan (prefix, type, description, tags) VALUES "
+                   "('1.3.3.0/24', 'reservation', 'test', '{}'), "
+                   "('1.3.3.0/28', 'reservation', 'test', '{}'), "
+                   "('1.3.0.0/16', 'reservation', 'test', '{b}'), "
+                   "('1.0.0.0/8', 'reservation', 'test', '{a}')")
+
+        res = {p.prefix: p for p in Prefix.smart_search('1.0.0.0/8', {})['result']}
+        self.assertEqual([res[p].children for p in ('1.0.0.0/8', '1.3.0.0/16', '1.3.3.0/24', '1.3.3.0/28')],
+                         [1, 1, 1, 0])
+        self.assertEqual([res[p].indent for p in ('1.0.0.0/8', '1.3.0.0/16', '1.3.3.0/24', '1.3.3.0/28')],
+                         [0, 1, 2, 3])
+        self.assertEqual(res['1.3.0.0/16'].used_addresses, 256)
+        self.assertEqual(res['1.3.3.0/24'].free_addresses, 240)
+        self.assertEqual(sorted(res['1.3.3.0/28'].inherited_tags), ['a', 'b'])
+
+        vrf = VRF.get(0)
+        self.assertEqual(vrf.num_prefixes_v4, 4)
+        self.assertEqual(vrf.used_addresses_v4, 65536)
+
+        auth = SqliteAuth('local', 'unittest', 'gottatest', 'nipap')
+        auth.authenticate()
+        self.assertEqual(n.verify_stats(auth), [])
+
+
+
+class TestBulkLoadPrefixes(unittest.TestCase):
+    """ Test loading prefixes in bulk
+    """
+
+    def setUp(self):
+        """ Test setup, which essentially means to empty the database
+        """
+        TestHelper.clear_database()
+
+    def test_bulk_load(self):
+        """ Load prefixes and check the tree and statistics are rebuilt
+        """
+        th = TestHelper()
+        pool1 = th.add_pool('test', 'assignment', 31, 112)
+
+        n = Nipap()
+        auth = SqliteAuth('local', 'unittest', 'gottatest', 'nipap')
+        auth.authenticate()
+        csv_file = io.StringIO(
+            "prefix,type,description,tags,pool_name,node\n"
+            "1.3.3.1/32,host,host 1,,,router1\n"
+            "1.3.3.0/24,assignment,\"assignment, 1\",{b},,\n"
+            "1.3.0.0/16,reservation,reservation,\"{a,b}\",test,\n"
+            "1.3.3.2/32,host,host 2,,,\n"
+            "1.3.4.0/24,assignment,assignment 2,,,\n"
+        )
+        self.assertEqual(n.bulk_load_prefixes(auth, csv_file), 5)
+
+        res = {p.prefix: p for p in Prefix.smart_search('1.3.0.0/16', {})['result']}
+        self.assertEqual(res['1.3.0.0/16'].indent, 0)
+        self.assertEqual(res['1.3.0.0/16'].children, 2)
+        self.assertEqual(res['1.3.0.0/16'].used_addresses, 512)
+        self.assertEqual(res['1.3.3.0/24'].indent, 1)
+        self.assertEqual(res['1.3.3.0/24'].children, 2)
+        self.assertEqual(sorted(res['1.3.3.0/24'].inherited_tags.keys()), ['a', 'b'])
+        self.assertEqual(res['1.3.3.1/32'].indent, 2)
+        self.assertEqual(res['1.3.3.1/32'].display_prefix, '1.3.3.1/24')
+        self.assertEqual(res['1.3.3.1/32'].node, 'router1')
+        self.assertEqual(res['1.3.3.1/32'].status, 'assigned')
+
+        vrf = VRF.get(0)
+        self.assertEqual(vrf.num_prefixes_v4, 5)
+        self.assertEqual(vrf.used_addresses_v4, 512)
+        pool = Pool.get(pool1.id)
+        self.assertEqual(pool.member_prefixes_v4, 1)
+        self.assertEqual(pool.used_prefixes_v4, 2)
+
+        # the triggers take over again once loaded
+        th.add_prefix('1.3.0.0/20', 'reservation', 'test')
+        res = {p.prefix: p for p in Prefix.smart_search('1.3.0.0/16', {})['result']}
+        self.assertEqual(res['1.3.0.0/16'].children, 1)
+        self.assertEqual(res['1.3.3.1/32'].indent, 3)
+
+    def test_bulk_load_invalid(self):
+        """ Nothing is loaded if a prefix is invalid
+        """
+        n = Nipap()
+        auth = SqliteAuth('local', 'unittest', 'gottatest', 'nipap')
+        auth.authenticate()
+
+        csv_file = io.StringIO(
+            "prefix,type,description\n"
+            "1.3.0.0/16,reservation,test\n"
+            "1.3.3.1/32,host,test\n"
+        )
+        with self.assertRaisesRegex(nipap.backend.NipapValueError, "must be of type 'assignment'"):
+            n.bulk_load_prefixes(auth, csv_file)
+        self.assertEqual(Prefix.list(), [])
+
+        csv_file = io.StringIO("prefix,type,description,vrf_rt\n1.3.0.0/16,reservation,test,123:456\n")
+        with self.assertRaisesRegex(nipap.backend.NipapNonExistentError, "No VRF"):
+            n.bulk_load_prefixes(auth, csv_file)
+
+        csv_file = io.StringIO("prefix,type,description,indent\n")
+        with self.assertRaises(nipap.backend.NipapExtraneousInputError):
+            n.bulk_load_prefixes(auth, csv_file)
+
+        th = TestHelper()
+        th.add_prefix('1.3.0.0/16', 'reservation', 'test')
+        th.add_prefix('1.3.3.0/24', 'assignment', 'test')
+        self.assertEqual(Prefix.smart_search('1.3.0.0/16', {})['result'][0].children, 1)
+
+    def test_bulk_load_local_auth(self):
+        """ Load prefixes as the local user, as nipapd --bulk-load does
+        """
+        n = Nipap()
+        auth = nipap.authlib.local_auth()
+        self.assertEqual(auth.authenticated_as, auth.username)
+        self.assertFalse(auth.readonly)
+
+        csv_file = io.StringIO("prefix,type,description\n1.3.0.0/16,reservation,test\n")
+        self.assertEqual(n.bulk_load_prefixes(auth, csv_file), 1)
+        self.assertEqual([p.prefix for p in Prefix.list()], ['1.3.0.0/16'])
+
+class TestRemovePrefixRecursive(unittest.TestCase):
+    """ Test removing a prefix along with the prefixes it covers
+    """
+
+    def setUp(self):
+        """ Test setup, which essentially means to empty the database
+        """
+        TestHelper.clear_database()
+
+    def test_remove_subtree(self):
+        """ Remove a subtree and check the statistics around it
+        """
+        th = TestHelper()
+        pool1 = th.add_pool('test', 'assignment', 28, 112)
+        p1 = th.add_prefix('1.3.0.0/16', 'reservation', 'test', pool_id=pool1.id)
+        p2 = th.add_prefix('1.3.0.0/20', 'reservation', 'test', pool_id=pool1.id)
+        th.add_prefix('1.3.1.0/24', 'assignment', 'test')
+        th.add_prefix('1.3.1.1/32', 'host', 'test')
+        th.add_prefix('1.3.1.2/32', 'host', 'test')
+        th.add_prefix('1.3.16.0/24', 'assignment', 'test')
+
+        p2.remove(recursive=True)
+
+        res = [(p.prefix, p.children, p.used_addresses) for p in Prefix.smart_search('1.3.0.0/16', {})['result']]
+        self.assertEqual(res, [('1.3.0.0/16', 1, 256), ('1.3.16.0/24', 0, 0)])
+
+        pool = Pool.get(pool1.id)
+        self.assertEqual(pool.member_prefixes_v4, 1)
+        self.assertEqual(pool.used_prefixes_v4, 1)
+        self.assertEqual(pool.free_prefixes_v4, 4080)
+        self.assertEqual(VRF.get(0).num_prefixes_v4, 2)
+
+        n = Nipap()
+        auth = SqliteAuth('local', 'unittest', 'gottatest', 'nipap')
+        auth.authenticate()
+        self.assertEqual(n.verify_stats(auth), [])
+
+        # the removed prefix is logged, also as removed from its pool
+        with n._db_connection():
+            n._execute("SELECT description FROM ip_net_log WHERE prefix_id = %s ORDER BY id", (p2.id,))
+            log = [row['description'] for row in n._curs_pg]
+        self.assertEqual(log[-2:], ['Removed prefix 1.3.0.0/20', 'Prefix 1.3.0.0/20 removed from pool test'])
+
+        p1.remove(recursive=True)
+        self.assertEqual(Prefix.list(), [])
+        self.assertEqual(n.verify_stats(auth), [])
+
+    def test_remove_range(self):
+        """ Remove the prefixes within a prefix which does not exist
+        """
+        th = TestHelper()
+        th.add_prefix('1.3.1.0/24', 'assignment', 'test')
+        th.add_prefix('1.3.1.1/32', 'host', 'test')
+        th.add_prefix('1.3.2.0/24', 'assignment', 'test')
+        th.add_prefix('1.4.0.0/24', 'assignment', 'test')
+
+        n = Nipap()
+        auth = SqliteAuth('local', 'unittest', 'gottatest', 'nipap')
+        auth.authenticate()
+        n.remove_prefix(auth, {'prefix': '1.3.0.0/16', 'vrf_id': 0}, recursive=True)
+
+        self.assertEqual([p.prefix for p in Prefix.list()], ['1.4.0.0/24'])
+        self.assertEqual(VRF.get(0).num_prefixes_v4, 1)
+        self.assertEqual(n.verify_stats(auth), [])
+
+
+
+class TestStats(unittest.TestCase):
+    """ Test verifying and rebuilding statistics
+    """
+
+    def setUp(self):
+        """ Test setup, which essentially means to empty the database
+        """
+        TestHelper.clear_database()
+
+    def test_verify_rebuild(self):
+        """ Values which are off are found and rebuilt
+        """
+        th = TestHelper()
+        pool1 = th.add_pool('test', 'assignment', 31, 112)
+        th.add_prefix('1.3.0.0/16', 'reservation', 'test', pool_id=pool1.id)
+        p2 = th.add_prefix('1.3.3.0/24', 'assignment', 'test')
+        th.add_prefix('1.3.3.1/32', 'host', 'test')
+
+        n = Nipap()
+        auth = SqliteAuth('local', 'unittest', 'gottatest', 'nipap')
+        auth.authenticate()
+        self.assertEqual(n.verify_stats(auth), [])
+
+        # mess up some values behind the back of the triggers
+        with n._db_connection(), n._transaction():
+            n._execute("SET LOCAL nipap.rebuild_stats = on")
+            n._execute("UPDATE ip_net_plan SET inherited_tags = '{foo}' WHERE prefix = '1.3.3.0/24'")
+            n._execute("UPDATE ip_net_plan_stats SET children = 7 WHERE prefix_id = %s", (p2.id,))
+            n._execute("DELETE FROM ip_net_plan_ancestor WHERE prefix_id = %s", (p2.id,))
+            n._execute("DELETE FROM ip_net_free_range WHERE prefix_id = %s", (p2.id,))
+            n._execute("UPDATE ip_net_vrf SET num_prefixes_v4 = 1")
+            n._execute("UPDATE ip_net_pool SET member_prefixes_v4 = 0")
+
+        off = {(row['table_name'], row['attribute']): row for row in n.verify_stats(auth, {'id': 0})}
+        self.assertEqual(sorted(off), [
+            ('ip_net_free_range', 'free_range'),
+            ('ip_net_plan', 'inherited_tags'),
+            ('ip_net_plan_ancestor', 'ancestor_id'),
+            ('ip_net_plan_stats', 'children'),
+            ('ip_net_pool', 'member_prefixes_v4'),
+            ('ip_net_vrf', 'num_prefixes_v4'),
+        ])
+        self.assertEqual(off[('ip_net_plan_stats', 'children')]['stored'], '7')
+        self.assertEqual(off[('ip_net_plan_stats', 'children')]['expected'], '1')
+        self.assertEqual(off[('ip_net_vrf', 'num_prefixes_v4')]['expected'], '3')
+
+        self.assertEqual(len(n.rebuild_stats(auth)), 6)
+        self.assertEqual(n.verify_stats(auth), [])
+        self.assertEqual(n.rebuild_stats(auth), [])
+
+        res = {p.prefix: p for p in Prefix.smart_search('1.3.0.0/16', {})['result']}
+        self.assertEqual(res['1.3.3.0/24'].children, 1)
+        self.assertEqual(res['1.3.3.1/32'].indent, 2)
+
+        # and the triggers take over again
+        th.add_prefix('1.3.4.0/24', 'assignment', 'test')
+        self.assertEqual(n.verify_stats(auth), [])
+
 
 
 class TestCli(unittest.TestCase):
@@ -3219,6 +4132,203 @@ class TestDatabaseConstraints(unittest.TestCase):
             p2.save()
 
 
+
+class TestQueryCache(unittest.TestCase):
+    """ Test the cache of WHERE-clauses compiled from search queries
+    """
+
+    def setUp(self):
+        """ Test setup, which essentially means to empty the database
+        """
+        TestHelper.clear_database()
+        nipap.backend._query_cache.clear()
+
+
+    def test_same_shape(self):
+        """ Queries of the same shape reuse the clause with their own values
+        """
+        th = TestHelper()
+        th.add_prefix('1.3.0.0/16', 'reservation', 'test')
+        th.add_prefix('1.3.3.0/24', 'assignment', 'foo')
+        th.add_prefix('1.3.4.0/24', 'assignment', 'bar')
+
+        n = Nipap()
+        auth = SqliteAuth('local', 'unittest', 'unittest', 'unittest')
+        cache = nipap.backend._query_cache
+
+        for description, prefix in (('foo', '1.3.3.0/24'), ('bar', '1.3.4.0/24')):
+            query = {
+                'operator': 'and',
+                'val1': {'operator': 'equals', 'val1': 'description', 'val2': description},
+                'val2': {'operator': 'equals', 'val1': 'vrf_id', 'val2': None}
+            }
+            hits = cache.hits
+            res = n.search_prefix(auth, query)
+            self.assertEqual([p['prefix'] for p in res['result']], [prefix])
+            # the query is normalized whether the clause is cached or not
+            self.assertEqual(query['val2']['val2'], 0)
+        self.assertEqual(cache.hits, hits + 1)
+
+        # a NULL-value is compiled into another clause
+        query = {'operator': 'equals', 'val1': 'description', 'val2': None}
+        res = n.search_prefix(auth, query)
+        self.assertEqual(res['result'], [])
+        self.assertEqual(query['operator'], 'is')
+
+
+
+class TestQueryOptimizer(unittest.TestCase):
+    """ Test the optimization of search queries before they are compiled
+    """
+
+    def setUp(self):
+        """ Test setup, which essentially means to empty the database
+        """
+        TestHelper.clear_database()
+
+
+    def test_long_chains(self):
+        """ Long chains of AND and OR are flattened and folded
+        """
+        th = TestHelper()
+        th.add_prefix('1.3.0.0/16', 'reservation', 'test')
+        th.add_prefix('1.3.3.0/24', 'assignment', 'test')
+        th.add_prefix('1.3.3.1/32', 'host', 'test')
+        th.add_prefix('1.3.4.0/24', 'assignment', 'test')
+
+        n = Nipap()
+        auth = SqliteAuth('local', 'unittest', 'unittest', 'unittest')
+
+        # far deeper than Python lets us recurse
+        query = {'operator': 'equals', 'val1': 'prefix', 'val2': '1.3.3.0/24'}
+        for i in range(2000):
+            query = {
+                'operator': 'or',
+                'val1': query,
+                'val2': {'operator': 'equals', 'val1': 'prefix', 'val2': '1.%d.%d.0/24' % (3 + i // 252, 4 + i % 252)}
+            }
+        res = n.search_prefix(auth, query, {'max_result': None})
+        self.assertEqual([p['prefix'] for p in res['result']], ['1.3.3.0/24', '1.3.4.0/24'])
+
+        # the narrower range of AND and wider range of OR is used
+        query = {
+            'operator': 'and',
+            'val1': {
+                'operator': 'and',
+                'val1': {'operator': 'contained_within_equals', 'val1': 'prefix', 'val2': '1.3.3.0/24'},
+                'val2': {'operator': 'contained_within_equals', 'val1': 'prefix', 'val2': '1.3.0.0/16'}
+            },
+            'val2': {
+                'operator': 'or',
+                'val1': {'operator': 'contained_within', 'val1': 'prefix', 'val2': '1.3.3.0/24'},
+                'val2': {'operator': 'contained_within', 'val1': 'prefix', 'val2': '1.3.0.0/16'}
+            }
+        }
+        res = n.search_prefix(auth, query)
+        self.assertEqual([p['prefix'] for p in res['result']], ['1.3.3.0/24', '1.3.3.1/32'])
+        self.assertEqual(query['val2']['val2']['val2'], '1.3.0.0/16')
+
+
+
+class TestConnectionPool(unittest.TestCase):
+    """ Test the database connection pool of the backend
+    """
+
+    def setUp(self):
+        """ Test setup, which essentially means to empty the database
+        """
+        TestHelper.clear_database()
+
+
+    def test_shared_pool(self):
+        """ Nipap instances share one pool and only hold connections during calls
+        """
+        n1 = Nipap()
+        n2 = Nipap()
+        self.assertIs(n1._pool, n2._pool)
+        self.assertIsNone(n1._con_pg)
+
+        auth = SqliteAuth('local', 'unittest', 'unittest', 'unittest')
+        n1.list_vrf(auth, {'id': 0})
+        self.assertIsNone(n1._con_pg)
+        self.assertEqual(n1._pool._used, 0)
+
+
+    def test_broken_connection(self):
+        """ A connection closed behind our back is replaced on checkout
+        """
+        n = Nipap()
+        pool = n._pool
+        con = pool.getconn()
+        pool.putconn(con)
+        con.close()
+
+        auth = SqliteAuth('local', 'unittest', 'unittest', 'unittest')
+        res = n.list_vrf(auth, {'id': 0})
+        self.assertEqual(res[0]['id'], 0)
+
+
+    def test_prepared_statements(self):
+        """ Statements are prepared once per connection, also after reconnecting
+        """
+        n = Nipap()
+        auth = SqliteAuth('local', 'unittest', 'unittest', 'unittest')
+        pool = nipap.backend.NipapConnectionPool(n._pool.db_args, max_size=1)
+        n._pool = pool
+
+        for i in range(3):
+            self.assertEqual(n.list_vrf(auth, {'id': 0})[0]['id'], 0)
+        stats = pool.prepared_statement_stats()['list_vrf']
+        self.assertEqual(stats['executions'], 3)
+        self.assertEqual(stats['prepared'], 1)
+
+        # kill the connection in the pool from the database side
+        con = pool.getconn()
+        pid = con.get_backend_pid()
+        pool.putconn(con)
+        killer = nipap.backend.NipapConnectionPool(n._pool.db_args)
+        con = killer.getconn()
+        con.cursor().execute("SELECT pg_terminate_backend(%s)", [pid])
+        killer.putconn(con, close=True)
+
+        self.assertEqual(n.list_vrf(auth, {'id': 0})[0]['id'], 0)
+        stats = pool.prepared_statement_stats()['list_vrf']
+        self.assertEqual(stats['executions'], 4)
+        self.assertEqual(stats['prepared'], 2)
+
+
+    def test_batched_audit_unprepared(self):
+        """ Audit inserts of varying batch sizes are not prepared
+        """
+        n = Nipap()
+        auth = SqliteAuth('local', 'unittest', 'gottatest', 'nipap')
+        auth.authenticate()
+        res = n.add_prefixes(auth, [{'prefix': '1.3.0.0/24', 'type': 'reservation',
+                                     'description': 'test'}])
+        self.assertEqual(res['errors'], [])
+        n.remove_prefix(auth, {'prefix': '1.3.0.0/16', 'vrf_id': 0}, True)
+        statements = len(nipap.backend._prepared_statements)
+
+        for i in range(1, 4):
+            attrs = [{'prefix': '1.%d.%d.0/24' % (i + 3, j), 'type': 'reservation',
+                      'description': 'test'} for j in range(i)]
+            self.assertEqual(n.add_prefixes(auth, attrs)['errors'], [])
+            n.remove_prefix(auth, {'prefix': '1.%d.0.0/16' % (i + 3), 'vrf_id': 0}, True)
+        self.assertEqual(len(nipap.backend._prepared_statements), statements)
+
+
+    def test_exhausted(self):
+        """ Checking out more than max_size connections times out
+        """
+        n = Nipap()
+        pool = nipap.backend.NipapConnectionPool(n._pool.db_args, max_size=1, timeout=0)
+        con = pool.getconn()
+        with self.assertRaisesRegex(nipap.backend.NipapError, "Timed out"):
+            pool.getconn()
+        pool.putconn(con)
+        pool.putconn(pool.getconn())
+
+
 if __name__ == '__main__':
 
     # set up logging
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+#
+# Measure how the time to add a prefix depends on the number of children of
+# its parent prefix, by filling a prefix with hosts and printing the average
+# time per add for every block of hosts added.
+#
+
+import argparse
+import sys
+import time
+
+import IPy
+
+sys.path.insert(0, '../../../nipap')
+
+from nipap.authlib import SqliteAuth
+from nipap.backend import Nipap
+from nipap.nipapconfig import NipapConfig
+
+
+def fill(n, auth, parent, count, block):
+    """ Add `count` hosts to `parent` and print the number of children of
+        the parent before each block and the average time per add within it
+    """
+
+    n.add_prefix(auth, {'prefix': parent, 'type': 'assignment', 'status': 'assigned',
+                        'description': 'fan-out test'})
+
+    hosts = IPy.IP(parent)
+    t_block = time.time()
+    for i in range(count):
+        n.add_prefix(auth, {'prefix': str(hosts[i + 1]), 'type': 'host', 'status': 'assigned',
+                            'description': 'fan-out test'})
+        if (i + 1) % block == 0:
+            t_now = time.time()
+            print("%d %.6f" % (i + 1 - block, (t_now - t_block) / block))
+            sys.stdout.flush()
+            t_block = t_now
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='/etc/nipap/nipap.conf', help='NIPAP configuration file')
+    parser.add_argument('--prefix', default='10.128.0.0/16', help='prefix to fill with hosts')
+    parser.add_argument('--count', type=int, default=4000, help='number of hosts to add')
+    parser.add_argument('--block', type=int, default=250, help='number of hosts per line of output')
+    args = parser.parse_args()
+
+    NipapConfig(args.config)
+    n = Nipap()
+    auth = SqliteAuth('local', 'fan-out', 'fan-out', 'fan-out')
+    auth.authenticated_as = 'fan-out'
+    auth.full_name = 'fan-out'
+
+    try:
+        fill(n, auth, args.prefix, args.count, args.block)
+    finally:
+        n._execute("DELETE FROM ip_net_plan WHERE iprange(prefix) << iprange(%(prefix)s::cidr)", {'prefix': args.prefix})
+        n._execute("DELETE FROM ip_net_plan WHERE prefix = %(prefix)s", {'prefix': args.prefix})
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+""" Benchmark prefix searches over datasets of increasing size
+
+    Each dataset is a /8 split into /16 reservations, with a number of /24
+    assignments spread out over them, each holding a few hosts. Every tenth
+    assignment is tagged 'customer'. The searches are timed on each dataset,
+    taking the best out of a number of runs.
+
+    WARNING: all prefixes in the database are removed, so only run this
+    against a database set aside for testing.
+"""
+
+import argparse
+import io
+import ipaddress
+import random
+import sys
+import time
+
+sys.path.append('../../nipap/')
+
+from nipap.nipapconfig import NipapConfig
+
+
+SEARCHES = [
+    ('customer tag, all parents', 'smart',
+        '#customer', {'parents_depth': -1}),
+    ('customer tag, all parents, no limit', 'smart',
+        '#customer', {'parents_depth': -1, 'max_result': None}),
+    ('/8 with all children', 'query',
+        {'operator': 'equals', 'val1': 'prefix', 'val2': '10.0.0.0/8'},
+        {'children_depth': -1}),
+    ('host with neighbors', 'query',
+        {'operator': 'equals', 'val1': 'type', 'val2': 'host'},
+        {'include_neighbors': True, 'parents_depth': -1}),
+    ('description regex, no limit', 'query',
+        {'operator': 'regex_match', 'val1': 'description', 'val2': '^a'},
+        {'max_result': None}),
+]
+
+
+def load(n, auth, assignments):
+    """ Replace all prefixes with a dataset of the given number of assignments
+    """
+    n._execute("TRUNCATE ip_net_plan CASCADE")
+
+    buf = io.StringIO()
+    buf.write('prefix,type,description,tags\n')
+    root = ipaddress.ip_network('10.0.0.0/8')
+    buf.write('%s,reservation,root,{}\n' % root)
+    for net in root.subnets(new_prefix=16):
+        buf.write('%s,reservation,reservation,{}\n' % net)
+
+    rnd = random.Random(1)
+    for i, net in enumerate(rnd.sample(list(root.subnets(new_prefix=24)), assignments)):
+        buf.write('%s,assignment,assignment,%s\n' % (net, '{customer}' if i % 10 == 0 else '{}'))
+        for host in list(net.hosts())[:3]:
+            buf.write('%s/32,host,host,{}\n' % host)
+    buf.seek(0)
+
+    return n.bulk_load_prefixes(auth, buf)
+
+
+def run(n, auth, runs):
+    """ Time the searches, returning the best time and result size of each
+    """
+    res = []
+    for name, kind, query, options in SEARCHES:
+        best = None
+        for i in range(runs):
+            t0 = time.time()
+            if kind == 'smart':
+                result = n.smart_search_prefix(auth, query, dict(options))
+            else:
+                result = n.search_prefix(auth, query, dict(options))
+            elapsed = time.time() - t0
+            if best is None or elapsed < best:
+                best = elapsed
+        res.append((name, len(result['result']), best))
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--config', default='/etc/nipap/nipap.conf', help='NIPAP configuration file')
+    parser.add_argument('--sizes', default='250,2500,25000',
+            help='comma separated numbers of assignments to load, each with three hosts')
+    parser.add_argument('--runs', type=int, default=5, help='runs of each search')
+    parser.add_argument('--username', required=True, help='user in the local auth database')
+    parser.add_argument('--password', required=True, help='password of the user')
+    args = parser.parse_args()
+
+    NipapConfig(args.config)
+    from nipap.backend import Nipap
+    from nipap.authlib import SqliteAuth
+
+    n = Nipap()
+    auth = SqliteAuth('local', args.username, args.password, 'nipap')
+    if not auth.authenticate():
+        print("authentication failed", file=sys.stderr)
+        sys.exit(1)
+
+    for size in [int(s) for s in args.sizes.split(',')]:
+        t0 = time.time()
+        num_prefixes = load(n, auth, size)
+        print("%d prefixes loaded in %.1fs" % (num_prefixes, time.time() - t0))
+        for name, rows, elapsed in run(n, auth, args.runs):
+            print("  %-40s %6d rows %9.1f ms" % (name, rows, elapsed * 1000))
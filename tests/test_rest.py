@@ -548,6 +548,27 @@ class NipapRestTest(unittest.TestCase):
         self.assertEqual(result[0]['prefix'], '1.33.35.0/24')
         self.assertEqual(result[24]['prefix'], '1.33.59.0/24')
 
+    def test_prefix_add_many(self):
+        """ Add a list of prefixes in one request
+        """
+
+        attrs = [
+            {'prefix': '1.34.0.0/24', 'type': 'assignment', 'description': 'test add many'},
+            {'prefix': '1.34.1.0/24', 'type': 'assignment'},
+            {'prefix': '1.34.2.0/24', 'type': 'assignment', 'description': 'test add many'}
+        ]
+
+        # nothing added if one fails
+        request = requests.post(self.server_url, headers=self.headers, json=attrs, params={'atomic': 'true'})
+        self.assertRegex(request.text, "Prefix 1: Either description or node must be specified.")
+
+        request = requests.post(self.server_url, headers=self.headers, json=attrs)
+        self.assertEqual(request.status_code, 200,
+                         msg=f"Result status code {request.status_code} != 200, response: {request.text}")
+        result = request.json()
+        self.assertEqual([p['prefix'] for p in result['result']], ['1.34.0.0/24', '1.34.2.0/24'])
+        self.assertEqual([e['index'] for e in result['errors']], [1])
+
 
 if __name__ == '__main__':
 
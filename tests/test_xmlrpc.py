@@ -1106,6 +1106,63 @@ class NipapXmlTest(unittest.TestCase):
 
 
 
+    def test_prefix_add_many(self):
+        """ Add many prefixes in one call
+        """
+        attrs = [
+                { 'prefix': '1.3.3.0/24', 'type': 'assignment', 'description': 'parent' },
+                { 'prefix': '1.3.3.1/32', 'type': 'host', 'description': 'child 1' },
+                { 'prefix': '1.3.3.2/32', 'type': 'host' },
+                { 'prefix': '1.3.3.1/32', 'type': 'host', 'description': 'duplicate' },
+                { 'prefix': '1.3.3.3/32', 'type': 'host', 'description': 'child 3', 'vrf_rt': '123:456' },
+                { 'prefix': '1.3.3.4/32', 'type': 'host', 'description': 'child 4' }
+            ]
+
+        # all or nothing
+        with self.assertRaisesRegex(xmlrpc.client.Fault, "Prefix 2: Either description or node must be specified."):
+            s.add_prefixes({ 'auth': ad, 'attrs': attrs, 'options': { 'atomic': True } })
+        with self.assertRaisesRegex(xmlrpc.client.Fault, "Duplicate value"):
+            s.add_prefixes({ 'auth': ad, 'attrs': [attrs[0], attrs[1], attrs[3]],
+                'options': { 'atomic': True } })
+        self.assertEqual(s.list_prefix({ 'auth': ad }), [])
+
+        # add what can be added
+        res = s.add_prefixes({ 'auth': ad, 'attrs': attrs })
+        self.assertEqual([ p['prefix'] for p in res['result'] ],
+                ['1.3.3.0/24', '1.3.3.1/32', '1.3.3.4/32'])
+        self.assertEqual([ (e['index'], e['error_code']) for e in res['errors'] ],
+                [(2, 1110), (3, 1400), (4, 1300)])
+
+        listed = s.list_prefix({ 'auth': ad })
+        self.assertEqual([ p['id'] for p in listed ], [ p['id'] for p in res['result'] ])
+        self.assertEqual([ p['indent'] for p in listed ], [0, 1, 1])
+
+
+
+    def test_prefix_edit_many(self):
+        """ Check that edit_prefix returns all edited prefixes
+        """
+        attrs = []
+        for i in range(0, 120):
+            attrs.append({ 'prefix': '1.3.%d.0/24' % i, 'type': 'assignment',
+                'description': 'test', 'order_id': 'bulk' })
+        s.add_prefixes({ 'auth': ad, 'attrs': attrs, 'options': { 'atomic': True } })
+
+        edit_res = s.edit_prefix({ 'auth': ad,
+            'prefix': { 'order_id': 'bulk' },
+            'attr': { 'description': 'edited' } })
+        self.assertEqual(sorted(p['prefix'] for p in edit_res),
+                sorted(attr['prefix'] for attr in attrs))
+        self.assertEqual(set(p['description'] for p in edit_res), set(['edited']))
+
+        # the 'in' operator used to fetch them
+        ids = [ p['id'] for p in edit_res[0:3] ]
+        res = s.search_prefix({ 'auth': ad, 'query': {
+                'operator': 'in', 'val1': 'id', 'val2': ids } })
+        self.assertEqual(sorted(p['id'] for p in res['result']), sorted(ids))
+
+
+
     def test_prefix_smart_search(self):
         """ Test the prefix smart search
         """
@@ -1170,7 +1227,9 @@ class NipapXmlTest(unittest.TestCase):
                 'search_options': {'include_all_children':
                 False, 'max_result': 50, 'include_all_parents': False,
                 'parents_depth': 0, 'offset': 0, 'children_depth': 0,
-                'parent_prefix': None, 'include_neighbors': False },
+                'parent_prefix': None, 'include_neighbors': False,
+                'after': None },
+                'next_cursor': None,
                 'error': False,
                 'result': [
                     {'comment': None,
@@ -1349,9 +1408,15 @@ class NipapXmlTest(unittest.TestCase):
             s.add_pool({ 'auth': ad, 'attr': attr })
 
         attr['ipv6_default_prefix_length'] = 112
+        attr['allocation_strategy'] = 'worst-fit'
+        with self.assertRaisesRegex(xmlrpc.client.Fault, '1200: \'Allocation strategy must be one of: first-fit, next-fit, sparse'):
+            s.add_pool({ 'auth': ad, 'attr': attr })
+
+        del attr['allocation_strategy']
 
         res = s.add_pool({ 'auth': ad, 'attr': attr })
         expected = attr.copy()
+        expected['allocation_strategy'] = 'first-fit'
         expected['id'] = res['id']
         expected['prefixes'] = []
         expected['vrf_id'] = None
@@ -1386,7 +1451,8 @@ class NipapXmlTest(unittest.TestCase):
             'description': 'Test pool #2 edit',
             'default_type': 'assignment',
             'ipv4_default_prefix_length': 30,
-            'ipv6_default_prefix_length': 96
+            'ipv6_default_prefix_length': 96,
+            'allocation_strategy': 'next-fit'
         }
 
         res = s.add_pool({ 'auth': ad, 'attr': attr })